@@ -0,0 +1,180 @@
+"""
+Локальная замена Bot API для бенчмарков.
+
+Отвечает на методы, которые вызывает бот (sendMessage, editMessageText,
+sendVideo, getChatMember и т.д.), как настоящий Telegram, и записывает
+каждый вызов: метод, чат, объём загруженного файла, время. Файлы из
+sendVideo не сохраняются — только считаются байты.
+
+Бот направляется сюда через telebot.asyncio_helper.API_URL (см. use_with()).
+"""
+import itertools
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from aiohttp import web
+from telebot import asyncio_helper
+
+
+@dataclass
+class ApiCall:
+    method: str
+    chat_id: int
+    at: float
+    upload_bytes: int = 0
+    message_id: int = 0
+    text: str = ""
+
+
+class FakeBotApi:
+    """
+    flood_rate — доля запросов, на которые отвечаем 429 (retry_after
+    flood_retry_after секунд), чтобы нагрузить повторы диспетчера.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, flood_rate=0.0, flood_retry_after=1):
+        self.host = host
+        self.port = port
+        self.flood_rate = flood_rate
+        self.flood_retry_after = flood_retry_after
+        self.calls = []
+        self.messages = {}      # (chat_id, message_id) → последний текст
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._runner = None
+
+    # Сервер
+
+    async def start(self):
+        # Видео до 50 МБ (и больше — Local Bot API) приходят multipart-запросом
+        app = web.Application(client_max_size=4 * 1024 ** 3)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @property
+    def api_url(self):
+        return f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+
+    def use_with(self):
+        """Направляет все запросы AsyncTeleBot в этот процесс сюда."""
+        asyncio_helper.API_URL = self.api_url
+
+    # Разбор запроса
+
+    async def _read_params(self, request):
+        params, upload_bytes = {}, 0
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename is None:
+                    params[part.name] = await part.text()
+                    continue
+                while True:
+                    chunk = await part.read_chunk(1024 * 1024)
+                    if not chunk:
+                        break
+                    upload_bytes += len(chunk)
+                params[part.name] = None
+        else:
+            params.update(request.query)
+            params.update(await request.post())
+        return params, upload_bytes
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        params, upload_bytes = await self._read_params(request)
+        chat_id = int(params.get("chat_id") or 0)
+        call = ApiCall(method, chat_id, time.monotonic(), upload_bytes)
+        self.calls.append(call)
+
+        if self.flood_rate and method != "getUpdates" and random.random() < self.flood_rate:
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.flood_retry_after}",
+                "parameters": {"retry_after": self.flood_retry_after},
+            }, status=429)
+
+        handler = getattr(self, f"_api_{method}", None)
+        result = handler(params, call) if handler is not None else True
+        return web.json_response({"ok": True, "result": result})
+
+    # Методы Bot API
+
+    def _message(self, chat_id, **fields):
+        message_id = next(self._message_ids)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+            **fields,
+        }
+
+    def _api_getMe(self, params, call):
+        return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+    def _api_getUpdates(self, params, call):
+        return []
+
+    def _api_getChatMember(self, params, call):
+        user_id = int(params.get("user_id") or 0)
+        return {
+            "user": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "status": "member",
+        }
+
+    def _api_sendMessage(self, params, call):
+        message = self._message(call.chat_id, text=params.get("text", ""))
+        call.message_id, call.text = message["message_id"], message["text"]
+        self.messages[(call.chat_id, call.message_id)] = call.text
+        return message
+
+    def _api_editMessageText(self, params, call):
+        call.message_id = int(params.get("message_id") or 0)
+        call.text = params.get("text", "")
+        self.messages[(call.chat_id, call.message_id)] = call.text
+        return self._message(call.chat_id, text=call.text)
+
+    def _media(self, params, kind):
+        # Повторная отправка по file_id возвращает тот же file_id
+        file_id = params.get(kind) or f"bench-{kind}-{next(self._file_ids)}"
+        return {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "width": int(params.get("width") or 0),
+            "height": int(params.get("height") or 0),
+            "duration": int(params.get("duration") or 0),
+        }
+
+    def _api_sendVideo(self, params, call):
+        message = self._message(call.chat_id, video=self._media(params, "video"))
+        call.message_id = message["message_id"]
+        return message
+
+    def _api_sendDocument(self, params, call):
+        message = self._message(call.chat_id, document=self._media(params, "document"))
+        call.message_id = message["message_id"]
+        return message
+
+    def _api_sendMediaGroup(self, params, call):
+        return [self._message(call.chat_id)]
+
+    # Итоги
+
+    def summary(self):
+        methods = Counter(call.method for call in self.calls)
+        uploaded = sum(call.upload_bytes for call in self.calls)
+        return {"calls": dict(methods), "uploaded_bytes": uploaded}
@@ -0,0 +1,116 @@
+"""
+Локальный HTTP-сервер с тестовыми видео для бенчмарков.
+
+Видео генерируются ffmpeg из lavfi-источников testsrc2 + sine: разной
+длительности, с разными кодеками и размерами, чтобы через бота прошли все
+ветки — remux без перекодирования, полное перекодирование, подгонка под
+50 МБ и нарезка на части. Сгенерированные файлы кэшируются в media_dir
+и при повторном запуске не пересоздаются.
+
+Адрес видео — http://host:port/<job>/<имя>.<ext>: часть <job> сервер
+игнорирует, но у каждой задачи получается своя ссылка, поэтому кэш
+результатов и singleflight бота их не склеивают.
+"""
+import os
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+
+from aiohttp import web
+
+
+@dataclass(frozen=True)
+class Variant:
+    name: str
+    duration: int       # секунды
+    size: str           # ШxВ
+    vcodec: str
+    acodec: str
+    ext: str = "mp4"
+    video_bitrate: str = ""
+
+    @property
+    def filename(self):
+        return f"{self.name}.{self.ext}"
+
+
+VARIANTS = {
+    v.name: v for v in (
+        # Совместимое H.264/AAC — только remux
+        Variant("short_h264", 15, "640x360", "libx264", "aac"),
+        Variant("hd_h264", 60, "1280x720", "libx264", "aac"),
+        # Несовместимые кодеки — полное перекодирование
+        Variant("mpeg4_mp3", 30, "854x480", "mpeg4", "libmp3lame"),
+        Variant("vp9_opus", 30, "854x480", "libvpx-vp9", "libopus", ext="webm"),
+        # Больше 50 МБ — подгонка битрейта или нарезка на части
+        Variant("big_h264", 180, "1920x1080", "libx264", "aac", video_bitrate="4M"),
+    )
+}
+
+
+def generate(variant, media_dir):
+    """Создаёт видео варианта в media_dir (если ещё нет) и возвращает путь."""
+    path = Path(media_dir) / variant.filename
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}")
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={variant.size}:rate=30:duration={variant.duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={variant.duration}",
+        "-c:v", variant.vcodec, "-pix_fmt", "yuv420p",
+    ]
+    if variant.video_bitrate:
+        cmd += ["-b:v", variant.video_bitrate]
+    elif variant.vcodec == "libx264":
+        cmd += ["-preset", "veryfast", "-crf", "23"]
+    cmd += ["-c:a", variant.acodec, "-shortest", "-f", variant.ext]
+    if variant.ext == "mp4":
+        cmd += ["-movflags", "+faststart"]
+    cmd.append(str(tmp_path))
+    subprocess.run(cmd, check=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def generate_all(names, media_dir):
+    """{имя варианта: путь} для всех запрошенных вариантов."""
+    return {name: generate(VARIANTS[name], media_dir) for name in names}
+
+
+class MediaServer:
+    """Отдаёт файлы из media_dir с поддержкой Range (yt-dlp докачивает кусками)."""
+
+    def __init__(self, media_dir, host="127.0.0.1", port=0):
+        self.media_dir = Path(media_dir)
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/{job}/{name}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def url(self, job, variant):
+        return f"http://{self.host}:{self.port}/{job}/{variant.filename}"
+
+    async def _handle(self, request):
+        name = request.match_info["name"]
+        path = self.media_dir / name
+        if "/" in name or name.startswith(".") or not path.is_file():
+            raise web.HTTPNotFound()
+        self.requests += 1
+        return web.FileResponse(path)
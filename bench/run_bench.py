@@ -0,0 +1,372 @@
+"""
+Сквозной бенчмарк пайплайна без сети и без Telegram.
+
+В одном процессе поднимаются:
+  • заглушка Bot API (bench/fake_bot_api.py) — бот отправляет видео и правит
+    статусы в неё, вызовы записываются;
+  • HTTP-сервер с тестовыми видео (bench/media_server.py, ffmpeg testsrc2);
+  • сам бот (bot.main) со временными DB_PATH и DOWNLOAD_DIR.
+
+Генератор нагрузки отдаёт в bot.process_new_updates N синтетических
+сообщений со ссылками на тестовые видео — каждое проходит обычный путь
+handle_download_request: подписка, планировщик, скачивание yt-dlp,
+ffmpeg, отправка. В конце печатает задачи/мин, задержку задач, время
+стадий (p50/p95 из bot.metrics), пиковый RSS процесса с дочерними ffmpeg,
+пиковый объём DOWNLOAD_DIR и число вызовов Bot API.
+
+    python -m bench.run_bench --jobs 12 --variants short_h264,mpeg4_mp3
+    python -m bench.run_bench --json head.json --baseline base.json --max-regression 20
+
+Настройки бота меняются через --env (MAX_PARALLEL_TRANSCODES=1 и т.п.),
+чтобы сравнивать конфигурации на одной машине. Нужен ffmpeg в PATH.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from telebot import types
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fake_bot_api import FakeBotApi  # noqa: E402
+from bench.media_server import VARIANTS, MediaServer, generate_all  # noqa: E402
+from bench.webhook_load import make_update, percentile  # noqa: E402
+
+# chat_id синтетических пользователей (ADMIN_ID бенчмарка — 1)
+FIRST_CHAT_ID = 200000
+
+DEFAULT_VARIANTS = "short_h264,hd_h264,mpeg4_mp3,vp9_opus"
+
+# Показатели для сравнения с базовым прогоном: (ключ, больше — лучше)
+COMPARED = (
+    ("jobs_per_min", True),
+    ("job_seconds_p50", False),
+    ("job_seconds_p95", False),
+    ("peak_rss_mb", False),
+    ("peak_disk_mb", False),
+)
+
+
+def _tree_rss_bytes(root_pid):
+    """RSS процесса и всех его потомков по /proc (только Linux)."""
+    parents = {}
+    rss = {}
+    page = os.sysconf("SC_PAGE_SIZE")
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        pid = int(entry.name)
+        parents[pid] = int(fields[1])
+        rss[pid] = int(fields[21]) * page
+    total = 0
+    for pid, value in rss.items():
+        node = pid
+        while node and node != root_pid:
+            node = parents.get(node)
+        if node == root_pid:
+            total += value
+    return total
+
+
+def _dir_size(path):
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+    return total
+
+
+class PeakSampler(threading.Thread):
+    """Раз в interval секунд снимает RSS дерева процессов и объём папок, запоминает максимум."""
+
+    def __init__(self, dirs, interval=0.1):
+        super().__init__(daemon=True)
+        self.dirs = dirs
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stopping = threading.Event()
+        self._proc = os.path.isdir("/proc")
+
+    def sample(self):
+        if self._proc:
+            self.peak_rss = max(self.peak_rss, _tree_rss_bytes(os.getpid()))
+        self.peak_disk = max(self.peak_disk, sum(_dir_size(d) for d in self.dirs))
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+        self.sample()
+
+
+def _configure_env(workdir, args):
+    """Окружение бота — до импорта bot.config, который читает его при импорте."""
+    env = {
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "ADMIN_ID": "1",
+        "CHANNEL_USERNAME": "@bench_channel",
+        "DB_PATH": str(workdir / "bench.sqlite3"),
+        "DOWNLOAD_DIR": str(workdir / "downloads"),
+        "CONVERTED_DIR": str(workdir / "converted"),
+        "METRICS_PORT": "0",
+        "WEBHOOK_URL": "",
+        "EXTERNAL_WORKERS": "0",
+        # Все задачи бенчмарка должны попасть в очередь
+        "MAX_QUEUED_JOBS": str(max(args.jobs, 50)),
+        "INTRO_VIDEO_PATH": str(workdir / "intro.mp4"),
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    os.environ.update(env)
+
+
+def _final_states(fake):
+    """Итог задачи — по последнему тексту её статусного сообщения."""
+    states = {"ok": 0, "failed": 0, "rejected": 0, "other": 0}
+    for (chat_id, _), text in fake.messages.items():
+        if chat_id < FIRST_CHAT_ID:
+            # Сводки администратору и прочие служебные сообщения
+            continue
+        if text.startswith("✅"):
+            states["ok"] += 1
+        elif text.startswith("🚫"):
+            states["failed"] += 1
+        elif text.startswith("⏳"):
+            states["rejected"] += 1
+        else:
+            states["other"] += 1
+    return states
+
+
+def _series(metrics, name, scale=1.0):
+    """{значение метки: {count, p50, p95}} для гистограммы с одной меткой."""
+    result = {}
+    for key, (count, p50, p95, _) in metrics.registry.quantiles(name).items():
+        label = ",".join(str(value) for _, value in key) or "all"
+        result[label] = {
+            "count": count,
+            "p50": round(p50 * scale, 3),
+            "p95": round(p95 * scale, 3),
+        }
+    return result
+
+
+async def run(args, workdir):
+    variants = [VARIANTS[name] for name in args.variants.split(",")]
+    media_dir = Path(args.media_dir or workdir / "media")
+    print(f"Генерирую тестовые видео в {media_dir}...", flush=True)
+    started = time.perf_counter()
+    await asyncio.to_thread(generate_all, [v.name for v in variants], media_dir)
+    print(f"  готово за {time.perf_counter() - started:.1f} с", flush=True)
+
+    fake = await FakeBotApi(flood_rate=args.flood_rate).start()
+    fake.use_with()
+    media_server = await MediaServer(media_dir).start()
+
+    # Импорт бота — только после настройки окружения и API_URL
+    from bot import main as frontend
+    from bot import metrics
+
+    updates = [
+        make_update(
+            i + 1,
+            FIRST_CHAT_ID + i % args.users,
+            media_server.url(i, variants[i % len(variants)]),
+        )
+        for i in range(args.jobs)
+    ]
+    updates = [types.Update.de_json(update) for update in updates]
+
+    sampler = PeakSampler([
+        os.environ["DOWNLOAD_DIR"], os.environ["CONVERTED_DIR"],
+    ])
+    sampler.start()
+
+    limit = asyncio.Semaphore(args.concurrency)
+    job_seconds = []
+
+    async def fire(update):
+        async with limit:
+            job_started = time.perf_counter()
+            await frontend.bot.process_new_updates([update])
+            job_seconds.append(time.perf_counter() - job_started)
+
+    print(
+        f"Запускаю {args.jobs} задач ({args.concurrency} одновременно, "
+        f"{args.users} пользователей)...",
+        flush=True,
+    )
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(fire(update) for update in updates)), timeout=args.timeout
+        )
+    except asyncio.TimeoutError:
+        print(f"  превышен --timeout {args.timeout} с, итог неполный", flush=True)
+    elapsed = time.perf_counter() - started
+
+    await frontend._shutdown()
+    sampler.stop()
+    await media_server.stop()
+    await fake.stop()
+
+    states = _final_states(fake)
+    # ru_maxrss на Linux — в КБ; точный пик самого процесса, выборки его могут пропустить
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    api = fake.summary()
+    return {
+        "jobs": args.jobs,
+        "concurrency": args.concurrency,
+        "variants": [v.name for v in variants],
+        "env": dict(item.partition("=")[::2] for item in args.env),
+        "elapsed_seconds": round(elapsed, 2),
+        "states": states,
+        "jobs_per_min": round(states["ok"] * 60 / elapsed, 2) if elapsed else 0.0,
+        "job_seconds_p50": round(percentile(job_seconds, 0.5), 2),
+        "job_seconds_p95": round(percentile(job_seconds, 0.95), 2),
+        "stage_seconds": _series(metrics, "stage_seconds"),
+        "queue_wait_seconds": _series(metrics, "queue_wait_seconds"),
+        "tool_cpu_seconds": _series(metrics, "tool_cpu_seconds"),
+        "stage_mb": _series(metrics, "stage_bytes", scale=1 / 1024 / 1024),
+        "peak_rss_mb": round(max(sampler.peak_rss, self_rss) / 1024 / 1024, 1),
+        "peak_self_rss_mb": round(self_rss / 1024 / 1024, 1),
+        "peak_disk_mb": round(sampler.peak_disk / 1024 / 1024, 1),
+        "bot_api_calls": api["calls"],
+        "uploaded_mb": round(api["uploaded_bytes"] / 1024 / 1024, 1),
+    }
+
+
+def _print_series(title, series, unit):
+    if not series:
+        return
+    print(title)
+    for label, values in sorted(series.items()):
+        print(
+            f"  {label}: {values['count']} шт, p50 {values['p50']:g} {unit}, "
+            f"p95 {values['p95']:g} {unit}"
+        )
+
+
+def report(result):
+    states = result["states"]
+    print()
+    print(f"Задач: {result['jobs']}, за {result['elapsed_seconds']} с")
+    print(
+        f"Итог: готово {states['ok']}, ошибок {states['failed']}, "
+        f"отказов {states['rejected']}, без итога {states['other']}"
+    )
+    print(f"Пропускная способность: {result['jobs_per_min']} задач/мин")
+    print(
+        f"Задача целиком: p50 {result['job_seconds_p50']} с, "
+        f"p95 {result['job_seconds_p95']} с"
+    )
+    _print_series("Стадии:", result["stage_seconds"], "с")
+    _print_series("Ожидание в очереди:", result["queue_wait_seconds"], "с")
+    _print_series("CPU инструментов:", result["tool_cpu_seconds"], "с")
+    _print_series("Объём данных:", result["stage_mb"], "МБ")
+    print(
+        f"Пиковый RSS: {result['peak_rss_mb']} МБ вместе с дочерними ffmpeg "
+        f"(сам процесс — {result['peak_self_rss_mb']} МБ)"
+    )
+    print(f"Пиковый объём DOWNLOAD_DIR: {result['peak_disk_mb']} МБ")
+    print(f"Bot API: {result['bot_api_calls']}, загружено {result['uploaded_mb']} МБ")
+
+
+def compare(result, baseline, max_regression):
+    """Печатает разницу с базовым прогоном. False — если регрессия больше max_regression %."""
+    print()
+    print("Сравнение с базовым прогоном:")
+    ok = True
+    for key, higher_is_better in COMPARED:
+        old, new = baseline.get(key), result.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) * 100 / old
+        worse = -change if higher_is_better else change
+        mark = ""
+        if max_regression and worse > max_regression:
+            mark, ok = "  ← регрессия", False
+        print(f"  {key}: {old} → {new} ({change:+.1f}%){mark}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=12, help="сколько задач отправить")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="сколько обновлений обрабатывается одновременно (0 — все сразу)")
+    parser.add_argument("--users", type=int, default=0,
+                        help="сколько разных пользователей (0 — по одному на задачу)")
+    parser.add_argument("--variants", default=DEFAULT_VARIANTS,
+                        help=f"тестовые видео через запятую из: {', '.join(VARIANTS)}")
+    parser.add_argument("--media-dir", help="кэш сгенерированных видео между запусками")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="настройка бота (можно несколько раз)")
+    parser.add_argument("--flood-rate", type=float, default=0.0,
+                        help="доля запросов к Bot API, получающих 429")
+    parser.add_argument("--timeout", type=float, default=1800)
+    parser.add_argument("--json", help="записать результат в файл")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, default=0,
+                        help="код возврата 1, если показатель хуже базового больше чем на N %%")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку")
+    args = parser.parse_args()
+    args.concurrency = args.concurrency or args.jobs
+    args.users = args.users or args.jobs
+
+    unknown = [name for name in args.variants.split(",") if name not in VARIANTS]
+    if unknown:
+        parser.error(f"неизвестные варианты: {', '.join(unknown)}")
+    if shutil.which("ffmpeg") is None:
+        parser.error("нужен ffmpeg в PATH")
+
+    workdir = Path(tempfile.mkdtemp(prefix="margarine-bench-"))
+    try:
+        _configure_env(workdir, args)
+        result = asyncio.run(run(args, workdir))
+    finally:
+        if args.keep:
+            print(f"Рабочая папка: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report(result)
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if not compare(result, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Нагрузочный тест приёма обновлений через webhook.
+
+Шлёт синтетические обновления Telegram POST-запросами и считает,
+сколько обновлений в секунду принимает сервер.
+
+Без --url поднимает в этом же процессе WebhookServer с ботом, у которого
+один обработчик просто считает сообщения (Bot API не вызывается), и меряет
+и приём, и обработку:
+
+    python -m bench.webhook_load --updates 5000 --concurrency 100
+
+С --url шлёт обновления в уже запущенный бот (WEBHOOK_SECRET должен
+совпадать). Осторожно: боевой бот будет отвечать на них в Telegram.
+
+    python -m bench.webhook_load --url http://127.0.0.1:8443/telegram --secret ...
+"""
+import argparse
+import asyncio
+import itertools
+import secrets
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bot.webhook import SECRET_HEADER, WebhookServer  # noqa: E402
+
+
+def make_update(update_id, chat_id, text):
+    """Обновление с текстовым сообщением в личном чате, как его присылает Telegram."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "bench"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench",
+                     "username": f"bench{chat_id}"},
+            "text": text,
+        },
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def post_updates(url, secret, count, concurrency, users, text):
+    """Отправляет count обновлений с concurrency параллельными запросами."""
+    latencies = []
+    statuses = {}
+    update_ids = itertools.count(1)
+    headers = {SECRET_HEADER: secret}
+
+    async def worker(session):
+        for update_id in update_ids:
+            if update_id > count:
+                return
+            payload = make_update(update_id, 100000 + update_id % users, text)
+            started = time.perf_counter()
+            async with session.post(url, json=payload, headers=headers) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Запрос без секрета должен отклоняться
+        async with session.post(url, json=make_update(0, 1, text)) as response:
+            rejected_status = response.status
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return elapsed, latencies, statuses, rejected_status
+
+
+async def run_local(args):
+    from telebot.async_telebot import AsyncTeleBot
+
+    bot = AsyncTeleBot("0:bench")
+    processed = 0
+    done = asyncio.Event()
+
+    @bot.message_handler(content_types=["text"])
+    async def count_message(message):
+        nonlocal processed
+        processed += 1
+        if processed >= args.updates:
+            done.set()
+
+    secret = secrets.token_urlsafe(32)
+    server = WebhookServer(bot, secret, host="127.0.0.1", port=args.port)
+    await server.start()
+    url = f"http://127.0.0.1:{args.port}{server.path}"
+    started = time.perf_counter()
+    try:
+        result = await post_updates(
+            url, secret, args.updates, args.concurrency, args.users, args.text
+        )
+        try:
+            await asyncio.wait_for(done.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            pass
+        processed_elapsed = time.perf_counter() - started
+    finally:
+        await server.stop()
+    return result, processed, processed_elapsed
+
+
+def report(args, elapsed, latencies, statuses, rejected_status):
+    accepted = statuses.get(200, 0)
+    print(f"Обновлений: {args.updates}, параллельно: {args.concurrency}")
+    print(f"Ответы: {dict(sorted(statuses.items()))}, без секрета: {rejected_status}")
+    print(f"Приём: {accepted / elapsed:.0f} обновлений/с за {elapsed:.2f} с")
+    print(
+        "Задержка ответа: "
+        f"p50 {percentile(latencies, 0.5) * 1000:.1f} мс, "
+        f"p95 {percentile(latencies, 0.95) * 1000:.1f} мс, "
+        f"среднее {statistics.fmean(latencies) * 1000:.1f} мс"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="адрес webhook запущенного бота")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET бота (с --url)")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=100, help="сколько разных chat_id")
+    parser.add_argument("--text", default="/bench")
+    parser.add_argument("--port", type=int, default=18443, help="порт локального сервера")
+    args = parser.parse_args()
+
+    if args.url:
+        result = asyncio.run(post_updates(
+            args.url, args.secret, args.updates, args.concurrency, args.users, args.text
+        ))
+        report(args, *result)
+        return
+
+    result, processed, processed_elapsed = asyncio.run(run_local(args))
+    report(args, *result)
+    print(
+        f"Обработано обработчиком: {processed} "
+        f"({processed / processed_elapsed:.0f}/с с начала теста)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from collections import Counter, defaultdict
+
+from bot.result_cache import normalize_url
+
+
+# Лимит длины сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+
+class AdminDigest:
+    """
+    Сводка для администратора вместо отдельного сообщения на каждое
+    действие пользователя.
+
+    События (новые сообщения, отправленные видео, деление на части,
+    время стадий) копятся в памяти и уходят одним сообщением раз в interval
+    секунд или сразу, когда набралось max_events. Ошибки отправляются
+    немедленно. interval = 0 — сводка после каждого события.
+    """
+
+    def __init__(self, outbound, admin_id, interval=300, max_events=100, top_urls=5):
+        self.outbound = outbound
+        self.admin_id = admin_id
+        self.interval = interval
+        self.max_events = max_events
+        self.top_urls = top_urls
+        self._task = None
+        self._reset()
+
+    def _reset(self):
+        self.started = time.monotonic()
+        self.events = 0
+        self.messages = 0
+        self.users = {}             # user_id → username
+        self.sent = 0
+        self.split = 0
+        self.sent_mb = 0.0
+        self.urls = Counter()
+        self.timings = defaultdict(list)   # стадия → [секунды]
+
+    # События
+
+    def user_message(self, user_id, username, text):
+        self.messages += 1
+        self.users[user_id] = username
+        if text and text.startswith(("http://", "https://")):
+            self.urls[normalize_url(text.strip())] += 1
+        self._added()
+
+    def video_sent(self, user_id, username, size_mb, parts=1):
+        self.sent += 1
+        self.sent_mb += size_mb
+        if parts > 1:
+            self.split += 1
+        self.users[user_id] = username
+        self._added()
+
+    def timing(self, stage, seconds):
+        self.timings[stage].append(seconds)
+
+    def error(self, text):
+        """Ошибки не ждут сводки."""
+        self.outbound.notify(self.admin_id, text)
+
+    # Отправка
+
+    def _added(self):
+        self.events += 1
+        if self.interval == 0 or self.events >= self.max_events:
+            self.flush()
+        else:
+            self._start()
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.events:
+                self.flush()
+
+    def flush(self):
+        """Отправляет накопленную сводку (без ожидания) и начинает новую."""
+        if not self.events:
+            return
+        text = self.render()
+        self._reset()
+        self.outbound.notify(self.admin_id, text)
+
+    def render(self):
+        minutes = max(1, round((time.monotonic() - self.started) / 60))
+        lines = [f"📊 Сводка за {minutes} мин:"]
+        if self.messages:
+            lines.append(f"Сообщений: {self.messages}")
+        lines.append(f"Пользователей: {len(self.users)}")
+        if self.sent:
+            lines.append(
+                f"Отправлено видео: {self.sent} ({self.sent_mb:.1f} MB), "
+                f"из них частями: {self.split}"
+            )
+        if self.urls:
+            lines.append("Чаще всего запрашивали:")
+            for key, count in self.urls.most_common(self.top_urls):
+                lines.append(f"{count} × {key}")
+        if self.timings:
+            lines.append("Стадии (среднее / максимум):")
+            for stage, values in self.timings.items():
+                lines.append(
+                    f"{stage}: {sum(values) / len(values):.1f} с / "
+                    f"{max(values):.1f} с ({len(values)})"
+                )
+        users = [
+            f"@{username}" if username else str(user_id)
+            for user_id, username in list(self.users.items())[:20]
+        ]
+        lines.append("Кто писал: " + ", ".join(users))
+        return "\n".join(lines)[:MAX_MESSAGE_LENGTH]
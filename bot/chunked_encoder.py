@@ -0,0 +1,135 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bot import config
+from bot import media
+
+
+# Опции ffmpeg, относящиеся к звуку: (имя, есть ли значение)
+AUDIO_OPTIONS = {"-c:a": True, "-b:a": True, "-ar": True, "-ac": True, "-an": False}
+
+
+def cpu_count():
+    return os.cpu_count() or 1
+
+
+def current_load():
+    """Средняя загрузка за минуту на одно ядро (0.0, если неизвестно)."""
+    try:
+        return os.getloadavg()[0] / cpu_count()
+    except (AttributeError, OSError):
+        return 0.0
+
+
+def should_use_chunked(info):
+    """
+    Параллельное кодирование окупается только на длинных видео и только
+    когда ядра свободны — иначе чанки просто отнимут CPU у других задач.
+    """
+    if not config.CHUNKED_ENCODING or cpu_count() < 4:
+        return False
+    if info.duration < config.CHUNKED_MIN_DURATION:
+        return False
+    return current_load() < config.CHUNKED_MAX_LOAD
+
+
+def split_av_args(codec_args):
+    """Делит аргументы кодирования на видео- и аудиочасть."""
+    video_args, audio_args = [], []
+    i = 0
+    while i < len(codec_args):
+        arg = codec_args[i]
+        if arg in AUDIO_OPTIONS:
+            width = 2 if AUDIO_OPTIONS[arg] else 1
+            audio_args.extend(codec_args[i:i + width])
+            i += width
+        else:
+            video_args.append(arg)
+            i += 1
+    return video_args, audio_args
+
+
+def _run(cmd):
+    media.run_ffmpeg(cmd)
+
+
+def encode_chunked(video_path, output_path, codec_args, info, workers=None,
+                   on_progress=None):
+    """
+    Кодирует видео параллельно: режет исходник по ключевым кадрам без
+    перекодирования, кодирует куски пулом процессов ffmpeg, звук — отдельно
+    одним проходом, и склеивает всё без потерь (concat + -c copy).
+    on_progress(percent) вызывается по мере готовности кусков.
+    """
+    workers = workers or min(config.CHUNKED_WORKERS or cpu_count(), cpu_count())
+    threads_per_chunk = max(1, cpu_count() // workers)
+    # Кусков вдвое больше, чем процессов, — чтобы медленные куски не тормозили хвост
+    chunk_time = max(config.CHUNKED_MIN_CHUNK, int(info.duration / (workers * 2)) + 1)
+
+    work_dir = os.path.splitext(output_path)[0] + "_chunks"
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        video_args, audio_args = split_av_args(list(codec_args))
+
+        # 1. Режем видеопоток по ключевым кадрам (только копирование)
+        _run([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-i", video_path,
+            "-map", "0:v:0", "-c", "copy",
+            "-f", "segment", "-segment_time", str(chunk_time),
+            "-reset_timestamps", "1",
+            os.path.join(work_dir, "src%04d.mkv"),
+        ])
+        sources = sorted(
+            name for name in os.listdir(work_dir) if name.startswith("src")
+        )
+
+        jobs = []
+        for name in sources:
+            encoded = os.path.join(work_dir, "enc" + name[3:-4] + ".mp4")
+            jobs.append((encoded, [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-i", os.path.join(work_dir, name),
+                *video_args, "-an",
+                "-threads", str(threads_per_chunk),
+                encoded,
+            ]))
+
+        audio_path = None
+        if info.audio_codec and "-an" not in audio_args:
+            audio_path = os.path.join(work_dir, "audio.m4a")
+            jobs.append((audio_path, [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-i", video_path,
+                "-map", "0:a:0", "-vn", *audio_args,
+                audio_path,
+            ]))
+
+        # 2. Кодируем куски параллельно (каждый поток ждёт свой процесс ffmpeg)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_run, cmd) for _, cmd in jobs]
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if on_progress is not None:
+                    on_progress(done * 100 / len(futures))
+
+        # 3. Склеиваем без перекодирования
+        list_path = os.path.join(work_dir, "concat.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            for encoded, _ in jobs:
+                if encoded != audio_path:
+                    f.write(f"file '{os.path.basename(encoded)}'\n")
+
+        concat_command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+        ]
+        if audio_path:
+            concat_command += ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"]
+        concat_command += ["-c", "copy", "-movflags", "faststart", output_path]
+        _run(concat_command)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return len(sources)
@@ -13,4 +13,134 @@ DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "downloads")
 CONVERTED_DIR = os.getenv("CONVERTED_DIR", "converted")
 
 # Канал
-CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME", "@example_channel")
\ No newline at end of file
+CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME", "@example_channel")
+
+# Планировщик задач: сколько задач одновременно на каждой стадии
+MAX_PARALLEL_DOWNLOADS = int(os.getenv("MAX_PARALLEL_DOWNLOADS", "4"))
+# libx264 сам использует все ядра, поэтому по умолчанию немного процессов
+MAX_PARALLEL_TRANSCODES = int(
+    os.getenv("MAX_PARALLEL_TRANSCODES", str(max(1, (os.cpu_count() or 2) // 4)))
+)
+MAX_PARALLEL_UPLOADS = int(os.getenv("MAX_PARALLEL_UPLOADS", "3"))
+# Сколько задач может быть в работе у одного пользователя
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "2"))
+# Общий лимит задач (в работе + в очереди), сверх него запросы отклоняются
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "50"))
+
+# SQLite-база бота (кэш результатов и прочее состояние)
+DB_PATH = os.getenv("DB_PATH", "margarine7.sqlite3")
+
+# Кэш готовых видео (file_id Telegram) по ссылке
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "5000"))
+
+# Кодирование под лимит Telegram (50 МБ) вместо деления на части
+FIT_TO_LIMIT = os.getenv("FIT_TO_LIMIT", "1") == "1"
+# Двухпроходное кодирование: точнее попадает в размер, но вдвое дольше
+FIT_TWO_PASS = os.getenv("FIT_TWO_PASS", "0") == "1"
+# Ниже этого битрейта видео (кбит/с) уже лучше делить на части
+FIT_MIN_VIDEO_KBPS = int(os.getenv("FIT_MIN_VIDEO_KBPS", "300"))
+# Длинные видео кодировать сразу частями и отправлять части по готовности
+SEGMENT_STREAMING = os.getenv("SEGMENT_STREAMING", "1") == "1"
+
+# Параллельное кодирование длинных видео кусками на нескольких ядрах
+CHUNKED_ENCODING = os.getenv("CHUNKED_ENCODING", "1") == "1"
+# С какой длительности (сек) видео кодируется кусками
+CHUNKED_MIN_DURATION = int(os.getenv("CHUNKED_MIN_DURATION", "300"))
+# Не включать, если загрузка на ядро (loadavg / cpu) уже выше порога
+CHUNKED_MAX_LOAD = float(os.getenv("CHUNKED_MAX_LOAD", "0.5"))
+# Сколько процессов ffmpeg одновременно (0 — по числу ядер)
+CHUNKED_WORKERS = int(os.getenv("CHUNKED_WORKERS", "0"))
+# Минимальная длина куска (сек)
+CHUNKED_MIN_CHUNK = int(os.getenv("CHUNKED_MIN_CHUNK", "30"))
+
+# Видео длиннее (сек) отклоняются ещё до скачивания (0 — без ограничения)
+MAX_VIDEO_DURATION = int(os.getenv("MAX_VIDEO_DURATION", str(3 * 3600)))
+
+# Одиночные HTTP-форматы качать прямо в ffmpeg, не сохраняя исходник на диск
+STREAM_TRANSCODE = os.getenv("STREAM_TRANSCODE", "1") == "1"
+
+# Правки статусных сообщений: не чаще раза в N секунд на чат (в группах реже)
+PROGRESS_PRIVATE_INTERVAL = float(os.getenv("PROGRESS_PRIVATE_INTERVAL", "2"))
+PROGRESS_GROUP_INTERVAL = float(os.getenv("PROGRESS_GROUP_INTERVAL", "3"))
+# Общий бюджет правок статусов в секунду на весь бот
+PROGRESS_EDITS_PER_SECOND = float(os.getenv("PROGRESS_EDITS_PER_SECOND", "10"))
+
+# Исходящие запросы к Bot API: лимит бота в секунду, на личный чат в секунду,
+# на группу в минуту; сколько раз повторять запрос после 429
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", "20"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+
+# Сводка для администратора: раз в N секунд (0 — после каждого события)
+# или сразу, когда накопилось ADMIN_DIGEST_MAX_EVENTS событий
+ADMIN_DIGEST_INTERVAL = int(os.getenv("ADMIN_DIGEST_INTERVAL", "300"))
+ADMIN_DIGEST_MAX_EVENTS = int(os.getenv("ADMIN_DIGEST_MAX_EVENTS", "100"))
+
+# Кэш проверки подписки: сколько секунд помнить подписку и её отсутствие
+SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", "3600"))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "60"))
+SUBSCRIPTION_CACHE_MAX_ENTRIES = int(os.getenv("SUBSCRIPTION_CACHE_MAX_ENTRIES", "10000"))
+
+# Видеоинструкция для /start (загружается один раз, дальше — по file_id)
+INTRO_VIDEO_PATH = os.getenv("INTRO_VIDEO_PATH", "margarine_intro.mp4")
+
+# Профиль скачивания "tor" (диагностика /youtube_blocked_test, /instagram_test)
+TOR_PROXY = os.getenv("TOR_PROXY", "socks5://127.0.0.1:9050")
+COOKIES_FILE = os.getenv("COOKIES_FILE", "web_auth_storage.txt")
+
+# Остановка (SIGTERM): сколько секунд дать текущим задачам завершиться,
+# прежде чем прервать их и продолжить после перезапуска
+DRAIN_TIMEOUT = int(os.getenv("DRAIN_TIMEOUT", "60"))
+# Сколько раз поднимать незавершённую задачу после перезапуска
+JOB_MAX_RESUMES = int(os.getenv("JOB_MAX_RESUMES", "3"))
+# Сколько секунд хранить завершённые задачи в базе
+JOB_HISTORY_TTL = int(os.getenv("JOB_HISTORY_TTL", str(7 * 24 * 3600)))
+
+# Webhook вместо long polling: публичный адрес бота (https://host), пусто — polling.
+# Сервер слушает WEBHOOK_HOST:WEBHOOK_PORT (за nginx/прокси с TLS), путь WEBHOOK_PATH.
+# WEBHOOK_SECRET — secret_token для проверки запросов (пусто — случайный при запуске)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Отдельные процессы-воркеры (worker.py): бот только ставит задачи в очередь
+# (таблица jobs в DB_PATH), скачивают, кодируют и отправляют видео воркеры.
+# Воркеров можно запускать и останавливать, не перезапуская бота
+EXTERNAL_WORKERS = os.getenv("EXTERNAL_WORKERS", "0") == "1"
+# Сколько задач воркер выполняет одновременно
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+# Как часто воркер проверяет очередь, а бот — статус задачи (секунды)
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
+# Как часто воркер записывает статус задачи
+WORKER_STATUS_INTERVAL = float(os.getenv("WORKER_STATUS_INTERVAL", "1"))
+# Через сколько секунд без heartbeat задачу упавшего воркера забирает другой
+WORKER_STALE_TIMEOUT = int(os.getenv("WORKER_STALE_TIMEOUT", "120"))
+# Имя воркера в логах и в очереди (по умолчанию host:pid)
+WORKER_ID = os.getenv("WORKER_ID", "")
+# Сколько воркеров запущено: лимиты Bot API (OUTBOUND_*) общие на токен бота,
+# поэтому бот и каждый воркер получают 1/(WORKER_PROCESSES + 1) от них
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено).
+# У воркера свой порт WORKER_METRICS_PORT
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+# Фоновая очистка DOWNLOAD_DIR раз в JANITOR_INTERVAL секунд (0 — выключено):
+# удаляются папки задач, которых нет среди незавершённых, и временные файлы
+# (.part, *_fixed.mp4, *_partNN), не менявшиеся дольше JANITOR_MAX_AGE секунд
+JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "600"))
+JANITOR_MAX_AGE = int(os.getenv("JANITOR_MAX_AGE", str(6 * 3600)))
+
+# Контроль места на диске: задача не начинает скачивание, если после неё
+# свободного места останется меньше DISK_MIN_FREE_MB (0 — не проверять),
+# а ждёт до DISK_WAIT_TIMEOUT секунд, пока место освободится
+DISK_MIN_FREE_MB = int(os.getenv("DISK_MIN_FREE_MB", "1024"))
+DISK_WAIT_TIMEOUT = int(os.getenv("DISK_WAIT_TIMEOUT", "1800"))
+# Битрейт для оценки размера, если метаданные его не дают
+DISK_ESTIMATE_KBPS = int(os.getenv("DISK_ESTIMATE_KBPS", "4000"))
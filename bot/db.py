@@ -0,0 +1,18 @@
+import sqlite3
+
+from bot import config
+
+
+def connect(db_path=None):
+    """
+    Открывает соединение с SQLite-базой бота.
+
+    Соединение нужно открывать в том потоке, где оно используется
+    (функции хранилищ вызываются через asyncio.to_thread).
+    """
+    conn = sqlite3.connect(db_path or config.DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # WAL: читатели не блокируют писателя
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import shutil
+import time
+
+
+class DiskFull(Exception):
+    """Места на диске не хватает и не освободилось за отведённое время."""
+
+
+def estimate_source_size(info, choice=None, fallback_kbps=4000):
+    """
+    Размер скачиваемого файла по метаданным: прогноз format_selector,
+    filesize / filesize_approx выбранных форматов или битрейт × длительность.
+    """
+    if choice is not None and choice.estimated_size:
+        return int(choice.estimated_size)
+    formats = info.get("requested_formats") or [info]
+    size = sum(fmt.get("filesize") or fmt.get("filesize_approx") or 0 for fmt in formats)
+    if size:
+        return int(size)
+    duration = info.get("duration") or 0
+    return int(duration * fallback_kbps * 1000 / 8)
+
+
+def estimate_footprint(source_size, limit_bytes):
+    """
+    Сколько места задача займёт на пике: исходник + перекодированный
+    файл (не больше исходника) + части, если файл больше лимита Telegram.
+    """
+    segments = source_size if source_size > limit_bytes else 0
+    return source_size * 2 + segments
+
+
+def _dir_size(path):
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    return total
+
+
+class DiskBudget:
+    """
+    Контроль места в DOWNLOAD_DIR перед стартом задачи.
+
+    Задача резервирует оценку своего объёма (acquire) и держит резерв до
+    конца (release). Новая задача стартует, только если после неё и
+    после ещё не записанной части чужих резервов свободного места
+    останется не меньше min_free байт; иначе ждёт, пока место освободится
+    (другие задачи закончатся, отработает очистка), не дольше max_wait.
+
+    Резервы видны только внутри процесса: воркеры на той же машине
+    учитывают друг друга лишь через реально занятое место. Папки задач
+    с резервом (job_ids) фоновая очистка не трогает — в том числе папки
+    диагностики, которых нет в JobStore.
+    """
+
+    def __init__(self, path, min_free, max_wait=1800, poll_interval=5):
+        self.path = path
+        self.min_free = min_free
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._reserved = {}     # job_id → (байт, папка задачи)
+        self._lock = asyncio.Lock()
+
+    def job_ids(self):
+        return set(self._reserved)
+
+    def _outstanding(self, reserved):
+        # Уже записанное задачей учтено в свободном месте — вычитаем его из резерва
+        return sum(max(0, size - _dir_size(path)) for size, path in reserved)
+
+    def _headroom(self, reserved):
+        """Сколько байт можно отдать новой задаче, не опускаясь ниже min_free."""
+        free = shutil.disk_usage(self.path).free
+        return free - self._outstanding(reserved) - self.min_free
+
+    def capacity(self):
+        return shutil.disk_usage(self.path).total - self.min_free
+
+    async def acquire(self, job_id, workspace_path, size, on_wait=None):
+        """
+        Резервирует size байт под задачу. Пока места нет — ждёт, вызывая
+        async-колбэк on_wait(size, headroom). DiskFull — если задача не
+        поместится никогда или место не освободилось за max_wait секунд.
+        """
+        if not self.min_free:
+            # Проверка выключена, но резерв всё равно помечает папку как занятую
+            self._reserved[job_id] = (size, workspace_path)
+            return
+        if size > await asyncio.to_thread(self.capacity):
+            raise DiskFull(
+                f"Видео слишком большое для диска сервера (~{size / 1024 / 1024:.0f} MB)."
+            )
+        deadline = time.monotonic() + self.max_wait
+        notified = False
+        while True:
+            async with self._lock:
+                reserved = list(self._reserved.values())
+                headroom = await asyncio.to_thread(self._headroom, reserved)
+                if headroom >= size:
+                    self._reserved[job_id] = (size, workspace_path)
+                    return
+            if time.monotonic() >= deadline:
+                raise DiskFull("На сервере закончилось место. Попробуйте позже.")
+            if on_wait is not None and not notified:
+                notified = True
+                await on_wait(size, headroom)
+            await asyncio.sleep(self.poll_interval)
+
+    def release(self, job_id):
+        self._reserved.pop(job_id, None)
+
+    def snapshot(self):
+        """(свободно байт, зарезервировано байт, число резервов) для /show_downloads."""
+        reserved = list(self._reserved.values())
+        free = shutil.disk_usage(self.path).free
+        return free, sum(size for size, _ in reserved), len(reserved)
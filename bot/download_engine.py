@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadCancelled
+from yt_dlp.networking import Request
+
+from bot import metrics
+
+
+class StreamRejected(Exception):
+    """Начало потока показало, что ffmpeg не сможет читать его из pipe."""
+
+
+class DownloadEngine:
+    """
+    Скачивание через yt-dlp внутри процесса бота вместо запуска CLI на
+    каждую задачу.
+
+    В каждом рабочем потоке живёт «тёплый» YoutubeDL (по одному на профиль
+    прокси/cookies): экстракторы уже импортированы, HTTP-соединения
+    переиспользуются между задачами. Прогресс приходит из progress_hooks
+    в виде словарей yt-dlp, а не парсится из stdout.
+    """
+
+    def __init__(self, base_opts, workers=4, profiles=None):
+        self.base_opts = dict(base_opts)
+        self.profiles = profiles or {"default": {}}
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="ytdl"
+        )
+        self._local = threading.local()
+        self._stopping = threading.Event()
+
+    def _ydl(self, profile):
+        instances = getattr(self._local, "instances", None)
+        if instances is None:
+            instances = self._local.instances = {}
+        ydl = instances.get(profile)
+        if ydl is None:
+            if profile not in self.profiles:
+                raise ValueError(f"Неизвестный профиль загрузки: {profile}")
+            opts = {
+                **self.base_opts,
+                **self.profiles[profile],
+                # Путь задаётся через paths.home на каждую задачу
+                "outtmpl": "%(title)s.%(ext)s",
+                "progress_hooks": [self._dispatch_progress],
+            }
+            ydl = instances[profile] = YoutubeDL(opts)
+        return ydl
+
+    def _dispatch_progress(self, status):
+        # Прерываем скачивание при остановке бота: .part остаётся на диске,
+        # и после перезапуска yt-dlp докачает его
+        if self._stopping.is_set():
+            raise DownloadCancelled("Бот останавливается")
+        callback = getattr(self._local, "on_progress", None)
+        if callback is not None:
+            try:
+                callback(status)
+            except Exception as e:
+                print(f"[ENGINE] Ошибка в обработчике прогресса: {e}", flush=True)
+
+    def _extract_info(self, url, profile):
+        return self._ydl(profile).extract_info(url, download=False)
+
+    def _download(self, url, download_dir, format_str, info, profile, on_progress):
+        ydl = self._ydl(profile)
+        ydl.params["paths"] = {"home": download_dir, "temp": download_dir}
+        fmt = format_str or self.base_opts.get("format")
+        if fmt and ydl.params.get("format") != fmt:
+            ydl.params["format"] = fmt
+            ydl.format_selector = ydl.build_format_selector(fmt)
+
+        self._local.on_progress = on_progress
+        # yt-dlp работает в этом потоке — его CPU считаем по времени потока
+        cpu_started = time.thread_time()
+        try:
+            if info is not None:
+                # Метаданные уже получены на стадии выбора формата — не извлекаем заново
+                result = ydl.process_ie_result(info, download=True)
+            else:
+                result = ydl.extract_info(url, download=True)
+        finally:
+            self._local.on_progress = None
+            metrics.registry.observe(
+                "tool_cpu_seconds", time.thread_time() - cpu_started, tool="yt-dlp"
+            )
+
+        downloads = result.get("requested_downloads") or [result]
+        filepath = downloads[0].get("filepath") or downloads[0].get("_filename")
+        if not filepath or not os.path.isfile(filepath):
+            raise RuntimeError("Не удалось найти загруженное видео после скачивания")
+        return os.path.abspath(filepath)
+
+    def _stream_to_process(self, fmt, command, profile, on_progress, chunk_size, accept_head):
+        ydl = self._ydl(profile)
+        total = fmt.get("filesize") or fmt.get("filesize_approx")
+        response = ydl.urlopen(Request(fmt["url"], headers=fmt.get("http_headers") or {}))
+        try:
+            # Первый блок смотрим до запуска ffmpeg: неподходящий поток
+            # отклоняем, прочитав только его
+            head = response.read(chunk_size)
+            if accept_head is not None and not accept_head(head):
+                raise StreamRejected("поток нельзя обрабатывать из pipe")
+            process = subprocess.Popen(command, stdin=subprocess.PIPE)
+            downloaded = 0
+            try:
+                chunk = head
+                while chunk:
+                    if self._stopping.is_set():
+                        raise DownloadCancelled("Бот останавливается")
+                    process.stdin.write(chunk)
+                    downloaded += len(chunk)
+                    if on_progress is not None:
+                        on_progress({
+                            "status": "downloading",
+                            "downloaded_bytes": downloaded,
+                            "total_bytes": total,
+                        })
+                    chunk = response.read(chunk_size)
+                process.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg завершился раньше — его код возврата скажет, что случилось
+                pass
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+        finally:
+            response.close()
+        returncode = metrics.wait_process(process, "ffmpeg")
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+        return downloaded
+
+    async def stream_to_process(self, fmt, command, profile="default",
+                                on_progress=None, chunk_size=1024 * 1024, accept_head=None):
+        """
+        Скачивает формат напрямую в stdin процесса (ffmpeg читает pipe:0),
+        не сохраняя исходный файл на диск. Сеть и кодирование идут
+        одновременно. Возвращает число переданных байт.
+
+        accept_head(bytes) проверяет первый блок ответа до запуска процесса;
+        False — StreamRejected, и вызывающий идёт обычным путём через файл.
+        """
+        return await self._run(
+            self._stream_to_process, fmt, command, profile, on_progress, chunk_size, accept_head
+        )
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args)
+        )
+
+    async def extract_info(self, url, profile="default"):
+        """Метаданные без скачивания (extract_info(download=False))."""
+        return await self._run(self._extract_info, url, profile)
+
+    async def download(self, url, download_dir, format_str=None, info=None,
+                       profile="default", on_progress=None):
+        """
+        Скачивает видео в download_dir и возвращает путь к итоговому файлу
+        (после слияния дорожек). on_progress(status) вызывается из рабочего
+        потока со словарём progress_hooks yt-dlp.
+        """
+        return await self._run(
+            self._download, url, download_dir, format_str, info, profile, on_progress
+        )
+
+    def shutdown(self):
+        """Прерывает текущие загрузки и останавливает рабочие потоки."""
+        self._stopping.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,25 +1,137 @@
 import os
+import re
+import shutil
+import time
+from dataclasses import dataclass
 
+from bot.workspace import JOB_DIR_PREFIX
 
-def list_downloads(download_dir):
+
+# Временные файлы пайплайна: недокачанное yt-dlp (.part, .ytdl, фрагменты),
+# промежуточный *_fixed.mp4, части *_partNN и пережатые части *_partNN_fit.mp4
+LEFTOVER_RE = re.compile(r"(\.part|\.part-Frag\d+|\.ytdl|_fixed\.mp4|_part\d{2,}(_fit)?\.\w+)$")
+
+
+@dataclass
+class DownloadEntry:
+    """Элемент верхнего уровня папки загрузок: папка задачи или отдельный файл."""
+    name: str
+    path: str
+    is_dir: bool
+    size: int = 0
+    files: int = 0
+    # Время последнего изменения самого свежего файла внутри
+    mtime: float = 0.0
+    # ID задачи для папок job_<id>
+    job_id: str = None
+
+    def age(self, now=None):
+        return max(0.0, (now or time.time()) - self.mtime)
+
+
+def _scan_tree(entry):
+    """Размер, число файлов и самый свежий mtime папки (os.scandir, без os.walk)."""
+    size, files = 0, 0
+    newest = entry.stat(follow_symlinks=False).st_mtime
+    stack = [entry.path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                children = list(it)
+        except OSError:
+            # Папку могли удалить во время обхода
+            continue
+        for child in children:
+            try:
+                stat = child.stat(follow_symlinks=False)
+                if child.is_dir(follow_symlinks=False):
+                    stack.append(child.path)
+                else:
+                    size += stat.st_size
+                    files += 1
+                newest = max(newest, stat.st_mtime)
+            except OSError:
+                continue
+    return size, files, newest
+
+
+def scan_downloads(download_dir):
     """
-    Возвращает список файлов в указанной папке.
+    Генератор DownloadEntry по верхнему уровню download_dir. Папки читаются
+    по одной через os.scandir, поэтому вызывающий может остановиться в любой
+    момент, не дожидаясь обхода всего дерева.
     """
     try:
-        files = os.listdir(download_dir)
-        return files
-    except Exception as e:
-        raise RuntimeError(f"Ошибка при получении содержимого папки: {e}")
+        it = os.scandir(download_dir)
+    except FileNotFoundError:
+        return
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    size, files, mtime = _scan_tree(entry)
+                    job_id = (
+                        entry.name[len(JOB_DIR_PREFIX):]
+                        if entry.name.startswith(JOB_DIR_PREFIX) else None
+                    )
+                    yield DownloadEntry(entry.name, entry.path, True, size, files, mtime, job_id)
+                else:
+                    stat = entry.stat(follow_symlinks=False)
+                    yield DownloadEntry(
+                        entry.name, entry.path, False, stat.st_size, 1, stat.st_mtime
+                    )
+            except OSError:
+                continue
+
+
+def sweep_orphans(download_dir, max_age, keep_job_ids=()):
+    """
+    Удаляет то, что осталось от упавших и брошенных задач и не менялось
+    дольше max_age секунд: папки job_<id> задач не из keep_job_ids и
+    временные файлы (LEFTOVER_RE) в корне папки. Прочие файлы и папки
+    не трогает. Возвращает (список удалённых DownloadEntry, освобождено байт).
+    """
+    now = time.time()
+    removed = []
+    for entry in scan_downloads(download_dir):
+        if entry.age(now) < max_age:
+            continue
+        if entry.is_dir:
+            if entry.job_id is None or entry.job_id in keep_job_ids:
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+        elif LEFTOVER_RE.search(entry.name):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+        else:
+            continue
+        removed.append(entry)
+    return removed, sum(entry.size for entry in removed)
 
 
-def clean_downloads(download_dir):
+def clean_downloads(download_dir, keep_job_ids=()):
     """
-    Очищает указанную папку.
+    Очищает указанную папку. Папки задач из keep_job_ids (выполняются
+    или будут продолжены после перезапуска) не трогает. Возвращает число
+    оставленных папок.
     """
+    kept = 0
     try:
         for filename in os.listdir(download_dir):
             file_path = os.path.join(download_dir, filename)
             if os.path.isfile(file_path):
                 os.remove(file_path)
+            elif os.path.isdir(file_path):
+                if (
+                    filename.startswith(JOB_DIR_PREFIX)
+                    and filename[len(JOB_DIR_PREFIX):] in keep_job_ids
+                ):
+                    kept += 1
+                    continue
+                # Остальные папки задач (job_*) удаляем целиком
+                shutil.rmtree(file_path, ignore_errors=True)
     except Exception as e:
         raise RuntimeError(f"Ошибка при очистке папки: {e}")
+    return kept
@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class FormatChoice:
+    """Выбранный формат и прогноз размера итогового файла."""
+
+    format_id: str
+    estimated_size: int
+    height: int
+    fits: bool
+    single_file: bool
+    compatible: bool
+
+
+def estimate_size(fmt, duration):
+    """Размер формата в байтах: filesize, filesize_approx или tbr × длительность."""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    tbr = fmt.get("tbr")
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+
+def _is_h264(fmt):
+    return (fmt.get("vcodec") or "").startswith(("avc1", "h264"))
+
+
+def _is_aac(fmt):
+    return (fmt.get("acodec") or "").startswith(("mp4a", "aac"))
+
+
+def _has_video(fmt):
+    return fmt.get("vcodec") not in (None, "none")
+
+
+def _has_audio(fmt):
+    return fmt.get("acodec") not in (None, "none")
+
+
+def _pick_audio(formats, duration):
+    """Звуковая дорожка: AAC (чтобы обойтись без перекодирования) не жирнее 160 кбит/с."""
+    audio = [
+        f for f in formats
+        if _has_audio(f) and not _has_video(f) and estimate_size(f, duration)
+    ]
+    if not audio:
+        return None
+
+    def key(f):
+        abr = f.get("abr") or f.get("tbr") or 0
+        return (_is_aac(f), abr <= 160, abr if abr <= 160 else -abr)
+
+    return max(audio, key=key)
+
+
+def choose_format(info, limit_mb=50, max_height=720, reserve=0.95):
+    """
+    Выбирает формат по метаданным yt-dlp (extract_info(download=False)) так,
+    чтобы итоговый файл по прогнозу влез в limit_mb: из помещающихся берётся
+    самый высокий, при равной высоте — H.264/AAC (не придётся перекодировать).
+    Если не помещается ничего — самый лёгкий вариант не ниже 360p.
+
+    Возвращает FormatChoice или None, если по метаданным выбрать нельзя.
+    """
+    formats = info.get("formats") or []
+    duration = info.get("duration") or 0
+    limit = limit_mb * 1024 * 1024 * reserve
+
+    audio = _pick_audio(formats, duration)
+    audio_size = estimate_size(audio, duration) if audio else 0
+
+    candidates = []
+    for fmt in formats:
+        if not _has_video(fmt) or not fmt.get("format_id"):
+            continue
+        height = fmt.get("height") or 0
+        if not height or height > max_height:
+            continue
+        size = estimate_size(fmt, duration)
+        if size is None:
+            continue
+
+        if _has_audio(fmt):
+            candidates.append(FormatChoice(
+                format_id=fmt["format_id"],
+                estimated_size=size,
+                height=height,
+                fits=size <= limit,
+                single_file=True,
+                compatible=_is_h264(fmt) and _is_aac(fmt),
+            ))
+        elif audio is not None:
+            total = size + audio_size
+            candidates.append(FormatChoice(
+                format_id=f"{fmt['format_id']}+{audio['format_id']}",
+                estimated_size=total,
+                height=height,
+                fits=total <= limit,
+                single_file=False,
+                compatible=_is_h264(fmt) and _is_aac(audio),
+            ))
+
+    if not candidates:
+        return None
+
+    fitting = [c for c in candidates if c.fits]
+    if fitting:
+        return max(
+            fitting,
+            key=lambda c: (c.height, c.compatible, c.single_file, c.estimated_size),
+        )
+
+    watchable = [c for c in candidates if c.height >= 360] or candidates
+    return min(watchable, key=lambda c: (c.estimated_size, not c.compatible))
@@ -0,0 +1,98 @@
+import asyncio
+import functools
+from dataclasses import dataclass
+
+
+@dataclass
+class SharedResult:
+    """Результат задачи, который можно разослать всем ожидающим по file_id."""
+
+    file_ids: list
+    width: int = 0
+    height: int = 0
+    duration: int = 0
+
+
+class Flight:
+    """
+    Одна выполняющаяся задача для конкретного видео.
+
+    Первый запрос (ведущий) запускает пайплайн; остальные подписываются своими
+    статусными сообщениями, видят те же обновления и получают тот же результат.
+    """
+
+    def __init__(self, key, hub):
+        self.key = key
+        self.hub = hub
+        hub.start()
+        self.subscribers = []   # (chat_id, message_id)
+        self.status_text = None
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+
+    def subscribe(self, chat_id, message_id):
+        self.subscribers.append((chat_id, message_id))
+
+    def update(self, text, **kwargs):
+        """
+        Новый статус для всех подписчиков. Правки уходят через ProgressHub
+        с учётом лимитов Telegram. Из рабочих потоков (прогресс yt-dlp и
+        ffmpeg) обновление передаётся в цикл событий, чтобы status_text и
+        subscribers менялись только там.
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not self._loop:
+            self._loop.call_soon_threadsafe(functools.partial(self._update, text, **kwargs))
+            return
+        self._update(text, **kwargs)
+
+    def _update(self, text, **kwargs):
+        if text == self.status_text:
+            return
+        self.status_text = text
+        for chat_id, message_id in list(self.subscribers):
+            self.hub.set(chat_id, message_id, text, **kwargs)
+
+    def resolve(self, result):
+        if not self._future.done():
+            self._future.set_result(result)
+
+    def fail(self, exc):
+        if not self._future.done():
+            self._future.set_exception(exc)
+            # Исключение может никто не забрать — не ругаемся в лог
+            self._future.exception()
+
+    async def wait(self):
+        """SharedResult ведущего, None (результат нельзя переиспользовать) или его ошибка."""
+        return await asyncio.shield(self._future)
+
+
+class InFlightRegistry:
+    """
+    Singleflight по ключу видео: одновременные запросы одной ссылки
+    выполняются одним пайплайном.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self._flights = {}
+
+    def join(self, key):
+        """Возвращает (flight, is_leader)."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = Flight(key, self.hub)
+        self._flights[key] = flight
+        return flight, True
+
+    def finish(self, flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def __len__(self):
+        return len(self._flights)
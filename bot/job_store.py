@@ -0,0 +1,335 @@
+import json
+import time
+import uuid
+from contextlib import closing
+from dataclasses import dataclass, field
+
+from bot import db
+
+
+STAGE_QUEUED = "queued"
+STAGE_DOWNLOADING = "downloading"
+STAGE_ENCODING = "encoding"
+STAGE_UPLOADING = "uploading"
+STAGE_DONE = "done"
+STAGE_FAILED = "failed"
+
+# Чем дальше продвинулась задача, тем раньше её поднимаем после перезапуска
+# (чтобы ведущей в singleflight стала она, а не подписчик с той же ссылкой)
+STAGE_ORDER = {
+    STAGE_UPLOADING: 0,
+    STAGE_ENCODING: 1,
+    STAGE_DOWNLOADING: 2,
+    STAGE_QUEUED: 3,
+}
+
+
+@dataclass
+class JobRecord:
+    job_id: str
+    chat_id: int
+    user_id: int
+    username: str
+    message_id: int
+    status_message_id: int
+    url: str
+    stage: str
+    source_path: str = None
+    output_path: str = None
+    # Уже отправленные части: [file_id, конец части в секундах или None]
+    parts: list = field(default_factory=list)
+    attempts: int = 0
+    error: str = None
+    created_at: float = 0.0
+    updated_at: float = 0.0
+    # Режим отдельных воркеров: задача в общей очереди и кто её взял
+    remote: bool = False
+    worker: str = None
+    heartbeat: float = 0.0
+    # Последний статус от воркера и результат (SharedResult в виде dict)
+    status_text: str = None
+    status_parse_mode: str = None
+    result: dict = None
+
+
+class JobStore:
+    """
+    Постоянное состояние задач в SQLite (WAL): стадия, скачанный исходник,
+    готовый файл и отправленные части. После перезапуска бота незавершённые
+    задачи поднимаются с той стадии, на которой остановились.
+
+    Эта же таблица — общая очередь для отдельных процессов-воркеров:
+    фронтенд ставит задачу (dispatch), воркер забирает её (claim), пишет
+    статус (set_status) и результат (finish), фронтенд читает их (get).
+    Другой брокер можно подключить, реализовав эти методы.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._schema_ready = False
+
+    def _connect(self):
+        conn = db.connect(self.db_path)
+        if not self._schema_ready:
+            with conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        job_id TEXT PRIMARY KEY,
+                        chat_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        username TEXT,
+                        message_id INTEGER,
+                        status_message_id INTEGER,
+                        url TEXT NOT NULL,
+                        stage TEXT NOT NULL,
+                        source_path TEXT,
+                        output_path TEXT,
+                        parts TEXT NOT NULL DEFAULT '[]',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        error TEXT,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL,
+                        remote INTEGER NOT NULL DEFAULT 0,
+                        worker TEXT,
+                        heartbeat REAL NOT NULL DEFAULT 0,
+                        status_text TEXT,
+                        status_parse_mode TEXT,
+                        result TEXT
+                    )
+                    """
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage)"
+                )
+            self._schema_ready = True
+        return conn
+
+    @staticmethod
+    def _row_to_record(row):
+        return JobRecord(
+            job_id=row["job_id"],
+            chat_id=row["chat_id"],
+            user_id=row["user_id"],
+            username=row["username"],
+            message_id=row["message_id"],
+            status_message_id=row["status_message_id"],
+            url=row["url"],
+            stage=row["stage"],
+            source_path=row["source_path"],
+            output_path=row["output_path"],
+            parts=json.loads(row["parts"]),
+            attempts=row["attempts"],
+            error=row["error"],
+            created_at=row["created_at"],
+            updated_at=row["updated_at"],
+            remote=bool(row["remote"]),
+            worker=row["worker"],
+            heartbeat=row["heartbeat"],
+            status_text=row["status_text"],
+            status_parse_mode=row["status_parse_mode"],
+            result=json.loads(row["result"]) if row["result"] else None,
+        )
+
+    def create(self, chat_id, user_id, username, message_id, status_message_id, url):
+        now = time.time()
+        record = JobRecord(
+            job_id=uuid.uuid4().hex[:12],
+            chat_id=chat_id,
+            user_id=user_id,
+            username=username,
+            message_id=message_id,
+            status_message_id=status_message_id,
+            url=url,
+            stage=STAGE_QUEUED,
+            created_at=now,
+            updated_at=now,
+        )
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                INSERT INTO jobs (
+                    job_id, chat_id, user_id, username, message_id,
+                    status_message_id, url, stage, created_at, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    record.job_id, chat_id, user_id, username, message_id,
+                    status_message_id, url, record.stage, now, now,
+                ),
+            )
+        return record
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return self._row_to_record(row) if row else None
+
+    def get_many(self, job_ids):
+        """Записи задач одним запросом: {job_id: JobRecord}, отсутствующих в ответе нет."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return {}
+        placeholders = ", ".join("?" * len(job_ids))
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE job_id IN ({placeholders})", job_ids
+            ).fetchall()
+        return {row["job_id"]: self._row_to_record(row) for row in rows}
+
+    def set_stage(self, record, stage, **paths):
+        """Новая стадия; paths — source_path / output_path, если они известны."""
+        record.stage = stage
+        for name in ("source_path", "output_path"):
+            if name in paths:
+                setattr(record, name, paths[name])
+        record.updated_at = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                UPDATE jobs SET stage = ?, source_path = ?, output_path = ?, updated_at = ?
+                WHERE job_id = ?
+                """,
+                (stage, record.source_path, record.output_path, record.updated_at, record.job_id),
+            )
+
+    def add_part(self, record, file_id, end=None):
+        """Запоминает отправленную часть, чтобы после перезапуска не слать её снова."""
+        record.parts.append([file_id, end])
+        record.updated_at = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET parts = ?, updated_at = ? WHERE job_id = ?",
+                (json.dumps(record.parts), record.updated_at, record.job_id),
+            )
+
+    def finish(self, record, error=None, result=None):
+        """Задача завершена: с ошибкой или с результатом (dict для подписчиков)."""
+        record.stage = STAGE_FAILED if error else STAGE_DONE
+        record.error = error
+        record.result = result
+        record.updated_at = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                UPDATE jobs SET stage = ?, error = ?, result = ?, updated_at = ?
+                WHERE job_id = ?
+                """,
+                (
+                    record.stage, error, json.dumps(result) if result else None,
+                    record.updated_at, record.job_id,
+                ),
+            )
+
+    def mark_resumed(self, record):
+        record.attempts += 1
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET attempts = ? WHERE job_id = ?",
+                (record.attempts, record.job_id),
+            )
+        return record.attempts
+
+    # Очередь для воркеров
+
+    def dispatch(self, record):
+        """Отдаёт задачу воркерам. Уже взятая воркером задача остаётся у него."""
+        record.remote = True
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE jobs SET remote = 1 WHERE job_id = ?", (record.job_id,))
+
+    def claim(self, worker_id, stale_after):
+        """
+        Забирает самую старую свободную задачу (или задачу воркера, который
+        не подавал признаков жизни stale_after секунд). None — очередь пуста.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            # IMMEDIATE: блокировка на запись сразу, два воркера не возьмут одну задачу
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    """
+                    SELECT * FROM jobs
+                    WHERE remote = 1 AND stage NOT IN (?, ?)
+                      AND (worker IS NULL OR heartbeat < ?)
+                    ORDER BY created_at LIMIT 1
+                    """,
+                    (STAGE_DONE, STAGE_FAILED, now - stale_after),
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET worker = ?, heartbeat = ? WHERE job_id = ?",
+                        (worker_id, now, row["job_id"]),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        record = self._row_to_record(row)
+        record.worker, record.heartbeat = worker_id, now
+        return record
+
+    def release(self, worker_id):
+        """Воркер останавливается: его незавершённые задачи сразу достанутся другим."""
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET worker = NULL WHERE worker = ? AND stage NOT IN (?, ?)",
+                (worker_id, STAGE_DONE, STAGE_FAILED),
+            )
+            return cursor.rowcount
+
+    def set_status(self, record, text, parse_mode=None):
+        """Статус задачи от воркера (фронтенд покажет его пользователю); заодно heartbeat."""
+        record.status_text, record.status_parse_mode = text, parse_mode
+        record.heartbeat = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                UPDATE jobs SET status_text = ?, status_parse_mode = ?, heartbeat = ?
+                WHERE job_id = ?
+                """,
+                (text, parse_mode, record.heartbeat, record.job_id),
+            )
+
+    def touch(self, record):
+        """Heartbeat воркера без смены статуса."""
+        record.heartbeat = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE job_id = ?",
+                (record.heartbeat, record.job_id),
+            )
+
+    def unfinished(self):
+        """Незавершённые задачи: сначала продвинувшиеся дальше, затем по времени."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE stage NOT IN (?, ?) ORDER BY created_at",
+                (STAGE_DONE, STAGE_FAILED),
+            ).fetchall()
+        records = [self._row_to_record(row) for row in rows]
+        records.sort(key=lambda r: STAGE_ORDER.get(r.stage, len(STAGE_ORDER)))
+        return records
+
+    def active_ids(self):
+        """ID незавершённых задач (их папки в downloads трогать нельзя)."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT job_id FROM jobs WHERE stage NOT IN (?, ?)",
+                (STAGE_DONE, STAGE_FAILED),
+            ).fetchall()
+        return {row["job_id"] for row in rows}
+
+    def purge(self, older_than):
+        """Удаляет завершённые задачи старше older_than секунд."""
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE stage IN (?, ?) AND updated_at < ?",
+                (STAGE_DONE, STAGE_FAILED, time.time() - older_than),
+            )
+            return cursor.rowcount
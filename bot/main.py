@@ -1,16 +1,42 @@
 import os
 import telebot
-from yt_dlp import YoutubeDL
 import subprocess
 import re
 import time
 import asyncio  # ← ДОБАВИТЬ
+import contextlib
+import dataclasses
+import secrets
+import signal
+from types import SimpleNamespace
 
 from telebot.async_telebot import AsyncTeleBot  # ← ДОБАВИТЬ
 
 from bot import config
 from bot import downloads_manager
-from bot.video_sender import send_video_to_user
+from bot import media
+from bot import chunked_encoder
+from bot import metrics
+from bot import format_selector
+from bot.video_sender import (
+    send_video_to_user, send_cached_video, encode_and_send_segments, CachedSendError
+)
+from bot.result_cache import ResultCache, normalize_url
+from bot.inflight import Flight, InFlightRegistry, SharedResult
+from bot.workspace import JobWorkspace
+from bot.download_engine import DownloadEngine, StreamRejected
+from bot.scheduler import JobScheduler, SchedulerBusy
+from bot.disk_budget import DiskBudget, estimate_footprint, estimate_source_size
+from bot.progress import ProgressHub, progress_text, spinner_text
+from bot.outbound import OutboundDispatcher
+from bot.admin_digest import AdminDigest
+from bot.static_media import StaticMediaStore, send_static
+from bot.subscriptions import SUBSCRIBED_STATUSES, SubscriptionCache, is_channel
+from bot.webhook import WebhookServer
+from bot.job_store import (
+    JobStore, STAGE_QUEUED, STAGE_DOWNLOADING, STAGE_ENCODING, STAGE_UPLOADING,
+    STAGE_DONE, STAGE_FAILED,
+)
 
 from yt_dlp.utils import DownloadError
 
@@ -20,28 +46,90 @@ from yt_dlp.utils import DownloadError
 bot = AsyncTeleBot(config.TELEGRAM_BOT_TOKEN)
 
 
+scheduler = JobScheduler(
+    download_limit=config.MAX_PARALLEL_DOWNLOADS,
+    transcode_limit=config.MAX_PARALLEL_TRANSCODES,
+    upload_limit=config.MAX_PARALLEL_UPLOADS,
+    per_user_limit=config.MAX_JOBS_PER_USER,
+    max_jobs=config.MAX_QUEUED_JOBS,
+)
+
+result_cache = ResultCache(
+    ttl=config.RESULT_CACHE_TTL,
+    max_entries=config.RESULT_CACHE_MAX_ENTRIES,
+)
+
+# Все исходящие запросы к Bot API: лимиты Telegram, приоритеты, повтор после 429
+outbound = OutboundDispatcher(
+    bot,
+    global_rate=config.OUTBOUND_GLOBAL_RATE,
+    chat_rate=config.OUTBOUND_CHAT_RATE,
+    group_rate=config.OUTBOUND_GROUP_RATE / 60,
+    max_retries=config.OUTBOUND_MAX_RETRIES,
+)
+
+# Уведомления администратору копятся и уходят сводкой, ошибки — сразу
+admin_digest = AdminDigest(
+    outbound,
+    config.ADMIN_ID,
+    interval=config.ADMIN_DIGEST_INTERVAL,
+    max_events=config.ADMIN_DIGEST_MAX_EVENTS,
+)
+
+# Все правки статусных сообщений идут через него: коалесцирование и лимиты Telegram
+progress_hub = ProgressHub(
+    outbound,
+    private_interval=config.PROGRESS_PRIVATE_INTERVAL,
+    group_interval=config.PROGRESS_GROUP_INTERVAL,
+    edits_per_second=config.PROGRESS_EDITS_PER_SECOND,
+)
+
+inflight = InFlightRegistry(progress_hub)
+
+# file_id видеоинструкции и других статичных файлов: загружаем один раз
+static_media = StaticMediaStore()
+
+subscriptions = SubscriptionCache(
+    positive_ttl=config.SUBSCRIPTION_CACHE_TTL,
+    negative_ttl=config.SUBSCRIPTION_NEGATIVE_TTL,
+    max_entries=config.SUBSCRIPTION_CACHE_MAX_ENTRIES,
+)
+
+# Стадии задач в SQLite: после перезапуска незавершённые задачи продолжаются
+job_store = JobStore()
+
+# Задачи пользователей, которые сейчас выполняются (их ждём при остановке)
+active_jobs = set()
+
 if not os.path.exists(config.DOWNLOAD_DIR):
     os.makedirs(config.DOWNLOAD_DIR)
 
+# Резерв места под задачи: новая не стартует, если диск заполнится ниже DISK_MIN_FREE_MB
+disk_budget = DiskBudget(
+    config.DOWNLOAD_DIR,
+    min_free=config.DISK_MIN_FREE_MB * 1024 * 1024,
+    max_wait=config.DISK_WAIT_TIMEOUT,
+)
+
+# Текущая глубина очередей — считается в момент запроса /metrics
+metrics.registry.gauge(
+    "stage_active", "Занятые слоты стадии",
+    lambda: [({"stage": name}, active) for name, (active, _, _) in scheduler.snapshot().items()],
+)
+metrics.registry.gauge(
+    "stage_waiting", "Задачи в очереди на стадию",
+    lambda: [({"stage": name}, waiting) for name, (_, _, waiting) in scheduler.snapshot().items()],
+)
+metrics.registry.gauge("jobs", "Задачи в работе", lambda: [({}, scheduler.jobs)])
+metrics.registry.gauge("outbound_queue", "Запросы к Bot API в очереди", lambda: [({}, len(outbound))])
+
 
-PROGRESS_BARS = [
-    "[░░░░░░░░░░]",
-    "[▓░░░░░░░░░]",
-    "[▓▓░░░░░░░░]",
-    "[▓▓▓░░░░░░░]",
-    "[▓▓▓▓░░░░░░]",
-    "[▓▓▓▓▓░░░░░]",
-    "[▓▓▓▓▓▓░░░░]",
-    "[▓▓▓▓▓▓▓░░░]",
-    "[▓▓▓▓▓▓▓▓░░]",
-    "[▓▓▓▓▓▓▓▓▓░]",
-    "[▓▓▓▓▓▓▓▓▓▓]",
-]
+def _disk_gauge():
+    free, reserved, _ = disk_budget.snapshot()
+    return [({"kind": "free"}, free), ({"kind": "reserved"}, reserved)]
 
-def get_next_bar(index: int) -> tuple[str, int]:
-    """Возвращает следующий вариант бара и новый индекс."""
-    index = (index + 1) % len(PROGRESS_BARS)
-    return PROGRESS_BARS[index], index
+
+metrics.registry.gauge("disk_bytes", "Свободное и зарезервированное под задачи место в DOWNLOAD_DIR", _disk_gauge)
 
 
 # test comment 08/10/2025
@@ -61,31 +149,166 @@ def sanitize_filepath(filepath):
     return os.path.join(directory, sanitized_filename)
 
 
-async def notify_admin(user_id, username, message_text):
-    await bot.send_message(
-        config.ADMIN_ID,
-        f"🔔 Новый пользователь:\n"
-        f"ID: {user_id}\n"
-        f"Имя: {username}\n"
-        f"Сообщение: {message_text}"
-    )
+def notify_admin(user_id, username, message_text):
+    # Не отдельным сообщением, а строкой в сводке для администратора
+    admin_digest.user_message(user_id, username, message_text)
 
 
 
 async def is_subscribed(user_id):
     """
-    Проверяет, подписан ли пользователь на канал.
+    Проверяет, подписан ли пользователь на канал. Повторные проверки
+    берутся из кэша без запроса к Telegram.
     """
+    cached = subscriptions.get(user_id)
+    if cached is not None:
+        metrics.registry.inc("cache_requests", cache="subscription", result="hit")
+        return cached
+    metrics.registry.inc("cache_requests", cache="subscription", result="miss")
+    started = time.monotonic()
     try:
         chat_member = await bot.get_chat_member(config.CHANNEL_USERNAME, user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
     except Exception as e:
+        # Ошибку не кэшируем: при следующем сообщении спросим снова
         print(f"Ошибка при проверке подписки: {e}")
         return False
+    finally:
+        metrics.registry.observe(
+            "stage_seconds", time.monotonic() - started, stage="subscription"
+        )
+    subscribed = chat_member.status in SUBSCRIBED_STATUSES
+    subscriptions.put(user_id, subscribed)
+    return subscribed
+
+
+@bot.chat_member_handler()
+async def on_channel_member_update(update):
+    """
+    Подписка/отписка в канале (приходит, если бот — администратор канала
+    и chat_member есть в allowed_updates): сразу обновляем кэш.
+    """
+    if not is_channel(update.chat, config.CHANNEL_USERNAME):
+        return
+    member = update.new_chat_member
+    subscriptions.put(member.user.id, member.status in SUBSCRIBED_STATUSES)
 
 
 
-def process_video(video_path):
+def _plan_encoding(source_info):
+    """
+    Путь обработки и аргументы кодеков ffmpeg: remux / только звук /
+    полное перекодирование, либо кодирование под лимит 50 МБ.
+    Возвращает (processing_path, codec_args, fit_plan | None).
+    """
+    processing_path = media.choose_processing_path(source_info)
+    fit_plan = None
+    if config.FIT_TO_LIMIT and media.needs_fit(source_info):
+        fit_plan = media.plan_fit(
+            source_info, min_video_kbps=config.FIT_MIN_VIDEO_KBPS
+        )
+    if fit_plan is not None:
+        return media.PATH_FIT, media.ffmpeg_args_for_fit(fit_plan, source_info), fit_plan
+    return processing_path, media.ffmpeg_args_for_path(processing_path), None
+
+
+def _encoded_info(source_info, output_path, processing_path, fit_plan):
+    """MediaInfo результата из параметров кодирования, без ffprobe."""
+    if fit_plan is not None:
+        output_streams = {
+            **media.encoded_streams(media.PATH_FULL, source_info),
+            "width": fit_plan.width,
+            "height": fit_plan.height,
+        }
+    else:
+        output_streams = media.encoded_streams(processing_path, source_info)
+    video_info = source_info.derive(output_path, **output_streams)
+    if not video_info.width or not video_info.height:
+        raise ValueError("Не удалось извлечь размеры видео.")
+    return video_info
+
+
+def _clear_dir(path):
+    """Удаляет содержимое папки задачи (остатки неудачной потоковой обработки)."""
+    for name in os.listdir(path):
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+
+def find_stream_format(info, choice):
+    """
+    Формат, который можно скачивать прямо в ffmpeg: один файл (видео и звук
+    вместе) по обычному HTTP. Для DASH/HLS и раздельных дорожек — None.
+    """
+    if not config.STREAM_TRANSCODE or choice is None or not choice.single_file:
+        return None
+    for fmt in info.get("formats") or []:
+        if fmt.get("format_id") == choice.format_id:
+            if fmt.get("protocol") in ("http", "https") and fmt.get("url"):
+                return fmt
+            return None
+    return None
+
+
+async def stream_process_video(fmt, info, output_dir, on_progress=None):
+    """
+    Потоковая обработка: байты из сети сразу идут в stdin ffmpeg, исходный
+    файл на диск не пишется, кодирование идёт одновременно со скачиванием.
+    MP4 без faststart отсеивается по первому блоку (StreamRejected) до
+    запуска ffmpeg. Возвращает (путь к результату, MediaInfo) или None, если видео для
+    потоковой обработки не подходит (тогда — обычный путь через файл).
+    """
+    duration = info.get("duration") or 0
+    source_info = media.MediaInfo.from_format(fmt, duration)
+    if not source_info.width or not source_info.height or not duration:
+        return None
+    if media.needs_split(source_info, config.FIT_TO_LIMIT, config.FIT_MIN_VIDEO_KBPS):
+        return None
+    if chunked_encoder.should_use_chunked(source_info):
+        return None
+
+    processing_path, codec_args, fit_plan = _plan_encoding(source_info)
+    if fit_plan is not None and config.FIT_TWO_PASS:
+        return None
+
+    title = sanitize_filename(info.get("title") or info.get("id") or "video")
+    fixed_video_path = os.path.join(output_dir, f"{title[:80]}_fixed.mp4")
+    ffmpeg_command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-i", "pipe:0",
+        *codec_args,
+        "-movflags", "faststart",      # Для Telegram и веб
+        fixed_video_path
+    ]
+
+    started = time.monotonic()
+    downloaded = await download_engine.stream_to_process(
+        fmt, ffmpeg_command, on_progress=on_progress, accept_head=media.pipe_readable
+    )
+    metrics.registry.observe("stage_bytes", downloaded, stage="download")
+    video_info = await asyncio.to_thread(
+        _encoded_info, source_info, fixed_video_path, processing_path, fit_plan
+    )
+
+    elapsed = time.monotonic() - started
+    media.processing_stats.record(processing_path, elapsed, duration)
+    log(
+        f"[BOT] stream_process_video path={processing_path} "
+        f"elapsed={elapsed:.1f}s duration={duration:.1f}s format={fmt.get('format_id')}"
+    )
+    return fixed_video_path, video_info
+
+
+def process_video(video_path, on_progress=None):
+    """
+    Приводит видео к виду, который понимает Telegram, и возвращает
+    (путь к результату, MediaInfo результата).
+
+    Если видео в лимит 50 МБ не помещается, кодируем его с битрейтом под
+    лимит (при необходимости уменьшая разрешение). Деление на части
+    остаётся только для роликов, которые не помещаются даже так.
+    on_progress(percent) вызывается из этого же потока по ходу кодирования.
+    """
     try:
         # Убедимся, что путь безопасен
         video_path = sanitize_filepath(video_path)
@@ -93,36 +316,55 @@ def process_video(video_path):
             os.path.splitext(video_path)[0] + "_fixed.mp4"
         )
 
-        # Перекодируем в совместимый формат: H.264 + AAC
-        ffmpeg_command = [
-            "ffmpeg", "-i", video_path,
-            "-c:v", "libx264",             # Видео кодек
-            "-preset", "fast",             # Скорость кодирования
-            "-crf", "23",                  # Качество (меньше = лучше)
-            "-c:a", "aac",                 # Аудио кодек
-            "-b:a", "128k",                # Битрейт аудио
-            "-movflags", "faststart",      # Для Telegram и веб
-            fixed_video_path
-        ]
-        subprocess.run(ffmpeg_command, check=True)
-
-        # Получение размеров видео
-        ffmpeg_command = [
-            "ffmpeg", "-i", fixed_video_path
-        ]
-        result = subprocess.run(
-            ffmpeg_command,
-            stderr=subprocess.PIPE,
-            text=True
+        # Смотрим кодеки: если уже H.264/AAC — не перекодируем заново
+        started = time.monotonic()
+        source_info = media.probe_media(video_path)
+        processing_path, codec_args, fit_plan = _plan_encoding(source_info)
+        main_progress = on_progress
+        if fit_plan is not None:
+            if config.FIT_TWO_PASS:
+                # Первый проход только собирает статистику для точного битрейта
+                passlog = os.path.splitext(fixed_video_path)[0] + "_2pass"
+                media.run_ffmpeg([
+                    "ffmpeg", "-y", "-i", video_path,
+                    *codec_args, "-an",
+                    "-pass", "1", "-passlogfile", passlog,
+                    "-f", "mp4", os.devnull
+                ], source_info.duration, on_progress and (lambda p: on_progress(p / 2)))
+                codec_args += ["-pass", "2", "-passlogfile", passlog]
+                if on_progress is not None:
+                    main_progress = lambda p: on_progress(50 + p / 2)
+
+        # Приводим к совместимому формату: H.264 + AAC в MP4
+        reencode = processing_path in (media.PATH_FULL, media.PATH_FIT)
+        two_pass = fit_plan is not None and config.FIT_TWO_PASS
+        if reencode and not two_pass and chunked_encoder.should_use_chunked(source_info):
+            # Длинное видео и свободные ядра — кодируем кусками параллельно
+            chunks = chunked_encoder.encode_chunked(
+                video_path, fixed_video_path, codec_args, source_info,
+                on_progress=on_progress,
+            )
+            log(f"[BOT] process_video chunked encode: {chunks} chunks")
+        else:
+            ffmpeg_command = [
+                "ffmpeg", "-y", "-i", video_path,
+                *codec_args,
+                "-movflags", "faststart",      # Для Telegram и веб
+                fixed_video_path
+            ]
+            media.run_ffmpeg(ffmpeg_command, source_info.duration, main_progress)
+
+        # Параметры результата известны заранее — второй запуск ffmpeg не нужен
+        video_info = _encoded_info(
+            source_info, fixed_video_path, processing_path, fit_plan
         )
-        ffmpeg_output = result.stderr
 
-        resolution_match = re.search(r'Video:.* (\d+)x(\d+)', ffmpeg_output)
-        if resolution_match:
-            width = int(resolution_match.group(1))
-            height = int(resolution_match.group(2))
-        else:
-            raise ValueError("Не удалось извлечь размеры видео.")
+        elapsed = time.monotonic() - started
+        media.processing_stats.record(processing_path, elapsed, source_info.duration)
+        log(
+            f"[BOT] process_video path={processing_path} "
+            f"elapsed={elapsed:.1f}s duration={source_info.duration:.1f}s file={video_path}"
+        )
 
         # Удаление оригинала
         if os.path.exists(video_path):
@@ -131,222 +373,219 @@ def process_video(video_path):
         else:
             print(f"Оригинальное видео {video_path} не найдено для удаления.")
 
-        return fixed_video_path, width, height
+        return fixed_video_path, video_info
 
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"Ошибка при обработке видео через FFmpeg: {e}")
 
 
-@bot.message_handler(commands=['youtube_blocked_test'])
-def youtube_blocked_test(message):
-    if message.from_user.id != config.ADMIN_ID:
-        bot.reply_to(message, "Эта команда доступна только администратору.")
-        return
-
-    try:
-        # Подготовка
-        download_dir = os.path.join(os.path.dirname(__file__), 'downloads')
-        os.makedirs(download_dir, exist_ok=True)
-        output_template = os.path.join(download_dir, '%(title)s.%(ext)s')
-
-        ytdlp_command = [
-            "yt-dlp",
-            "--proxy", "socks5://127.0.0.1:9050",
-            "--cookies", "web_auth_storage.txt",
-            "-f", "(bv*+ba/b)[height<=720]",
-            "-o", output_template,
-            "https://www.youtube.com/watch?v=QnaS8T4MdrI"
-        ]
-
-        # Первичное сообщение
-        status_message = bot.send_message(message.chat.id, "🔄 Загрузка видео...")
-
-        # Запуск yt-dlp
-        process = subprocess.Popen(
-            ytdlp_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1
-        )
+# Ссылки по умолчанию для диагностических команд
+YOUTUBE_TEST_URL = "https://www.youtube.com/watch?v=QnaS8T4MdrI"
+INSTAGRAM_TEST_URL = "https://www.instagram.com/reel/DFk0NvTuX4S/?igsh=MWZ1MTFhOWExMGV5bQ=="
 
-        last_edit_time = 0
-        for line in process.stdout:
-            if not line.strip():
-                continue
-
-            print(f"[yt-dlp] {line.strip()}")  # лог в stdout → journalctl
-
-            # Попытка найти прогресс
-            progress_match = re.search(r'(\d{1,3}\.\d+)%', line)
-            if progress_match:
-                percent = float(progress_match.group(1))
-                blocks = int(percent / 10)
-                bar = "▓" * blocks + "░" * (10 - blocks)
-                now = time.time()
-                if now - last_edit_time > 1:  # не обновлять чаще 1 раза в секунду
-                    bot.edit_message_text(
-                        f"📥 Прогресс: `{bar} {percent:.1f}%`",
-                        chat_id=message.chat.id,
-                        message_id=status_message.message_id,
-                        parse_mode="Markdown"
-                    )
-                    last_edit_time = now
 
-        process.wait()
+def _parse_diagnostic_args(text, default_url, default_profile):
+    """'/команда [ссылка] [профиль]' → (url, profile) с подстановкой значений по умолчанию."""
+    url, profile = default_url, default_profile
+    for arg in text.split()[1:]:
+        if "://" in arg:
+            url = arg
+        else:
+            profile = arg
+    return url, profile
 
-        if process.returncode != 0:
-            bot.edit_message_text("❌ Загрузка завершилась с ошибкой.", chat_id=message.chat.id, message_id=status_message.message_id)
-            return
 
-        # Поиск и обработка видео
-        downloaded_files = [f for f in os.listdir(download_dir) if f.endswith(('.mp4', '.mkv'))]
-        if not downloaded_files:
-            bot.edit_message_text("⚠️ Не удалось найти загруженное видео.", chat_id=message.chat.id, message_id=status_message.message_id)
-            return
+def _format_timings(timings):
+    lines = [f"{stage}: {seconds:.1f} с" for stage, seconds in timings.items()]
+    lines.append(f"Итого: {sum(timings.values()):.1f} с")
+    return "\n".join(lines)
 
-        video_path = os.path.join(download_dir, downloaded_files[0])
-        fixed_video_path, width, height = process_video(video_path)
 
-        # Отправка видео
-        send_video_to_user(
-            bot=bot,
-            chat_id=message.chat.id,
-            user_id=message.from_user.id,
-            username=message.from_user.username,
-            url="https://www.youtube.com/watch?v=QnaS8T4MdrI",
-            video_path=fixed_video_path,
-            width=width,
-            height=height,
-            admin_id=config.ADMIN_ID
+def _describe_plan(source_info):
+    """
+    Путь обработки, которым видео пойдёт в задаче: тот же выбор, что в
+    _run_download_job и process_video (_plan_encoding, деление на части).
+    """
+    if media.needs_split(source_info, config.FIT_TO_LIMIT, config.FIT_MIN_VIDEO_KBPS):
+        processing_path = media.choose_processing_path(source_info)
+        if config.SEGMENT_STREAMING:
+            plan = media.plan_segments(source_info, processing_path)
+            kind = "перекодирование" if plan.reencode else processing_path
+            return f"части по {plan.segment_time} с ({kind}, {plan.width}x{plan.height})"
+        return f"{processing_path} + деление на части"
+    processing_path, _, fit_plan = _plan_encoding(source_info)
+    if fit_plan is not None:
+        return (
+            f"{processing_path} ({fit_plan.video_kbps} kbps, "
+            f"{fit_plan.width}x{fit_plan.height})"
         )
-
-        # Удаление
-        if os.path.exists(fixed_video_path):
-            os.remove(fixed_video_path)
-
-    except Exception as e:
-        bot.send_message(message.chat.id, f"🚫 Ошибка: {e}")
+    return processing_path
 
 
-@bot.message_handler(commands=['instagram_test'])
-def instagram_test(message):
+async def _run_diagnostic(message, default_url, default_profile):
+    """
+    Полный прогон одной ссылки через общий пайплайн (движок yt-dlp,
+    планировщик стадий, обработка, отправка) без кэша результатов и
+    singleflight — замер задержек по стадиям: очередь, resolve, download,
+    transcode, upload.
+    """
     if message.from_user.id != config.ADMIN_ID:
-        bot.reply_to(message, "Эта команда доступна только администратору.")
+        await outbound.reply_to(message, "Эта команда доступна только администратору.")
         return
 
-    try:
-        # Подготовка путей и команды
-        download_dir = os.path.join(os.path.dirname(__file__), 'downloads')
-        os.makedirs(download_dir, exist_ok=True)
-        output_template = os.path.join(download_dir, '%(title)s.%(ext)s')
-
-        ytdlp_command = [
-            "yt-dlp",
-            "--proxy", "socks5://127.0.0.1:9050",
-            "--cookies", "web_auth_storage.txt",
-            "-f", "mp4",
-            "-o", output_template,
-            "https://www.instagram.com/reel/DFk0NvTuX4S/?igsh=MWZ1MTFhOWExMGV5bQ=="
-        ]
-
-        # Первичное сообщение
-        status_message = bot.send_message(message.chat.id, "🔄 Загрузка Instagram-видео...")
-
-        # Запуск yt-dlp с выводом прогресса
-        process = subprocess.Popen(
-            ytdlp_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1
+    url, profile = _parse_diagnostic_args(message.text, default_url, default_profile)
+    if profile not in DOWNLOAD_PROFILES:
+        await outbound.reply_to(
+            message,
+            f"Неизвестный профиль {profile}. Доступны: {', '.join(DOWNLOAD_PROFILES)}"
         )
+        return
 
-        last_edit_time = 0
-        for line in process.stdout:
-            if not line.strip():
-                continue
-
-            # Отображение прогресса
-            progress_match = re.search(r'(\d{1,3}\.\d+)%', line)
-            if progress_match:
-                percent = float(progress_match.group(1))
-                blocks = int(percent / 10)
-                bar = "▓" * blocks + "░" * (10 - blocks)
-                now = time.time()
-                if now - last_edit_time > 1:
-                    bot.edit_message_text(
-                        f"📥 Прогресс: `{bar} {percent:.1f}%`",
-                        chat_id=message.chat.id,
-                        message_id=status_message.message_id,
-                        parse_mode="Markdown"
-                    )
-                    last_edit_time = now
+    status_message = await outbound.reply_to(
+        message, f"🔄 Диагностика ({profile}): {url}"
+    )
+    flight = Flight(f"diagnostic:{status_message.message_id}", progress_hub)
+    flight.subscribe(message.chat.id, status_message.message_id)
+    on_wait = _queue_notifier(flight)
+
+    timings = {}
+    details = []
+    stage = "resolve"
+    # Папки диагностики нет в JobStore: от очистки её защищает резерв места
+    workspace = JobWorkspace(config.DOWNLOAD_DIR)
+    try:
+        started = time.monotonic()
+        flight.update(f"🔎 Получаю информацию о видео ({profile})...")
+        format_str, choice, info = await resolve_download(url, profile)
+        timings["resolve"] = time.monotonic() - started
+        if choice is not None:
+            details.append(
+                f"Формат: {choice.format_id} ({choice.height}p, "
+                f"~{choice.estimated_size / 1024 / 1024:.1f} MB)"
+            )
 
-        process.wait()
+        stage = "disk"
+        started = time.monotonic()
+        await _reserve_disk(
+            workspace.job_id, workspace, _estimate_footprint(info, choice), flight
+        )
+        timings["место на диске"] = time.monotonic() - started
+        await asyncio.to_thread(workspace.create)
+
+        queued = time.monotonic()
+        async with scheduler.stage("download", on_wait):
+            timings["очередь"] = time.monotonic() - queued
+
+            stage = "download"
+            started = time.monotonic()
+            video_path = await download_engine.download(
+                url,
+                workspace.path,
+                format_str=format_str,
+                info=info,
+                profile=profile,
+                on_progress=_download_progress_hook(flight),
+            )
+            timings["download"] = time.monotonic() - started
+            size_mb = await asyncio.to_thread(os.path.getsize, video_path) / (1024 * 1024)
+            details.append(
+                f"Скачано: {size_mb:.1f} MB "
+                f"({size_mb / max(timings['download'], 0.001):.1f} MB/s)"
+            )
 
-        if process.returncode != 0:
-            bot.edit_message_text("❌ Ошибка при загрузке видео.", chat_id=message.chat.id, message_id=status_message.message_id)
-            return
+        stage = "transcode"
+        queued = time.monotonic()
+        async with scheduler.stage("transcode", on_wait):
+            timings["очередь"] += time.monotonic() - queued
+            started = time.monotonic()
+            flight.update("🎞 Обрабатываю видео...")
+            source_info = await asyncio.to_thread(media.probe_media, video_path)
+            details.append(f"Путь обработки: {_describe_plan(source_info)}")
+            fixed_video_path, video_info = await asyncio.to_thread(
+                process_video,
+                video_path,
+                _progress_reporter(flight, "🎞 Обрабатываю видео"),
+            )
+            timings["transcode"] = time.monotonic() - started
+
+        stage = "upload"
+        queued = time.monotonic()
+        async with scheduler.stage("upload", on_wait):
+            timings["очередь"] += time.monotonic() - queued
+            started = time.monotonic()
+            flight.update("📤 Отправляю видео...")
+            await send_video_to_user(
+                outbound,
+                message.chat.id,
+                message.from_user.id,
+                message.from_user.username,
+                url,
+                fixed_video_path,
+                video_info.width,
+                video_info.height,
+                admin_digest,
+                media_info=video_info,
+                on_progress=_progress_reporter(flight, "📤 Отправляю видео"),
+            )
+            timings["upload"] = time.monotonic() - started
 
-        # Поиск загруженного файла
-        downloaded_files = [f for f in os.listdir(download_dir) if f.endswith(('.mp4', '.mkv'))]
-        if not downloaded_files:
-            bot.edit_message_text("⚠️ Не удалось найти загруженное видео.", chat_id=message.chat.id, message_id=status_message.message_id)
-            return
+        await _edit_own_status(
+            message,
+            status_message,
+            f"✅ Диагностика ({profile}) завершена\n{url}\n"
+            + "\n".join(details) + "\n\n" + _format_timings(timings),
+        )
 
-        video_path = os.path.join(download_dir, downloaded_files[0])
+    except Exception as e:
+        log(f"[BOT] diagnostic {url} ({profile}) failed at {stage}: {e}")
+        await _edit_own_status(
+            message,
+            status_message,
+            f"🚫 Диагностика ({profile}) упала на стадии {stage}: {e}\n"
+            + "\n".join(details) + "\n\n" + _format_timings(timings),
+        )
 
-        # Обработка видео
-        fixed_video_path, width, height = process_video(video_path)
+    finally:
+        disk_budget.release(workspace.job_id)
+        await asyncio.to_thread(workspace.cleanup)
 
-        # Отправка пользователю
-        send_video_to_user(
-            bot=bot,
-            chat_id=message.chat.id,
-            user_id=message.from_user.id,
-            username=message.from_user.username,
-            url="https://www.instagram.com/reel/DFk0NvTuX4S/?igsh=MWZ1MTFhOWExMGV5bQ==",
-            video_path=fixed_video_path,
-            width=width,
-            height=height,
-            admin_id=config.ADMIN_ID
-        )
 
-        # Удаление обработанного файла
-        if os.path.exists(fixed_video_path):
-            os.remove(fixed_video_path)
+@bot.message_handler(commands=['youtube_blocked_test'])
+async def youtube_blocked_test(message):
+    await _run_diagnostic(message, YOUTUBE_TEST_URL, "tor")
 
-    except Exception as e:
-        bot.send_message(message.chat.id, f"🚫 Ошибка: {e}")
+
+@bot.message_handler(commands=['instagram_test'])
+async def instagram_test(message):
+    await _run_diagnostic(message, INSTAGRAM_TEST_URL, "tor")
 
 
 @bot.message_handler(commands=['start', 'help'])
 async def send_welcome(message):
-    await notify_admin(
+    notify_admin(
         message.from_user.id,
         message.from_user.username,
         message.text
     )
 
-    await bot.reply_to(
+    await outbound.reply_to(
         message,
         "Привет! Отправь мне ссылку на видео, и я скачаю его для тебя"
     )
 
     try:
-        with open("margarine_intro.mp4", "rb") as video:
-            await bot.send_video(
-                message.chat.id,
-                video,
-                caption=(
-                    "Посмотрите видеоинструкцию, чтобы узнать, "
-                    "как пользоваться ботом."
-                )
+        await send_static(
+            outbound,
+            static_media,
+            message.chat.id,
+            config.INTRO_VIDEO_PATH,
+            caption=(
+                "Посмотрите видеоинструкцию, чтобы узнать, "
+                "как пользоваться ботом."
             )
+        )
     except Exception as e:
-        await bot.send_message(
-            config.ADMIN_ID,
+        admin_digest.error(
             f"⚠️ Ошибка при отправке видеоинструкции:\n\n"
             f"Пользователь: @{message.from_user.username} "
             f"(ID: {message.from_user.id})\n"
@@ -355,46 +594,229 @@ async def send_welcome(message):
 
 
 
+# Сколько элементов папки загрузок показывать в /show_downloads
+SHOW_DOWNLOADS_LIMIT = 30
+
+
+def _format_age(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f} с"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f} ч"
+    return f"{seconds / 86400:.1f} д"
+
+
+def _describe_owner(entry, records):
+    """
+    Владелец элемента папки загрузок: задача из JobStore (стадия и
+    пользователь). records — {job_id: JobRecord} из job_store.get_many.
+    """
+    if entry.job_id is None:
+        if not entry.is_dir and downloads_manager.LEFTOVER_RE.search(entry.name):
+            return "временный файл без задачи"
+        return "без задачи"
+    record = records.get(entry.job_id)
+    if record is None:
+        return "задачи нет в базе"
+    owner = f"@{record.username}" if record.username else str(record.user_id)
+    return f"{record.stage}, {owner}"
+
+
+def render_downloads():
+    """
+    Текст /show_downloads: размер, возраст и владелец каждого элемента.
+    Папка обходится os.scandir по одному элементу; после
+    SHOW_DOWNLOADS_LIMIT строк только досчитываются итоги. Задачи
+    показанных элементов читаются из JobStore одним запросом.
+    """
+    now = time.time()
+    shown = []
+    count, total = 0, 0
+    for entry in downloads_manager.scan_downloads(config.DOWNLOAD_DIR):
+        count += 1
+        total += entry.size
+        if count <= SHOW_DOWNLOADS_LIMIT:
+            shown.append(entry)
+    if not count:
+        return "Папка downloads пуста."
+    records = job_store.get_many(entry.job_id for entry in shown if entry.job_id)
+    lines = []
+    for entry in shown:
+        files = f", файлов: {entry.files}" if entry.is_dir else ""
+        lines.append(
+            f"{entry.name} — {entry.size / 1024 / 1024:.1f} MB{files}, "
+            f"{_format_age(entry.age(now))} назад · {_describe_owner(entry, records)}"
+        )
+    if count > SHOW_DOWNLOADS_LIMIT:
+        lines.append(f"…и ещё {count - SHOW_DOWNLOADS_LIMIT}")
+    free, reserved, jobs = disk_budget.snapshot()
+    lines.insert(0, f"Содержимое папки downloads: {count} шт, {total / 1024 / 1024:.1f} MB")
+    lines.append(
+        f"Свободно на диске: {free / 1024 / 1024 / 1024:.1f} GB, "
+        f"зарезервировано задачами: {reserved / 1024 / 1024:.0f} MB ({jobs})"
+    )
+    return "\n".join(lines)
+
+
 @bot.message_handler(commands=['show_downloads'])
 async def show_downloads(message):
     if message.from_user.id == config.ADMIN_ID:
         try:
-            # downloads_manager.list_downloads синхронный → в поток
-            files = await asyncio.to_thread(
-                downloads_manager.list_downloads,
-                config.DOWNLOAD_DIR
-            )
-            if files:
-                await bot.send_message(
-                    message.chat.id,
-                    "Содержимое папки downloads:\n" + "\n".join(files)
-                )
-            else:
-                await bot.send_message(message.chat.id, "Папка downloads пуста.")
+            # Обход папки и запросы к базе синхронные → в поток
+            text = await asyncio.to_thread(render_downloads)
+            await outbound.send_message(message.chat.id, text)
         except Exception as e:
-            await bot.send_message(
+            await outbound.send_message(
                 message.chat.id,
                 f"Ошибка при получении содержимого папки: {e}"
             )
     else:
-        await bot.reply_to(message, "Эта команда доступна только администратору.")
+        await outbound.reply_to(message, "Эта команда доступна только администратору.")
+
+
+
+# Порядок стадий в /stats
+STATS_STAGES = ("subscription", "metadata", "disk", "download", "transcode", "split", "upload")
+
 
+def _format_quantiles(series, key_name, order=(), unit="с", scale=1.0):
+    values = {dict(key).get(key_name): value for key, value in series.items()}
+    names = [name for name in order if name in values]
+    names += sorted(name for name in values if name not in order)
+    return [
+        f"{name}: {values[name][1] / scale:.1f} / {values[name][2] / scale:.1f} {unit} "
+        f"({values[name][0]})"
+        for name in names
+    ]
+
+
+def _hit_rate(cache):
+    hits = metrics.registry.counter_value("cache_requests", cache=cache, result="hit")
+    misses = metrics.registry.counter_value("cache_requests", cache=cache, result="miss")
+    total = hits + misses
+    return f"{hits}/{total} ({hits * 100 / total:.0f}%)" if total else "нет обращений"
+
+
+def render_stats():
+    """Сводка метрик для /stats: p50 / p95 стадий, CPU, объём, кэши, очереди."""
+    lines = ["📈 Метрики с запуска (p50 / p95, в скобках — число замеров)"]
+    sections = (
+        ("Время стадий:", "stage_seconds", "stage", STATS_STAGES, "с", 1.0),
+        ("Ожидание в очереди:", "queue_wait_seconds", "stage", STATS_STAGES, "с", 1.0),
+        ("CPU на задачу:", "tool_cpu_seconds", "tool", (), "с", 1.0),
+        ("Объём на задачу:", "stage_bytes", "stage", STATS_STAGES, "MB", 1024 * 1024),
+    )
+    for title, name, key_name, order, unit, scale in sections:
+        rows = _format_quantiles(metrics.registry.quantiles(name), key_name, order, unit, scale)
+        if rows:
+            lines.append(title)
+            lines.extend(rows)
+    lines.append(f"Кэш file_id: {_hit_rate('result')}")
+    lines.append(f"Кэш подписок: {_hit_rate('subscription')}")
+    lines.append(f"Сейчас задач: {scheduler.jobs}")
+    for stage, (active, limit, waiting) in scheduler.snapshot().items():
+        lines.append(f"{stage}: {active}/{limit}, в очереди {waiting}")
+    lines.append(f"Запросов к Bot API в очереди: {len(outbound)}")
+    if config.EXTERNAL_WORKERS:
+        lines.append("Метрики воркеров — на их /metrics (WORKER_METRICS_PORT).")
+    return "\n".join(lines)
+
+
+@bot.message_handler(commands=['stats'])
+async def show_stats(message):
+    if message.from_user.id != config.ADMIN_ID:
+        await outbound.reply_to(message, "Эта команда доступна только администратору.")
+        return
+    await outbound.send_message(message.chat.id, render_stats())
 
 
 @bot.message_handler(commands=['clean_downloads'])
 async def clean_downloads(message):
     if message.from_user.id == config.ADMIN_ID:
         try:
+            # Папки незавершённых задач и задач с резервом места не трогаем
+            keep = await asyncio.to_thread(job_store.active_ids)
             # синхронная очистка → в поток
-            await asyncio.to_thread(
+            kept = await asyncio.to_thread(
                 downloads_manager.clean_downloads,
-                config.DOWNLOAD_DIR
+                config.DOWNLOAD_DIR,
+                keep | disk_budget.job_ids(),
             )
-            await bot.send_message(message.chat.id, "Папка downloads очищена.")
+            text = "Папка downloads очищена."
+            if kept:
+                text += f" Папки задач в работе оставлены: {kept}."
+            await outbound.send_message(message.chat.id, text)
         except Exception as e:
-            await bot.send_message(message.chat.id, f"Ошибка при очистке папки: {e}")
+            await outbound.send_message(message.chat.id, f"Ошибка при очистке папки: {e}")
+    else:
+        await outbound.reply_to(message, "Эта команда доступна только администратору.")
+
+
+
+@bot.message_handler(commands=['encode_stats'])
+async def encode_stats(message):
+    if message.from_user.id != config.ADMIN_ID:
+        await outbound.reply_to(message, "Эта команда доступна только администратору.")
+        return
+
+    lines = media.processing_stats.summary()
+    if lines:
+        await outbound.send_message(
+            message.chat.id,
+            "Пути обработки видео с момента запуска:\n" + "\n".join(lines)
+        )
     else:
-        await bot.reply_to(message, "Эта команда доступна только администратору.")
+        await outbound.send_message(message.chat.id, "Видео ещё не обрабатывались.")
+
+
+
+@bot.message_handler(commands=['cache'])
+async def show_cache(message):
+    if message.from_user.id != config.ADMIN_ID:
+        await outbound.reply_to(message, "Эта команда доступна только администратору.")
+        return
+
+    try:
+        entries, hits = await asyncio.to_thread(result_cache.stats)
+        top = await asyncio.to_thread(result_cache.top, 10)
+    except Exception as e:
+        await outbound.send_message(message.chat.id, f"Ошибка при чтении кэша: {e}")
+        return
+
+    lines = [f"Кэш результатов: записей {entries}, повторных отправок {hits}"]
+    for item in top:
+        lines.append(
+            f"{item.hits} × {item.key} (частей: {len(item.file_ids)})"
+        )
+    await outbound.send_message(message.chat.id, "\n".join(lines))
+
+
+@bot.message_handler(commands=['cache_purge'])
+async def purge_cache(message):
+    if message.from_user.id != config.ADMIN_ID:
+        await outbound.reply_to(message, "Эта команда доступна только администратору.")
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await outbound.reply_to(message, "Использование: /cache_purge <ссылка> или /cache_purge all")
+        return
+
+    try:
+        if args[1].strip() == "all":
+            removed = await asyncio.to_thread(result_cache.purge)
+            await outbound.send_message(message.chat.id, f"Кэш очищен, удалено записей: {removed}.")
+        else:
+            key = normalize_url(args[1])
+            removed = await asyncio.to_thread(result_cache.delete, key)
+            await outbound.send_message(
+                message.chat.id,
+                f"Запись {key} удалена." if removed else f"Записи {key} нет в кэше."
+            )
+    except Exception as e:
+        await outbound.send_message(message.chat.id, f"Ошибка при очистке кэша: {e}")
 
 
 
@@ -413,112 +835,114 @@ def get_format_str(url):
         )
 
 
-#def download_with_options(url, use_tor=False):
-def download_with_options(url):
-    ydl_opts = {
+def get_ydl_opts(url, download_dir=None):
+    """Общие опции YoutubeDL для метаданных и скачивания."""
+    return {
         'format': get_format_str(url),
-        'outtmpl': f'{config.DOWNLOAD_DIR}/%(title)s.%(ext)s',
+        'outtmpl': f'{download_dir or config.DOWNLOAD_DIR}/%(title)s.%(ext)s',
         'quiet': True,
         'no_warnings': True,
+        'noprogress': True,
         'merge_output_format': 'mp4',
         'force_keyframes_at_cuts': True,
-        'overwrites': True,
+        # У каждой задачи своя папка, поэтому чужие файлы не перезапишем;
+        # а уже скачанные форматы и .part после перезапуска бота не качаются заново
+        'overwrites': False,
         'noplaylist': True,
         'no_sabr': True,
         'restrictfilenames': True,
         'geo_bypass': True,
+        'concurrent_fragment_downloads': 4,
         'retries': 5,
         'fragment_retries': 5,
         'continuedl': True,
     }
 
-#    if use_tor:
-#        ydl_opts['proxy'] = 'socks5://127.0.0.1:9050'
-#        ydl_opts['cookiefile'] = '/root/Margarine6_bot/web_auth_storage.txt'
-
-    with YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        video_path = sanitize_filepath(ydl.prepare_filename(info))
-        return process_video(video_path)
-
-
-#def download_video_file(url):
-#    try:
-#        return download_with_options(url)
-#    except Exception as e:
-#        print(f"[BOT] Ошибка при первой попытке скачивания: {e}")
-#        try:
-#            return download_with_options(url, use_tor=True)
-#        except Exception as e2:
-#            raise RuntimeError(f"[BOT] Ошибка даже через Tor: {e2}")
-        
-def download_video_file(url):
-    try:
-        return download_with_options(url)
-    except Exception as e:
-        raise RuntimeError(f"[BOT] Ошибка при скачивании видео: {e}")
-    
-def log(msg: str):
-    print(msg, flush=True)
 
+# Профили сети для скачивания: прокси и cookies
+DOWNLOAD_PROFILES = {
+    "default": {},
+    "tor": {"proxy": config.TOR_PROXY, "cookiefile": config.COOKIES_FILE},
+    "cookies": {"cookiefile": config.COOKIES_FILE},
+}
 
+# Тёплые экземпляры YoutubeDL в рабочих потоках вместо запуска yt-dlp на каждую задачу
+download_engine = DownloadEngine(
+    base_opts=get_ydl_opts(""),
+    workers=config.MAX_PARALLEL_DOWNLOADS,
+    profiles=DOWNLOAD_PROFILES,
+)
 
-def download_with_progress(url, bot, chat_id, status_message, download_dir):
-    log(f"[BOT] download_with_progress called for url={url}")
-    os.makedirs(download_dir, exist_ok=True)
-    output_template = os.path.join(download_dir, '%(title)s.%(ext)s')
-    format_str = get_format_str(url)
-
-    ytdlp_command = [
-        "yt-dlp",
-        "-f", format_str,
-        "-o", output_template,
-        "--merge-output-format", "mp4",
-        "--force-keyframes-at-cuts",
-        "--no-playlist",
-        "--restrict-filenames",
-        "--geo-bypass",
-        "--concurrent-fragments", "4",
-        "--retries", "5",
-        "--fragment-retries", "5",
-        "--continue",
-        url,
-    ]
 
-    log(f"[BOT] running command: {' '.join(ytdlp_command)}")
+async def resolve_download(url, profile="default"):
+    """
+    Стадия до скачивания: получает метаданные (extract_info(download=False)),
+    проверяет длительность и подбирает формат под лимит 50 МБ.
+    Возвращает (format_str, FormatChoice | None, info); info потом
+    передаётся в скачивание, чтобы не извлекать его второй раз.
+    Слишком длинные видео и трансляции отклоняются до передачи байтов.
+    """
+    started = time.monotonic()
+    info = await download_engine.extract_info(url, profile)
+    metrics.registry.observe("stage_seconds", time.monotonic() - started, stage="metadata")
+
+    if info.get("is_live"):
+        raise RuntimeError("Прямые трансляции не поддерживаются.")
+
+    duration = info.get("duration") or 0
+    if config.MAX_VIDEO_DURATION and duration > config.MAX_VIDEO_DURATION:
+        raise RuntimeError(
+            f"Видео слишком длинное ({duration // 60:.0f} мин). "
+            f"Максимум — {config.MAX_VIDEO_DURATION // 60} мин."
+        )
+
+    choice = format_selector.choose_format(info)
+    if choice is None:
+        log(f"[BOT] format selection: no size info for {url}, using default")
+        return get_format_str(url), None, info
 
-    process = subprocess.Popen(
-        ytdlp_command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1
+    log(
+        f"[BOT] format selection: {choice.format_id} "
+        f"~{choice.estimated_size / 1024 / 1024:.1f} MB {choice.height}p "
+        f"fits={choice.fits} compatible={choice.compatible}"
     )
+    # Если выбранные ID вдруг недоступны при скачивании — прежняя стратегия
+    return f"{choice.format_id}/{get_format_str(url)}", choice, info
 
-    output_lines = []
-    for line in process.stdout:
-        if not line.strip():
-            continue
-        text = line.rstrip("\n")
-        output_lines.append(text)
-        log(f"[yt-dlp] {text}")
 
-    process.wait()
-    log(f"[BOT] yt-dlp returncode={process.returncode}")
+def log(msg: str):
+    print(msg, flush=True)
+
 
-    if process.returncode != 0:
-        debug_output = "".join(output_lines)
-        log(f"[yt-dlp ERROR] output:\n{debug_output}")
-        raise RuntimeError("Загрузка завершилась с ошибкой (yt-dlp)")
+def _progress_reporter(flight, title):
+    """Колбэк percent → строка с полосой в статусе задачи (из любого потока)."""
+    def report(percent):
+        flight.update(progress_text(title, percent), parse_mode="Markdown")
+    return report
 
-    downloaded_files = [
-        f for f in os.listdir(download_dir)
-        if f.endswith(('.mp4', '.mkv'))
-    ]
-    if not downloaded_files:
-        raise RuntimeError("Не удалось найти загруженное видео после скачивания")
 
-    return os.path.join(download_dir, downloaded_files[0])
+def _download_progress_hook(flight, title="📥 Скачиваю видео"):
+    """
+    progress_hooks yt-dlp → статусные сообщения задачи. Частоту правок
+    ограничивает ProgressHub, здесь только считаем процент; без известного
+    размера полоса просто «бежит».
+    """
+    report = _progress_reporter(flight, title)
+    spinner_index = 0
+
+    def hook(status):
+        nonlocal spinner_index
+        if status.get("status") != "downloading":
+            return
+        total = status.get("total_bytes") or status.get("total_bytes_estimate")
+        downloaded = status.get("downloaded_bytes") or 0
+        if total:
+            report(downloaded * 100 / total)
+        else:
+            text, spinner_index = spinner_text(title, spinner_index)
+            flight.update(text, parse_mode="Markdown")
+
+    return hook
 
 
 
@@ -529,7 +953,7 @@ async def handle_download_request(message):
     # Проверка подписки (is_subscribed синхронный → уводим в поток)
     is_sub = await is_subscribed(message.from_user.id)
     if not is_sub:
-        await bot.reply_to(
+        await outbound.reply_to(
             message,
             "Бот бесплатный, но работает только для подписчиков "
             "моего телеграм канала: "
@@ -538,8 +962,8 @@ async def handle_download_request(message):
         )
         return
 
-    # Уведомление админа (notify_admin синхронный → в поток)
-    await notify_admin(
+    # Уведомление админа (в очередь с низким приоритетом)
+    notify_admin(
         message.from_user.id,
         message.from_user.username,
         message.text,
@@ -547,66 +971,715 @@ async def handle_download_request(message):
 
     url = message.text
 
-    # Первичное сообщение — его будем обновлять
-    status_message = await bot.reply_to(message, "🔄 Начинаю загрузку видео...")
+    # Это видео уже отправляли — отвечаем по file_id без скачивания
+    if await _reply_from_cache(message, url):
+        return
+
+    with _track_job():
+        await _process_url(message, url)
+
 
+@contextlib.contextmanager
+def _track_job():
+    """Текущая задача пользователя — в active_jobs, чтобы остановка бота её дождалась."""
+    task = asyncio.current_task()
+    active_jobs.add(task)
     try:
-        # 1. Скачивание с прогрессом (синхронная функция в отдельном потоке)
-        video_path = await asyncio.to_thread(
-            download_with_progress,
-            url,
-            bot,                 # объект бота можно прокинуть как есть
-            message.chat.id,
-            status_message,
-            config.DOWNLOAD_DIR,
-        )
+        yield
+    finally:
+        active_jobs.discard(task)
 
-        # 2. Обработка видео (process_video синхронный)
-        fixed_video_path, width, height = await asyncio.to_thread(
-            process_video,
-            video_path,
+
+async def _process_url(message, url, status_message=None, job=None):
+    """
+    Запускает пайплайн для ссылки или подключается к уже идущей задаче
+    с тем же видео (singleflight по ключу кэша). job — запись JobStore
+    задачи, которая продолжается после перезапуска бота.
+    """
+    flight, is_leader = inflight.join(normalize_url(url))
+    if not is_leader:
+        await _follow_flight(message, url, flight, status_message, job)
+        return
+
+    try:
+        # Backpressure: при переполнении очереди отказываем сразу
+        with scheduler.admit(message.from_user.id):
+            # Первичное сообщение — его будем обновлять
+            if status_message is None:
+                status_message = await outbound.reply_to(message, "🔄 Начинаю загрузку видео...")
+            flight.subscribe(message.chat.id, status_message.message_id)
+            if job is None:
+                job = await asyncio.to_thread(
+                    job_store.create, message.chat.id, message.from_user.id,
+                    message.from_user.username, message.message_id,
+                    status_message.message_id, url,
+                )
+            # Сам пайплайн — здесь же или в отдельном процессе-воркере
+            run_job = _run_on_worker if config.EXTERNAL_WORKERS else _run_download_job
+            result = await run_job(message, url, flight, status_message, job)
+        await _edit_own_status(message, status_message, "✅ Видео готово и отправлено.")
+        flight.resolve(result)
+    except SchedulerBusy as e:
+        # Снимаем задачу с реестра до первого await: новые запросы этой
+        # ссылки не должны подключаться к уже отказанной задаче
+        inflight.finish(flight)
+        flight.fail(e)
+        if job is not None:
+            await asyncio.to_thread(job_store.finish, job, str(e))
+        if status_message is not None:
+            await _edit_own_status(message, status_message, f"⏳ {e}")
+        else:
+            await outbound.reply_to(message, f"⏳ {e}")
+    except Exception as e:
+        # Ошибка уже показана всем подписчикам задачи
+        flight.fail(e)
+    finally:
+        inflight.finish(flight)
+
+
+async def _follow_flight(message, url, flight, status_message=None, job=None):
+    """Ждёт результат чужой задачи с тем же видео и отправляет его по file_id."""
+    log(f"[BOT] {message.from_user.id} joined in-flight job {flight.key}")
+    if status_message is None:
+        status_message = await outbound.reply_to(
+            message,
+            flight.status_text or "🔄 Это видео уже загружается, подключаю вас к задаче..."
+        )
+    flight.subscribe(message.chat.id, status_message.message_id)
+    if job is None:
+        # Тоже запоминаем: после перезапуска снова подключимся к задаче
+        job = await asyncio.to_thread(
+            job_store.create, message.chat.id, message.from_user.id,
+            message.from_user.username, message.message_id,
+            status_message.message_id, url,
         )
 
-        # 3. Отправка видео пользователю (send_video_to_user синхронный)
-        await send_video_to_user(
-            bot,
-            message.chat.id,
-            message.from_user.id,
-            message.from_user.username,
-            url,
-            fixed_video_path,
-            width,
-            height,
-            config.ADMIN_ID,
+    try:
+        result = await flight.wait()
+    except SchedulerBusy as e:
+        if e.per_user:
+            # Отказ касается лимита ведущего, а не этого пользователя —
+            # запускаем задачу сами
+            await _process_url(message, url, status_message, job)
+            return
+        await asyncio.to_thread(job_store.finish, job, str(e))
+        await _edit_own_status(message, status_message, f"⏳ {e}")
+        return
+    except Exception as e:
+        await asyncio.to_thread(job_store.finish, job, str(e))
+        return
+
+    if result is None:
+        # Результат ведущей задачи нельзя переслать — запускаем свою
+        await _process_url(message, url, status_message, job)
+        return
+
+    try:
+        await send_cached_video(
+            outbound, message.chat.id, result.file_ids,
+            result.width, result.height, result.duration,
         )
+        await asyncio.to_thread(job_store.finish, job)
+        await _edit_own_status(message, status_message, "✅ Видео готово и отправлено.")
+    except Exception as e:
+        await asyncio.to_thread(job_store.finish, job, str(e))
+        await _edit_own_status(message, status_message, f"🚫 Ошибка при отправке: {e}")
+
 
-        # 4. Обновляем статус (уже async‑метод)
-        await bot.edit_message_text(
-            "✅ Видео готово и отправлено.",
+async def _edit_own_status(message, status_message, text):
+    # Сначала снимаем отложенные правки прогресса, чтобы они не затёрли итог
+    await progress_hub.finish(message.chat.id, status_message.message_id)
+    try:
+        await outbound.edit_message_text(
+            text,
             chat_id=message.chat.id,
             message_id=status_message.message_id,
         )
+    except Exception:
+        await outbound.reply_to(message, text)
+
+
+async def _reply_from_cache(message, url, status_message=None):
+    """
+    Отправляет видео из кэша результатов. True — если запрос обработан
+    (в том числе отправкой не всех частей), False — видео нужно качать.
+    status_message — статус задачи, в котором показываем итог.
+    """
+    cache_key = normalize_url(url)
+    try:
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+    except Exception as e:
+        log(f"[BOT] result cache lookup failed for {cache_key}: {e}")
+        return False
+    if cached is None:
+        metrics.registry.inc("cache_requests", cache="result", result="miss")
+        return False
+
+    metrics.registry.inc("cache_requests", cache="result", result="hit")
+    try:
+        await send_cached_video(
+            outbound, message.chat.id, cached.file_ids,
+            cached.width, cached.height, cached.duration,
+        )
+    except CachedSendError as e:
+        # Первые части уже у пользователя: полная перезагрузка отправила бы
+        # их повторно. Забываем запись и просим прислать ссылку заново
+        log(f"[BOT] cached file_id failed for {cache_key}: {e}")
+        await asyncio.to_thread(result_cache.delete, cache_key)
+        text = (
+            f"⚠️ Удалось отправить только {e.sent} из {e.total} частей. "
+            "Пришлите ссылку ещё раз — видео загрузится заново."
+        )
+        if status_message is not None:
+            await _edit_own_status(message, status_message, text)
+        else:
+            await outbound.reply_to(message, text)
+        return True
+    except Exception as e:
+        # file_id мог стать недействительным — забываем его и качаем заново
+        log(f"[BOT] cached file_id failed for {cache_key}: {e}")
+        await asyncio.to_thread(result_cache.delete, cache_key)
+        return False
+
+    log(f"[BOT] result cache hit {cache_key} (hits={cached.hits})")
+    if status_message is not None:
+        await _edit_own_status(message, status_message, "✅ Видео готово и отправлено.")
+    return True
+
+
+@contextlib.asynccontextmanager
+async def _pipeline_stage(stage, on_wait):
+    """
+    Слот стадии в планировщике. Ожидание слота и время самой стадии
+    идут в метрики, время стадии — ещё и в сводку для администратора.
+    """
+    queued = time.monotonic()
+    async with scheduler.stage(stage, on_wait):
+        started = time.monotonic()
+        metrics.registry.observe("queue_wait_seconds", started - queued, stage=stage)
+        yield
+        elapsed = time.monotonic() - started
+        metrics.registry.observe("stage_seconds", elapsed, stage=stage)
+        admin_digest.timing(stage, elapsed)
+
+
+STAGE_TITLES = {
+    "download": "загрузку",
+    "transcode": "обработку",
+    "upload": "отправку",
+}
+
+
+def _part_recorder(job):
+    """Колбэк отправки частей: каждая отправленная часть сразу пишется в JobStore."""
+    async def on_part_uploaded(file_id, end):
+        await asyncio.to_thread(job_store.add_part, job, file_id, end)
+    return on_part_uploaded
+
+
+def _queue_notifier(flight):
+    """Колбэк планировщика: показывает позицию в очереди в статусных сообщениях."""
+    async def on_wait(stage, position):
+        flight.update(
+            f"⏳ В очереди на {STAGE_TITLES.get(stage, stage)}: позиция {position}",
+        )
+    return on_wait
+
+
+async def _encode_and_send_parts(message, url, video_path, source_info, job,
+                                 on_wait, on_progress=None):
+    """
+    Однопроходное кодирование в части с отправкой по мере готовности.
+    Каждая часть отправляется через слот upload, как и обычные видео.
+    """
+    started = time.monotonic()
+    processing_path = media.choose_processing_path(source_info)
+    plan = media.plan_segments(source_info, processing_path)
+    log(
+        f"[BOT] segment streaming path={processing_path} "
+        f"segment_time={plan.segment_time}s file={video_path}"
+    )
+
+    result = await encode_and_send_segments(
+        outbound,
+        message.chat.id,
+        message.from_user.id,
+        message.from_user.username,
+        url,
+        video_path,
+        source_info,
+        plan,
+        admin_digest,
+        on_progress=on_progress,
+        uploaded_parts=job.parts,
+        on_part_uploaded=_part_recorder(job),
+        upload_slot=lambda: _pipeline_stage("upload", on_wait),
+    )
+
+    media.processing_stats.record(
+        media.PATH_FULL if plan.reencode else processing_path,
+        time.monotonic() - started,
+        source_info.duration,
+    )
+    return result
+
+
+def _estimate_footprint(info, choice):
+    """Пиковый объём задачи на диске по метаданным: исходник, перекодирование, части."""
+    return estimate_footprint(
+        estimate_source_size(info, choice, config.DISK_ESTIMATE_KBPS),
+        media.TELEGRAM_LIMIT_MB * 1024 * 1024,
+    )
 
-        # 5. Удаляем файл после отправки (на всякий случай)
+
+async def _reserve_disk(job_id, workspace, footprint, flight):
+    """
+    Резервирует место под задачу в disk_budget; если его мало — задача
+    ждёт с сообщением в статусе. Ожидание — в queue_wait_seconds{stage="disk"}.
+    """
+    async def on_wait(size, headroom):
+        log(
+            f"[BOT] job {job_id} deferred: needs ~{size / 1024 / 1024:.0f} MB, "
+            f"available {max(0, headroom) / 1024 / 1024:.0f} MB"
+        )
+        flight.update(
+            f"⏳ На сервере мало места, задача отложена (нужно ~{size / 1024 / 1024:.0f} MB)..."
+        )
+
+    started = time.monotonic()
+    await disk_budget.acquire(job_id, workspace.path, footprint, on_wait)
+    metrics.registry.observe("queue_wait_seconds", time.monotonic() - started, stage="disk")
+
+
+def _failure_text(error):
+    return f"🚫 Ошибка при скачивании: {error}"
+
+
+async def _run_download_job(message, url, flight, status_message, job):
+    """
+    Скачивание → обработка → отправка. Возвращает SharedResult для
+    подписчиков задачи (или None), ошибки показывает всем и пробрасывает.
+
+    Стадия задачи, скачанный исходник, готовый файл и отправленные части
+    пишутся в JobStore. Задача, прерванная остановкой бота, продолжается
+    после перезапуска: готовый файл сразу отправляется, скачанный —
+    обрабатывается, недокачанный (.part) — докачивается.
+    """
+    on_wait = _queue_notifier(flight)
+
+    # Отдельная папка под задачу: параллельные загрузки не пересекаются.
+    # Имя папки — ID задачи, чтобы после перезапуска найти её файлы
+    workspace = JobWorkspace(config.DOWNLOAD_DIR, job.job_id)
+    await asyncio.to_thread(workspace.create)
+    log(f"[BOT] job {workspace.job_id} workspace: {workspace.path} stage={job.stage}")
+
+    finished = False
+    try:
+        video_path = None
+        fixed_video_path = None
+        streamed = None
+        if job.output_path and os.path.exists(job.output_path):
+            # Перезапуск во время отправки: файл уже готов
+            fixed_video_path = job.output_path
+            video_info = await asyncio.to_thread(media.probe_media, fixed_video_path)
+        elif job.source_path and os.path.exists(job.source_path):
+            # Перезапуск во время обработки: исходник уже скачан
+            video_path = job.source_path
+        else:
+            # 1. Скачивание с прогрессом (в рабочем потоке движка yt-dlp)
+            await asyncio.to_thread(job_store.set_stage, job, STAGE_DOWNLOADING)
+            # Сначала метаданные: формат под лимит и отсев слишком длинных видео
+            flight.update("🔎 Получаю информацию о видео...")
+            format_str, choice, info = await resolve_download(url)
+            # Место под исходник, перекодированный файл и части — до слота
+            # скачивания: ждущая места задача не должна держать его
+            await _reserve_disk(job.job_id, workspace, _estimate_footprint(info, choice), flight)
+
+            stream_format = find_stream_format(info, choice)
+            if stream_format is not None:
+                # Один файл по HTTP: качаем прямо в ffmpeg, кодирование идёт
+                # параллельно. Упор в кодирование — поэтому держим только слот
+                # обработки, слот скачивания остаётся свободным
+                try:
+                    async with _pipeline_stage("transcode", on_wait):
+                        streamed = await stream_process_video(
+                            stream_format, info, workspace.path,
+                            _download_progress_hook(flight, "⚙️ Скачиваю и обрабатываю видео"),
+                        )
+                except StreamRejected as e:
+                    # Прочитан только первый блок, ffmpeg не запускался
+                    log(f"[BOT] job {workspace.job_id} not streamable, fallback to file: {e}")
+                    streamed = None
+                except Exception as e:
+                    log(f"[BOT] job {workspace.job_id} streaming failed, fallback to file: {e}")
+                    await asyncio.to_thread(_clear_dir, workspace.path)
+                    streamed = None
+
+            if streamed is None:
+                async with _pipeline_stage("download", on_wait):
+                    if choice is not None and not choice.fits:
+                        flight.update(
+                            "📥 Скачиваю видео... (оно больше 50 МБ, "
+                            "сожму его или разделю на части)"
+                        )
+                    else:
+                        flight.update("📥 Скачиваю видео...")
+
+                    video_path = await download_engine.download(
+                        url,
+                        workspace.path,
+                        format_str=format_str,
+                        info=info,
+                        on_progress=_download_progress_hook(flight),
+                    )
+                    log(f"[BOT] job {workspace.job_id} downloaded: {video_path}")
+                    metrics.registry.observe(
+                        "stage_bytes", await asyncio.to_thread(os.path.getsize, video_path),
+                        stage="download",
+                    )
+
+        # 2. Обработка видео (process_video синхронный)
+        if streamed is not None:
+            fixed_video_path, video_info = streamed
+        elif video_path is not None:
+            async with _pipeline_stage("transcode", on_wait):
+                await asyncio.to_thread(
+                    job_store.set_stage, job, STAGE_ENCODING, source_path=video_path
+                )
+                flight.update("🎞 Обрабатываю видео...")
+                source_info = await asyncio.to_thread(media.probe_media, video_path)
+
+                if config.SEGMENT_STREAMING and media.needs_split(
+                    source_info, config.FIT_TO_LIMIT, config.FIT_MIN_VIDEO_KBPS
+                ):
+                    # Длинное видео: кодируем сразу частями и отправляем каждую
+                    # по готовности — без промежуточного *_fixed.mp4
+                    flight.update("🎞 Обрабатываю и отправляю видео частями...")
+                    file_ids, width, height = await _encode_and_send_parts(
+                        message, url, video_path, source_info, job, on_wait,
+                        _progress_reporter(flight, "🎞 Обрабатываю и отправляю частями"),
+                    )
+                    duration = int(source_info.duration)
+                else:
+                    fixed_video_path, video_info = await asyncio.to_thread(
+                        process_video,
+                        video_path,
+                        _progress_reporter(flight, "🎞 Обрабатываю видео"),
+                    )
+
+        # 3. Отправка видео пользователю
+        if fixed_video_path is not None:
+            async with _pipeline_stage("upload", on_wait):
+                await asyncio.to_thread(
+                    job_store.set_stage, job, STAGE_UPLOADING, output_path=fixed_video_path
+                )
+                flight.update("📤 Отправляю видео...")
+                file_ids = await send_video_to_user(
+                    outbound,
+                    message.chat.id,
+                    message.from_user.id,
+                    message.from_user.username,
+                    url,
+                    fixed_video_path,
+                    video_info.width,
+                    video_info.height,
+                    admin_digest,
+                    media_info=video_info,
+                    on_progress=_progress_reporter(flight, "📤 Отправляю видео"),
+                    uploaded_parts=job.parts,
+                    on_part_uploaded=_part_recorder(job),
+                )
+            metrics.registry.observe("stage_bytes", video_info.size, stage="upload")
+            width, height = video_info.width, video_info.height
+            duration = int(video_info.duration)
+
+        # Запоминаем file_id, чтобы следующий такой же запрос не качал заново
+        if file_ids:
+            try:
+                await asyncio.to_thread(
+                    result_cache.put,
+                    normalize_url(url),
+                    url,
+                    file_ids,
+                    width,
+                    height,
+                    duration,
+                )
+            except Exception as e:
+                log(f"[BOT] result cache store failed for {url}: {e}")
+
+        result = SharedResult(file_ids, width, height, duration) if file_ids else None
+        await asyncio.to_thread(
+            job_store.finish, job, result=dataclasses.asdict(result) if result else None
+        )
+        finished = True
+
+        # 4. Удаляем файл после отправки (на всякий случай)
         await asyncio.to_thread(
             os.remove,
             fixed_video_path,
-        ) if os.path.exists(fixed_video_path) else None
+        ) if fixed_video_path and os.path.exists(fixed_video_path) else None
+
+        return result
+
+    except asyncio.CancelledError:
+        # Остановка бота: файлы и запись остаются, задача продолжится после перезапуска
+        log(f"[BOT] job {workspace.job_id} interrupted at stage {job.stage}")
+        flight.update("⏸ Бот перезапускается — задача продолжится автоматически.")
+        raise
+
+    except Exception as e:
+        # Если что-то пошло не так — редактируем статусные сообщения всех подписчиков
+        log(f"[BOT] job {workspace.job_id} failed: {e}")
+        finished = True
+        flight.update(_failure_text(e))
+        await asyncio.to_thread(job_store.finish, job, str(e))
+        raise
+
+    finally:
+        disk_budget.release(job.job_id)
+        # Папка задачи остаётся на диске только для продолжения после перезапуска
+        if finished:
+            await asyncio.to_thread(workspace.cleanup)
+
+
+async def _run_on_worker(message, url, flight, status_message, job):
+    """
+    Режим EXTERNAL_WORKERS: задача уходит в общую очередь, её выполняет
+    процесс-воркер (worker.py). Здесь только пересылаем его статус
+    подписчикам и ждём результат.
+    """
+    await asyncio.to_thread(job_store.dispatch, job)
+    flight.update("⏳ Задача в очереди на обработку...")
+    last_status = None
+    while True:
+        await asyncio.sleep(config.WORKER_POLL_INTERVAL)
+        record = await asyncio.to_thread(job_store.get, job.job_id)
+        if record is None:
+            raise RuntimeError("Задача пропала из очереди")
+        if record.status_text and record.status_text != last_status:
+            last_status = record.status_text
+            kwargs = {"parse_mode": record.status_parse_mode} if record.status_parse_mode else {}
+            flight.update(record.status_text, **kwargs)
+        if record.stage == STAGE_DONE:
+            return SharedResult(**record.result) if record.result else None
+        if record.stage == STAGE_FAILED:
+            log(f"[BOT] job {job.job_id} failed on worker {record.worker}: {record.error}")
+            flight.update(_failure_text(record.error))
+            raise RuntimeError(record.error)
+
+
+def _message_from_record(record):
+    """Минимальный аналог Message для задачи, поднятой из JobStore."""
+    return SimpleNamespace(
+        chat=SimpleNamespace(id=record.chat_id),
+        from_user=SimpleNamespace(id=record.user_id, username=record.username),
+        message_id=record.message_id,
+        text=record.url,
+    )
+
+
+async def _resume_job(message, status_message, record):
+    with _track_job():
+        # Ожидавшие чужую задачу могли остаться без неё — тогда, возможно, видео уже в кэше
+        if record.stage == STAGE_QUEUED and await _reply_from_cache(
+            message, record.url, status_message
+        ):
+            await asyncio.to_thread(job_store.finish, record)
+            return
+        await _process_url(message, record.url, status_message, record)
+
+
+async def _resume_jobs():
+    """Поднимает задачи, прерванные остановкой бота (сначала самые продвинутые)."""
+    purged = await asyncio.to_thread(job_store.purge, config.JOB_HISTORY_TTL)
+    if purged:
+        log(f"[BOT] job store: removed {purged} old jobs")
+    records = await asyncio.to_thread(job_store.unfinished)
+    for record in records:
+        message = _message_from_record(record)
+        status_message = SimpleNamespace(message_id=record.status_message_id)
+        if record.remote and config.EXTERNAL_WORKERS:
+            # Задачу выполняет воркер, перезапуск фронтенда её не прервал
+            log(f"[BOT] following worker job {record.job_id} stage={record.stage}")
+            asyncio.create_task(_resume_job(message, status_message, record))
+            continue
+        attempts = await asyncio.to_thread(job_store.mark_resumed, record)
+        if attempts > config.JOB_MAX_RESUMES:
+            # Задача раз за разом не переживает перезапуск — не зацикливаемся
+            log(f"[BOT] job {record.job_id} dropped after {attempts - 1} resumes")
+            await asyncio.to_thread(job_store.finish, record, "слишком много перезапусков")
+            await asyncio.to_thread(JobWorkspace(config.DOWNLOAD_DIR, record.job_id).cleanup)
+            await _edit_own_status(
+                message, status_message,
+                "🚫 Не удалось завершить задачу после перезапуска бота. "
+                "Отправьте ссылку ещё раз."
+            )
+            continue
+
+        log(f"[BOT] resuming job {record.job_id} stage={record.stage} url={record.url}")
+        progress_hub.set(
+            record.chat_id, record.status_message_id,
+            "🔄 Бот перезапущен, продолжаю задачу...",
+        )
+        asyncio.create_task(_resume_job(message, status_message, record))
+
+
+async def _stop_polling(polling):
+    polling.cancel()
+    await asyncio.gather(polling, return_exceptions=True)
+    # Подтверждаем последнюю полученную пачку, иначе Telegram пришлёт её снова
+    try:
+        await bot.get_updates(offset=bot.offset, limit=1, timeout=0)
+    except Exception as e:
+        log(f"[BOT] shutdown: failed to confirm updates: {e}")
+
+
+async def _shutdown():
+    """
+    Плавная остановка по SIGTERM (обновления уже не принимаются): текущим
+    задачам даём DRAIN_TIMEOUT секунд, остальные прерываем — они
+    продолжатся после перезапуска.
+    """
+    pending = set(active_jobs)
+    if pending:
+        log(f"[BOT] shutdown: waiting up to {config.DRAIN_TIMEOUT}s for {len(pending)} jobs")
+        _, pending = await asyncio.wait(pending, timeout=config.DRAIN_TIMEOUT)
+    if pending:
+        log(f"[BOT] shutdown: interrupting {len(pending)} jobs")
+        for task in pending:
+            task.cancel()
+    # Потоки кодирования и скачивания отменой задачи не остановить
+    media.terminate_ffmpeg()
+    download_engine.shutdown()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    await progress_hub.drain(5)
+    admin_digest.flush()
+    await outbound.drain(5)
+    try:
+        await bot.close_session()
+    except Exception as e:
+        # Сессии может не быть, если процесс ни разу не обращался к Bot API
+        log(f"[BOT] close_session failed: {e}")
+    log("[BOT] stopped")
+
+
+# chat_member по умолчанию не приходит — без него кэш подписок живёт только по TTL
+ALLOWED_UPDATES = ["message", "chat_member"]
 
+
+async def _start_webhook():
+    """
+    Webhook-режим: поднимает HTTP-сервер и регистрирует его в Telegram.
+    Возвращает WebhookServer или None, если не получилось (тогда — polling).
+    """
+    # Без заданного секрета — случайный: setWebhook вызывается при каждом запуске
+    secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(
+        bot, secret,
+        path=config.WEBHOOK_PATH,
+        host=config.WEBHOOK_HOST,
+        port=config.WEBHOOK_PORT,
+    )
+    try:
+        await server.start()
+        await server.register(config.WEBHOOK_URL, ALLOWED_UPDATES)
     except Exception as e:
-        # Если что-то пошло не так — редактируем статусное сообщение
+        log(f"[BOT] webhook setup failed, falling back to polling: {e}")
+        admin_digest.error(f"Webhook не запустился, работаю через polling: {e}")
+        await server.stop()
+        return None
+    log(
+        f"[BOT] webhook mode: {config.WEBHOOK_URL.rstrip('/')}{config.WEBHOOK_PATH} "
+        f"→ {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}"
+    )
+    return server
+
+
+async def _janitor_loop():
+    """
+    Фоновая очистка DOWNLOAD_DIR: остатки упавших и брошенных задач
+    старше JANITOR_MAX_AGE. Папки незавершённых задач (в том числе тех,
+    что выполняют воркеры) и задач с резервом места не трогаются.
+    """
+    while True:
         try:
-            await bot.edit_message_text(
-                f"🚫 Ошибка при скачивании: {e}",
-                chat_id=message.chat.id,
-                message_id=status_message.message_id,
+            keep = await asyncio.to_thread(job_store.active_ids)
+            removed, freed = await asyncio.to_thread(
+                downloads_manager.sweep_orphans,
+                config.DOWNLOAD_DIR,
+                config.JANITOR_MAX_AGE,
+                keep | disk_budget.job_ids(),
             )
-        except Exception:
-            await bot.reply_to(message, f"🚫 Ошибка при скачивании: {e}")
+            if removed:
+                metrics.registry.inc("janitor_removed_bytes", freed)
+                log(
+                    f"[BOT] janitor: removed {len(removed)} items, "
+                    f"freed {freed / 1024 / 1024:.1f} MB: "
+                    + ", ".join(entry.name for entry in removed[:10])
+                )
+        except Exception as e:
+            log(f"[BOT] janitor failed: {e}")
+        await asyncio.sleep(config.JANITOR_INTERVAL)
 
 
+async def start_metrics_server(port):
+    """Эндпоинт /metrics на METRICS_HOST:port; None — если выключен или не поднялся."""
+    if not port:
+        return None
+    server = metrics.MetricsServer(metrics.registry, config.METRICS_HOST, port)
+    try:
+        await server.start()
+    except OSError as e:
+        log(f"[BOT] metrics endpoint failed on port {port}: {e}")
+        return None
+    log(f"[BOT] metrics: http://{config.METRICS_HOST}:{port}/metrics")
+    return server
+
+
+async def _serve():
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    if config.EXTERNAL_WORKERS:
+        # Бот и воркеры шлют запросы с одним токеном — лимиты делятся между процессами
+        outbound.share_limits(config.WORKER_PROCESSES + 1)
+    await _resume_jobs()
+    metrics_server = await start_metrics_server(config.METRICS_PORT)
+    # После _resume_jobs: папки поднятых задач уже среди незавершённых
+    janitor = asyncio.create_task(_janitor_loop()) if config.JANITOR_INTERVAL else None
+
+    webhook = await _start_webhook() if config.WEBHOOK_URL else None
+    if webhook is not None:
+        await stop.wait()
+        log("[BOT] shutting down")
+        # Webhook в Telegram не снимаем: пока бот перезапускается,
+        # Telegram копит обновления и доставит их новому процессу
+        await webhook.stop()
+    else:
+        # getUpdates не работает, пока у бота установлен webhook
+        try:
+            await bot.delete_webhook()
+        except Exception as e:
+            log(f"[BOT] delete_webhook failed: {e}")
+        polling = asyncio.create_task(bot.infinity_polling(allowed_updates=ALLOWED_UPDATES))
+        stopping = asyncio.create_task(stop.wait())
+        await asyncio.wait({polling, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        log("[BOT] shutting down")
+        await _stop_polling(polling)
+
+    if janitor is not None:
+        janitor.cancel()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await _shutdown()
 
 
 def main():
-    # для AsyncTeleBot нужно вызывать асинхронный polling
-    asyncio.run(bot.infinity_polling())  # или bot.polling(), но infinity_polling рекомендован[web:70]
+    # Обновления — через webhook (WEBHOOK_URL) или long polling; SIGTERM (systemctl
+    # restart) завершает работу плавно, незавершённые задачи продолжатся после запуска
+    asyncio.run(_serve())
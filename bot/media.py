@@ -0,0 +1,587 @@
+import json
+import os
+import subprocess
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, replace
+
+from bot import metrics
+
+
+# Пути обработки видео
+PATH_REMUX = "remux"          # только пересборка контейнера (-c copy)
+PATH_AUDIO = "audio"          # видео копируем, перекодируем только звук
+PATH_FULL = "full"            # полное перекодирование H.264 + AAC
+PATH_FIT = "fit"              # перекодирование под лимит размера Telegram
+
+# Лимит Telegram на загрузку файла ботом
+TELEGRAM_LIMIT_MB = 50
+
+# Минимальный битрейт видео (кбит/с), при котором ещё имеет смысл держать высоту
+FIT_HEIGHT_LADDER = (
+    (720, 1500),
+    (480, 800),
+    (360, 0),
+)
+
+# Что Telegram проигрывает без перекодирования
+TELEGRAM_VIDEO_CODECS = {"h264"}
+TELEGRAM_AUDIO_CODECS = {"aac"}
+TELEGRAM_PIX_FMTS = {"yuv420p", "yuvj420p"}
+
+
+def ffprobe_json(path):
+    """
+    Запускает ffprobe и возвращает JSON с format и streams.
+    """
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_format", "-show_streams",
+        "-of", "json", path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+# Запущенные процессы ffmpeg: при остановке бота их нужно прервать,
+# иначе рабочие потоки (и выход из процесса) ждут окончания кодирования
+_ffmpeg_processes = set()
+_ffmpeg_lock = threading.Lock()
+
+
+def run_ffmpeg(cmd, duration=0, on_progress=None):
+    """
+    Запускает ffmpeg (cmd[0] == "ffmpeg") и ждёт завершения. Если передан
+    on_progress, ffmpeg пишет машиночитаемый прогресс (-progress pipe:1),
+    и колбэк получает процент обработанной длительности.
+    """
+    with_progress = on_progress is not None and duration
+    if with_progress:
+        cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE if with_progress else None,
+        text=True,
+    )
+    with _ffmpeg_lock:
+        _ffmpeg_processes.add(process)
+    try:
+        if with_progress:
+            for line in process.stdout:
+                key, _, value = line.strip().partition("=")
+                # out_time_ms исторически тоже в микросекундах
+                if key in ("out_time_us", "out_time_ms") and value.isdigit():
+                    on_progress(min(100.0, int(value) / 1_000_000 * 100 / duration))
+        returncode = metrics.wait_process(process, "ffmpeg")
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        with _ffmpeg_lock:
+            _ffmpeg_processes.discard(process)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def terminate_ffmpeg():
+    """Прерывает все запущенные через run_ffmpeg процессы (остановка бота)."""
+    with _ffmpeg_lock:
+        processes = list(_ffmpeg_processes)
+    for process in processes:
+        process.kill()
+    return len(processes)
+
+
+def _first_stream(probe, codec_type):
+    for stream in probe.get("streams", []):
+        if stream.get("codec_type") != codec_type:
+            continue
+        # Обложки в mp4/mkv тоже видеопотоки — пропускаем их
+        if stream.get("disposition", {}).get("attached_pic"):
+            continue
+        return stream
+    return None
+
+
+def _rotation(stream):
+    rotate = stream.get("tags", {}).get("rotate")
+    if rotate is None:
+        for side_data in stream.get("side_data_list", []):
+            if "rotation" in side_data:
+                rotate = side_data["rotation"]
+                break
+    try:
+        return int(float(rotate or 0)) % 360
+    except (TypeError, ValueError):
+        return 0
+
+
+# Префиксы кодеков yt-dlp (RFC 6381) → имена ffprobe
+_CODEC_PREFIXES = (
+    ("avc", "h264"), ("h264", "h264"),
+    ("hvc", "hevc"), ("hev", "hevc"), ("h265", "hevc"),
+    ("vp09", "vp9"), ("vp9", "vp9"), ("vp8", "vp8"),
+    ("av01", "av1"),
+    ("mp4a", "aac"), ("aac", "aac"),
+    ("opus", "opus"), ("vorbis", "vorbis"), ("mp3", "mp3"),
+)
+
+
+def _normalize_codec(codec):
+    if not codec or codec == "none":
+        return None
+    codec = codec.lower()
+    for prefix, name in _CODEC_PREFIXES:
+        if codec.startswith(prefix):
+            return name
+    return codec
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """
+    Всё, что пайплайну нужно знать о файле: кодеки, размеры, длительность,
+    битрейт и размер. Считается один раз и передаётся дальше по стадиям.
+    """
+
+    path: str
+    format_name: str = ""
+    duration: float = 0.0
+    size: int = 0
+    bit_rate: int = 0
+    width: int = 0
+    height: int = 0
+    video_codec: str | None = None
+    audio_codec: str | None = None
+    pix_fmt: str | None = None
+
+    @classmethod
+    def from_probe(cls, path, probe):
+        fmt = probe.get("format", {})
+        video = _first_stream(probe, "video") or {}
+        audio = _first_stream(probe, "audio") or {}
+
+        width = int(video.get("width") or 0)
+        height = int(video.get("height") or 0)
+        # Вертикальные ролики с телефона хранятся повёрнутыми
+        if _rotation(video) in (90, 270):
+            width, height = height, width
+
+        duration = float(fmt.get("duration") or video.get("duration") or 0)
+        size = int(fmt.get("size") or 0)
+        bit_rate = int(fmt.get("bit_rate") or 0)
+        if not bit_rate and duration:
+            bit_rate = int(size * 8 / duration)
+
+        return cls(
+            path=path,
+            format_name=fmt.get("format_name", ""),
+            duration=duration,
+            size=size,
+            bit_rate=bit_rate,
+            width=width,
+            height=height,
+            video_codec=video.get("codec_name"),
+            audio_codec=audio.get("codec_name"),
+            pix_fmt=video.get("pix_fmt"),
+        )
+
+    @classmethod
+    def from_format(cls, fmt, duration):
+        """
+        MediaInfo по метаданным формата yt-dlp — когда файла на диске ещё
+        нет (потоковая обработка). Размер — оценка из filesize/tbr.
+        """
+        size = fmt.get("filesize") or fmt.get("filesize_approx") or 0
+        tbr = fmt.get("tbr") or 0
+        if not size and tbr and duration:
+            size = tbr * 1000 / 8 * duration
+        video_codec = _normalize_codec(fmt.get("vcodec"))
+        return cls(
+            path=fmt.get("url", ""),
+            format_name=fmt.get("ext", ""),
+            duration=float(duration or 0),
+            size=int(size),
+            bit_rate=int(tbr * 1000) if tbr else 0,
+            width=int(fmt.get("width") or 0),
+            height=int(fmt.get("height") or 0),
+            video_codec=video_codec,
+            audio_codec=_normalize_codec(fmt.get("acodec")),
+            # 10-bit H.264 в вебе почти не встречается
+            pix_fmt="yuv420p" if video_codec == "h264" else None,
+        )
+
+    @property
+    def size_mb(self):
+        return self.size / (1024 * 1024)
+
+    def derive(self, path, **changes):
+        """
+        MediaInfo результата кодирования без повторного ffprobe:
+        размер берётся с диска, остальное известно из параметров кодирования.
+        """
+        size = os.path.getsize(path)
+        bit_rate = int(size * 8 / self.duration) if self.duration else 0
+        info = replace(
+            self, path=path, size=size, bit_rate=bit_rate,
+            format_name="mov,mp4,m4a,3gp,3g2,mj2", **changes
+        )
+        _cache_put(info)
+        return info
+
+
+_CACHE_SIZE = 256
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_key(path):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+
+def _cache_put(info):
+    try:
+        key = _cache_key(info.path)
+    except OSError:
+        return
+    with _cache_lock:
+        _cache[key] = info
+        _cache.move_to_end(key)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def probe_media(path):
+    """
+    MediaInfo для файла. Повторные вызовы для неизменившегося файла
+    не запускают ffprobe — результат берётся из кэша.
+    """
+    key = _cache_key(path)
+    with _cache_lock:
+        info = _cache.get(key)
+        if info is not None:
+            _cache.move_to_end(key)
+            return info
+
+    info = MediaInfo.from_probe(path, ffprobe_json(path))
+    _cache_put(info)
+    return info
+
+
+def pipe_readable(head):
+    """
+    Можно ли отдать файл ffmpeg через pipe, судя по первым байтам.
+    MP4/MOV без faststart (mdat раньше moov) ffmpeg из pipe не прочитает:
+    индекс лежит в конце, а перемотать поток нельзя. Другие контейнеры
+    и MP4, где moov не нашёлся в head, считаем подходящими.
+    """
+    if head[4:8] != b"ftyp":
+        return True
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box = head[offset + 4:offset + 8]
+        if box == b"moov":
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                break
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            # size 0 — бокс до конца файла, дальше заголовков нет
+            break
+        offset += size
+    return True
+
+
+def choose_processing_path(info):
+    """
+    Решает, как довести файл до вида, который понимает Telegram:
+    PATH_REMUX, PATH_AUDIO или PATH_FULL.
+    """
+    if info.video_codec is None:
+        return PATH_FULL
+
+    video_ok = (
+        info.video_codec in TELEGRAM_VIDEO_CODECS
+        and info.pix_fmt in TELEGRAM_PIX_FMTS
+    )
+    if not video_ok:
+        return PATH_FULL
+
+    audio_ok = info.audio_codec is None or info.audio_codec in TELEGRAM_AUDIO_CODECS
+    if not audio_ok:
+        return PATH_AUDIO
+
+    # Кодеки подходят — даже mkv/webm достаточно пересобрать в MP4 без перекодирования
+    return PATH_REMUX
+
+
+def ffmpeg_args_for_path(path):
+    """Аргументы кодеков ffmpeg для выбранного пути обработки."""
+    if path == PATH_REMUX:
+        return ["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"]
+    if path == PATH_AUDIO:
+        return [
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-c:v", "copy",
+            "-c:a", "aac", "-b:a", "128k",
+        ]
+    return [
+        "-c:v", "libx264",             # Видео кодек
+        "-preset", "fast",             # Скорость кодирования
+        "-crf", "23",                  # Качество (меньше = лучше)
+        "-pix_fmt", "yuv420p",         # Telegram не играет 10-bit / 4:4:4
+        "-c:a", "aac",                 # Аудио кодек
+        "-b:a", "128k",                # Битрейт аудио
+    ]
+
+
+@dataclass(frozen=True)
+class FitPlan:
+    """Параметры кодирования, при которых видео помещается в один файл."""
+
+    video_kbps: int
+    audio_kbps: int
+    width: int
+    height: int
+
+
+def _scaled_size(info, short_side):
+    """Размеры после уменьшения короткой стороны до short_side (чётные)."""
+    if info.width <= info.height:
+        width = short_side
+        height = int(round(info.height * short_side / info.width / 2)) * 2
+    else:
+        height = short_side
+        width = int(round(info.width * short_side / info.height / 2)) * 2
+    return width, height
+
+
+def needs_fit(info, limit_mb=TELEGRAM_LIMIT_MB, reserve=0.95):
+    """
+    Не поместится ли результат в один файл. Для remux размер почти не
+    меняется, для CRF-перекодирования исходный размер — грубая, но
+    достаточная оценка.
+    """
+    return info.size > limit_mb * 1024 * 1024 * reserve
+
+
+def needs_split(info, fit_enabled=True, min_video_kbps=200):
+    """Видео придётся делить на части: кодирование под лимит его не спасёт."""
+    if not needs_fit(info):
+        return False
+    return not fit_enabled or plan_fit(info, min_video_kbps=min_video_kbps) is None
+
+
+def plan_fit(info, limit_mb=TELEGRAM_LIMIT_MB, reserve=0.93, min_video_kbps=200):
+    """
+    Считает целевой битрейт, чтобы результат уложился в limit_mb.
+    Возвращает FitPlan или None, если при минимальном качестве не помещается
+    (тогда остаётся деление на части).
+    """
+    if not info.duration or not info.width or not info.height:
+        return None
+
+    total_kbps = limit_mb * 1024 * 1024 * 8 * reserve / info.duration / 1000
+    audio_kbps = 0
+    if info.audio_codec:
+        audio_kbps = 128 if total_kbps > 1000 else 64
+    video_kbps = int(total_kbps - audio_kbps)
+    if video_kbps < min_video_kbps:
+        return None
+
+    # Чем меньше битрейт, тем ниже разрешение — иначе картинка рассыплется
+    short_side = min(info.width, info.height)
+    target = short_side
+    for ladder_height, ladder_kbps in FIT_HEIGHT_LADDER:
+        if video_kbps >= ladder_kbps:
+            target = min(short_side, ladder_height)
+            break
+
+    if target < short_side:
+        width, height = _scaled_size(info, target)
+    else:
+        width, height = info.width, info.height
+    return FitPlan(video_kbps, audio_kbps, width, height)
+
+
+# Ограниченный VBR: пики до FIT_MAXRATE_FACTOR × средний битрейт, буфер — FIT_BUFSIZE_FACTOR ×
+FIT_MAXRATE_FACTOR = 1.2
+FIT_BUFSIZE_FACTOR = 2
+
+
+def ffmpeg_args_for_fit(plan, info):
+    """
+    Аргументы кодирования с ограниченным VBR: средний битрейт плана,
+    пики не выше maxrate, поэтому размер файла предсказуем.
+    """
+    args = [
+        "-c:v", "libx264",
+        "-preset", "fast",
+        "-b:v", f"{plan.video_kbps}k",
+        "-maxrate", f"{int(plan.video_kbps * FIT_MAXRATE_FACTOR)}k",
+        "-bufsize", f"{plan.video_kbps * FIT_BUFSIZE_FACTOR}k",
+        "-pix_fmt", "yuv420p",
+    ]
+    if (plan.width, plan.height) != (info.width, info.height):
+        args += ["-vf", f"scale={plan.width}:{plan.height}"]
+    if plan.audio_kbps:
+        args += ["-c:a", "aac", "-b:a", f"{plan.audio_kbps}k"]
+    else:
+        args += ["-an"]
+    return args
+
+
+# Параметры для длинных видео, которые всё равно придётся делить на части
+SEGMENT_VIDEO_KBPS = 1000
+SEGMENT_AUDIO_KBPS = 128
+SEGMENT_SHORT_SIDE = 480
+SEGMENT_MIN_TIME = 10
+SEGMENT_MAX_TIME = 600
+# При -c copy часть режется только по ключевому кадру и несёт пики VBR
+# исходника, поэтому средний битрейт берём с большим запасом
+COPY_SEGMENT_RESERVE = 0.6
+
+
+@dataclass(frozen=True)
+class SegmentPlan:
+    """Как кодировать длинное видео сразу частями, каждая меньше лимита."""
+
+    codec_args: tuple
+    segment_time: int
+    width: int
+    height: int
+    reencode: bool
+
+
+def plan_segments(info, processing_path, limit_mb=TELEGRAM_LIMIT_MB, reserve=0.9):
+    """
+    Длина части выбирается заранее из длительности и битрейта: для копии
+    потоков — из среднего битрейта исходника с запасом COPY_SEGMENT_RESERVE
+    (ключевые кадры, пики VBR), для перекодирования — из maxrate:
+    средний битрейт ABR держится только по всему файлу, а отдельная
+    сложная часть может идти на пиковом (плюс заполненный буфер VBV).
+    Часть, которая всё же вышла больше лимита, пережимает shrink_to_limit.
+    """
+    limit_bits = limit_mb * 1024 * 1024 * 8 * reserve
+
+    if processing_path in (PATH_REMUX, PATH_AUDIO):
+        bit_rate = info.bit_rate or (info.size * 8 / info.duration if info.duration else 0)
+        copy_bits = limit_mb * 1024 * 1024 * 8 * COPY_SEGMENT_RESERVE
+        raw_time = copy_bits / bit_rate if bit_rate else SEGMENT_MAX_TIME
+        segment_time = int(max(SEGMENT_MIN_TIME, min(raw_time, SEGMENT_MAX_TIME)))
+        return SegmentPlan(
+            codec_args=tuple(ffmpeg_args_for_path(processing_path)),
+            segment_time=segment_time,
+            width=info.width,
+            height=info.height,
+            reencode=False,
+        )
+
+    short_side = min(info.width, info.height)
+    if short_side > SEGMENT_SHORT_SIDE:
+        width, height = _scaled_size(info, SEGMENT_SHORT_SIDE)
+    else:
+        width, height = info.width, info.height
+    audio_kbps = SEGMENT_AUDIO_KBPS if info.audio_codec else 0
+    peak_bps = (SEGMENT_VIDEO_KBPS * FIT_MAXRATE_FACTOR + audio_kbps) * 1000
+    burst_bits = SEGMENT_VIDEO_KBPS * FIT_BUFSIZE_FACTOR * 1000
+    segment_time = int(max(
+        SEGMENT_MIN_TIME, min((limit_bits - burst_bits) / peak_bps, SEGMENT_MAX_TIME)
+    ))
+
+    fit = FitPlan(SEGMENT_VIDEO_KBPS, audio_kbps, width, height)
+    codec_args = ffmpeg_args_for_fit(fit, info) + [
+        # Ключевой кадр ровно на границе каждой части
+        "-force_key_frames", f"expr:gte(t,n_forced*{segment_time})",
+    ]
+    return SegmentPlan(
+        codec_args=tuple(codec_args),
+        segment_time=segment_time,
+        width=width,
+        height=height,
+        reencode=True,
+    )
+
+
+def shrink_to_limit(path, limit_mb=TELEGRAM_LIMIT_MB):
+    """
+    Перекодирует готовую часть, которая вышла больше limit_mb, под лимит.
+    Возвращает путь к новому файлу *_fit.mp4, исходная часть удаляется.
+    """
+    info = probe_media(path)
+    plan = plan_fit(info, limit_mb)
+    if plan is None:
+        raise RuntimeError(
+            f"часть {os.path.basename(path)} не помещается в {limit_mb} МБ "
+            "даже при минимальном качестве"
+        )
+    output_path = os.path.splitext(path)[0] + "_fit.mp4"
+    run_ffmpeg([
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-i", path,
+        *ffmpeg_args_for_fit(plan, info),
+        "-movflags", "faststart",
+        output_path
+    ], info.duration)
+    os.remove(path)
+    if os.path.getsize(output_path) > limit_mb * 1024 * 1024:
+        raise RuntimeError(
+            f"часть {os.path.basename(path)} после перекодирования больше {limit_mb} МБ"
+        )
+    return output_path
+
+
+def encoded_streams(processing_path, info):
+    """Как изменятся кодеки после выбранного пути (для MediaInfo.derive)."""
+    audio_codec = "aac" if info.audio_codec else None
+    if processing_path == PATH_REMUX:
+        return {}
+    if processing_path == PATH_AUDIO:
+        return {"audio_codec": audio_codec}
+    return {"video_codec": "h264", "audio_codec": audio_codec, "pix_fmt": "yuv420p"}
+
+
+class ProcessingStats:
+    """
+    Счётчики того, каким путём прошли задачи, и сколько времени на это ушло.
+    По ним видно, сколько CPU экономит remux вместо перекодирования.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.seconds = Counter()
+        self.media_seconds = Counter()
+
+    def record(self, path, elapsed, media_duration=0.0):
+        with self._lock:
+            self.counts[path] += 1
+            self.seconds[path] += elapsed
+            self.media_seconds[path] += media_duration or 0.0
+
+    def summary(self):
+        """Строки вида 'remux: задач 12, время 3.1 c, 0.004 c на секунду видео'."""
+        with self._lock:
+            lines = []
+            for path in (PATH_REMUX, PATH_AUDIO, PATH_FULL, PATH_FIT):
+                count = self.counts[path]
+                if not count:
+                    continue
+                media = self.media_seconds[path]
+                per_media = self.seconds[path] / media if media else 0.0
+                lines.append(
+                    f"{path}: задач {count}, время {self.seconds[path]:.1f} c, "
+                    f"{per_media:.3f} c на секунду видео"
+                )
+            return lines
+
+
+processing_stats = ProcessingStats()
+
@@ -0,0 +1,198 @@
+import os
+import threading
+from collections import deque
+
+from aiohttp import web
+
+
+# Границы корзин гистограмм: секунды и байты
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+BYTE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000))
+
+
+class Histogram:
+    """
+    Гистограмма в стиле Prometheus (накопительные корзины, сумма, число)
+    плюс последние reservoir значений для p50/p95 в /stats.
+    """
+
+    def __init__(self, buckets, reservoir=1000):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=reservoir)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    def quantile(self, q):
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    inner = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return "{" + inner + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    Метрики пайплайна в памяти процесса: гистограммы (время стадий,
+    ожидание в очереди, байты, CPU ffmpeg/yt-dlp) и счётчики (кэши).
+    Потокобезопасно — пишется и из рабочих потоков.
+
+    render() отдаёт текстовый формат Prometheus, collectors — функции,
+    которые в момент запроса возвращают текущие значения (глубина
+    очередей и т.п.) как [(имя, labels, значение)].
+    """
+
+    def __init__(self, prefix="margarine"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._help = {}
+        self._buckets = {}
+        self._histograms = {}   # имя → {labels: Histogram}
+        self._counters = {}     # имя → {labels: число}
+        self._collectors = []
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS):
+        self._help[name] = help_text
+        self._buckets[name] = buckets
+
+    def counter(self, name, help_text):
+        self._help[name] = help_text
+
+    def gauge(self, name, help_text, collector):
+        """Значения gauge считаются в момент запроса: collector() → [(labels, значение)]."""
+        self._help[name] = help_text
+        self._collectors.append((name, collector))
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            key = _label_key(labels)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self._buckets.get(name, TIME_BUCKETS))
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self._counters.get(name, {}).get(_label_key(labels), 0)
+
+    def quantiles(self, name):
+        """{labels: (число, p50, p95, сумма)} по гистограмме."""
+        with self._lock:
+            return {
+                key: (h.count, h.quantile(0.5), h.quantile(0.95), h.sum)
+                for key, h in self._histograms.get(name, {}).items()
+            }
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in self._histograms.items():
+                full = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {full} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {full} histogram")
+                for key, h in series.items():
+                    for bound, count in zip(h.buckets, h.bucket_counts):
+                        lines.append(
+                            f"{full}_bucket{_format_labels(key, ('le', _format_value(float(bound))))} {count}"
+                        )
+                    lines.append(f"{full}_bucket{_format_labels(key, ('le', '+Inf'))} {h.count}")
+                    lines.append(f"{full}_sum{_format_labels(key)} {_format_value(h.sum)}")
+                    lines.append(f"{full}_count{_format_labels(key)} {h.count}")
+            for name, series in self._counters.items():
+                full = f"{self.prefix}_{name}_total"
+                lines.append(f"# HELP {full} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {full} counter")
+                for key, value in series.items():
+                    lines.append(f"{full}{_format_labels(key)} {_format_value(value)}")
+        for name, collector in self._collectors:
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {full} gauge")
+            try:
+                for labels, value in collector():
+                    lines.append(f"{full}{_format_labels(_label_key(labels))} {_format_value(value)}")
+            except Exception as e:
+                print(f"[METRICS] Ошибка при сборе {name}: {e}", flush=True)
+        return "\n".join(lines) + "\n"
+
+
+registry = Metrics()
+registry.histogram("stage_seconds", "Время стадии пайплайна без ожидания в очереди")
+registry.histogram("queue_wait_seconds", "Ожидание свободного слота стадии")
+registry.histogram("stage_bytes", "Объём данных стадии (скачано / отправлено)", BYTE_BUCKETS)
+registry.histogram("tool_cpu_seconds", "CPU-время (user+sys) ffmpeg и yt-dlp на задачу")
+registry.counter("cache_requests", "Обращения к кэшам: result — кэш file_id, subscription — подписки")
+registry.counter("janitor_removed_bytes", "Удалено фоновой очисткой DOWNLOAD_DIR, байт")
+registry.counter("webhook_updates", "Запросы на webhook: accepted, rejected (неверный secret_token), invalid")
+
+
+def wait_process(process, tool="ffmpeg"):
+    """
+    Ждёт завершения дочернего процесса через wait4 и записывает его
+    CPU-время (user + sys) в tool_cpu_seconds. Возвращает код возврата.
+    """
+    if not hasattr(os, "wait4"):
+        return process.wait()
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Процесс уже подобрал Popen.poll() (например, из kill()) — CPU неизвестно
+        return process.wait()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    registry.observe("tool_cpu_seconds", usage.ru_utime + usage.ru_stime, tool=tool)
+    return process.returncode
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics для Prometheus (только чтение, слушает localhost)."""
+
+    def __init__(self, metrics, host="127.0.0.1", port=9108):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request):
+        return web.Response(text=self.metrics.render(), content_type="text/plain")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
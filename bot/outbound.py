@@ -0,0 +1,281 @@
+import asyncio
+import bisect
+import itertools
+import time
+from dataclasses import dataclass, field
+
+
+# Чем меньше число, тем раньше уходит запрос
+PRIORITY_USER = 0       # видео и ответы пользователю
+PRIORITY_PROGRESS = 1   # правки статусных сообщений
+PRIORITY_ADMIN = 2      # уведомления администратору
+
+
+def retry_after(exc):
+    """retry_after из ответа 429 Telegram (или 0)."""
+    if getattr(exc, "error_code", None) != 429:
+        return 0
+    result_json = getattr(exc, "result_json", None) or {}
+    return int(result_json.get("parameters", {}).get("retry_after", 1))
+
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду, всплеск до capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд можно будет взять токен (0 — уже можно)."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until):
+        """После 429: до until запросов нет, потом один запрос и дальше по rate."""
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 1
+        self.updated = max(self.updated, until)
+
+    def idle(self, now):
+        return self.blocked_until <= now and self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+@dataclass(order=True)
+class _Request:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    request: object = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+class OutboundDispatcher:
+    """
+    Все исходящие запросы к Bot API идут через одну очередь.
+
+    Запрос уходит, когда есть токены и в общем ведре (лимит бота), и в ведре
+    его чата (в личке ~1 сообщение в секунду, в группах ~20 в минуту).
+    Из готовых к отправке первым идёт запрос с более высоким приоритетом:
+    видео пользователю раньше правок прогресса, а те — раньше уведомлений
+    админу. На 429 чат блокируется на retry_after, запрос возвращается
+    в очередь на своё место и повторяется, а не роняет задачу.
+
+    request — функция без аргументов, возвращающая корутину; она вызывается
+    заново на каждую попытку (например, чтобы заново открыть файл).
+    """
+
+    def __init__(self, bot, global_rate=30.0, chat_rate=1.0, group_rate=20 / 60,
+                 burst=3, max_retries=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._queue = []   # отсортирован по (priority, seq)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._running = set()
+        self.retries = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def share_limits(self, processes):
+        """
+        Лимиты Telegram считаются на токен бота, а не на процесс: если
+        запросы шлют processes процессов (бот и воркеры), каждому достаётся
+        своя доля общего, чатового и группового лимита. Вызывать до первых запросов.
+        """
+        processes = max(1, int(processes))
+        rate = self._global.rate / processes
+        self._global = TokenBucket(rate, max(1.0, rate))
+        self.chat_rate /= processes
+        self.group_rate /= processes
+        self._chats.clear()
+
+    async def drain(self, timeout):
+        """
+        Ждёт, пока очередь опустеет и выполнятся начатые запросы (при
+        остановке бота). Возвращает False, если не успели за timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue or self._running:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def call(self, chat_id, request, priority=PRIORITY_USER):
+        """Ставит запрос в очередь и ждёт его результата."""
+        return await self.post(chat_id, request, priority)
+
+    def post(self, chat_id, request, priority=PRIORITY_USER):
+        """Ставит запрос в очередь и сразу возвращает future с результатом."""
+        loop = asyncio.get_running_loop()
+        self._start(loop)
+        item = _Request(priority, next(self._seq), chat_id, request, loop.create_future())
+        self._push(item)
+        return item.future
+
+    # Обёртки над методами AsyncTeleBot
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_USER, **kwargs):
+        return await self.call(
+            chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs), priority
+        )
+
+    async def reply_to(self, message, text, priority=PRIORITY_USER, **kwargs):
+        return await self.call(
+            message.chat.id, lambda: self.bot.reply_to(message, text, **kwargs), priority
+        )
+
+    async def edit_message_text(self, text, chat_id, message_id,
+                                priority=PRIORITY_USER, **kwargs):
+        return await self.call(
+            chat_id,
+            lambda: self.bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id, **kwargs
+            ),
+            priority,
+        )
+
+    async def send_media(self, kind, chat_id, media, priority=PRIORITY_USER, **kwargs):
+        """
+        send_<kind> (video, photo, document, animation...). media — file_id/URL
+        или функция, открывающая файл: при повторе после 429 файл
+        открывается заново и читается с начала.
+        """
+        method = getattr(self.bot, f"send_{kind}")
+
+        async def request():
+            if not callable(media):
+                return await method(chat_id, media, **kwargs)
+            handle = await asyncio.to_thread(media)
+            try:
+                return await method(chat_id, handle, **kwargs)
+            finally:
+                await asyncio.to_thread(handle.close)
+
+        return await self.call(chat_id, request, priority)
+
+    async def send_video(self, chat_id, video, priority=PRIORITY_USER, **kwargs):
+        return await self.send_media("video", chat_id, video, priority, **kwargs)
+
+    def notify(self, chat_id, text, **kwargs):
+        """Уведомление с низким приоритетом без ожидания отправки."""
+        future = self.post(
+            chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs), PRIORITY_ADMIN
+        )
+        future.add_done_callback(_log_failure)
+        return future
+
+    # Внутренняя кухня
+
+    def _start(self, loop):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    def _push(self, item):
+        bisect.insort(self._queue, item)
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные ID — группы и каналы, там лимит строже
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    async def _run(self):
+        while True:
+            try:
+                delay = self._dispatch_ready()
+            except Exception as e:
+                print(f"[OUTBOUND] Ошибка диспетчера: {e}", flush=True)
+                delay = 1.0
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch_ready(self):
+        """Запускает всё, что можно отправить сейчас; возвращает, сколько ждать дальше."""
+        now = time.monotonic()
+        wait = None
+        for item in list(self._queue):
+            if item.future.done():
+                # Вызывающий отменил ожидание
+                self._queue.remove(item)
+                continue
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                return global_wait if wait is None else min(wait, global_wait)
+            bucket = self._chat_bucket(item.chat_id)
+            chat_wait = bucket.wait_time(now)
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            self._global.take(now)
+            bucket.take(now)
+            self._queue.remove(item)
+            task = asyncio.get_running_loop().create_task(self._execute(item))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+        if len(self._chats) > 1000:
+            self._chats = {
+                chat_id: bucket for chat_id, bucket in self._chats.items()
+                if not bucket.idle(now)
+            }
+        return wait
+
+    async def _execute(self, item):
+        try:
+            result = await item.request()
+        except Exception as e:
+            delay = retry_after(e)
+            if delay and item.attempts < self.max_retries and not item.future.done():
+                item.attempts += 1
+                self.retries += 1
+                print(
+                    f"[OUTBOUND] 429 для чата {item.chat_id}, повтор через {delay} с "
+                    f"(попытка {item.attempts})",
+                    flush=True,
+                )
+                self._chat_bucket(item.chat_id).block(time.monotonic() + delay)
+                # Возвращаем на прежнее место: seq тот же
+                self._push(item)
+                return
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            if not item.future.done():
+                item.future.set_result(result)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"[OUTBOUND] Не удалось отправить уведомление: {future.exception()}", flush=True)
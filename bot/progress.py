@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+
+from bot.outbound import PRIORITY_PROGRESS, retry_after
+
+
+PROGRESS_BARS = [
+    "[░░░░░░░░░░]",
+    "[▓░░░░░░░░░]",
+    "[▓▓░░░░░░░░]",
+    "[▓▓▓░░░░░░░]",
+    "[▓▓▓▓░░░░░░]",
+    "[▓▓▓▓▓░░░░░]",
+    "[▓▓▓▓▓▓░░░░]",
+    "[▓▓▓▓▓▓▓░░░]",
+    "[▓▓▓▓▓▓▓▓░░]",
+    "[▓▓▓▓▓▓▓▓▓░]",
+    "[▓▓▓▓▓▓▓▓▓▓]",
+]
+
+def get_next_bar(index: int) -> tuple[str, int]:
+    """Возвращает следующий вариант бара и новый индекс."""
+    index = (index + 1) % len(PROGRESS_BARS)
+    return PROGRESS_BARS[index], index
+
+
+def progress_text(title, percent):
+    """Строка статуса с полосой: '📥 Скачиваю видео: `[▓▓▓░░░░░░░] 34.0%`'."""
+    percent = max(0.0, min(100.0, percent))
+    bar = PROGRESS_BARS[int(percent // 10)]
+    return f"{title}: `{bar} {percent:.1f}%`"
+
+
+def spinner_text(title, index):
+    """Статус без известного процента: полоса «бежит» при каждом обновлении."""
+    bar, index = get_next_bar(index)
+    return f"{title}: `{bar}`", index
+
+
+class ProgressHub:
+    """
+    Единая точка для правок статусных сообщений.
+
+    Обновления можно слать сколько угодно часто и из любого потока: для
+    каждого сообщения хранится только последний текст, а отдельная задача
+    в event loop отправляет правки не чаще лимитов Telegram — интервал на
+    чат (в группах реже) и общий бюджет правок в секунду. На 429 чат
+    (и при необходимости весь бот) ставится на паузу на retry_after.
+    Пайплайн никогда не ждёт сами правки.
+
+    bot — OutboundDispatcher: правки идут в общую очередь с приоритетом
+    ниже отправки видео.
+    """
+
+    def __init__(self, bot, private_interval=2.0, group_interval=3.0,
+                 edits_per_second=10.0, tick=0.25):
+        self.bot = bot
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self.edits_per_second = edits_per_second
+        self.tick = tick
+
+        self._lock = threading.Lock()
+        self._pending = {}      # (chat_id, message_id) → (text, kwargs)
+        self._inflight = {}     # (chat_id, message_id) → asyncio.Task
+        self._next_allowed = {}  # chat_id → monotonic
+        self._paused_until = 0.0
+        self._tokens = edits_per_second
+        self._refilled_at = time.monotonic()
+        self._task = None
+        self._loop = None
+
+    def set(self, chat_id, message_id, text, **kwargs):
+        """Запоминает новый текст статуса. Потокобезопасно, не блокирует."""
+        key = (chat_id, message_id)
+        with self._lock:
+            self._pending[key] = (text, kwargs)
+        self.start()
+
+    async def finish(self, chat_id, message_id):
+        """
+        Перед финальной правкой (готово / ошибка): выбрасывает ожидающие
+        обновления и дожидается уже отправляемой правки, чтобы устаревший
+        прогресс не затёр итоговый текст.
+        """
+        key = (chat_id, message_id)
+        with self._lock:
+            self._pending.pop(key, None)
+            task = self._inflight.get(key)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def drain(self, timeout):
+        """
+        При остановке бота: ждёт, пока уйдут последние статусы.
+        Возвращает False, если не успели за timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while self._pending or self._inflight:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.tick)
+        return True
+
+    def start(self):
+        """Запускает фоновую отправку правок в текущем event loop (если ещё не)."""
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вызов из рабочего потока — цикл запустится при первом вызове из event loop
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._run())
+
+    def _interval(self, chat_id):
+        # Отрицательные ID — группы и каналы, там лимит строже
+        return self.group_interval if chat_id < 0 else self.private_interval
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self._flush()
+            except Exception as e:
+                print(f"[PROGRESS] Ошибка при отправке статусов: {e}", flush=True)
+
+    def _flush(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return
+        self._tokens = min(
+            self.edits_per_second,
+            self._tokens + (now - self._refilled_at) * self.edits_per_second,
+        )
+        self._refilled_at = now
+
+        with self._lock:
+            if len(self._next_allowed) > 1000:
+                self._next_allowed = {
+                    chat_id: t for chat_id, t in self._next_allowed.items() if t > now
+                }
+            for key in list(self._pending):
+                if self._tokens < 1:
+                    break
+                chat_id = key[0]
+                if key in self._inflight or self._next_allowed.get(chat_id, 0) > now:
+                    continue
+                text, kwargs = self._pending.pop(key)
+                self._tokens -= 1
+                self._next_allowed[chat_id] = now + self._interval(chat_id)
+                self._inflight[key] = self._loop.create_task(self._edit(key, text, kwargs))
+
+    async def _edit(self, key, text, kwargs):
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id,
+                priority=PRIORITY_PROGRESS, **kwargs
+            )
+        except Exception as e:
+            delay = retry_after(e)
+            if delay:
+                now = time.monotonic()
+                with self._lock:
+                    self._next_allowed[chat_id] = now + delay
+                    # Вернём текст в очередь, если новее ничего не пришло
+                    self._pending.setdefault(key, (text, kwargs))
+                if delay > self._interval(chat_id) * 4:
+                    # Длинный flood wait — это лимит всего бота, а не одного чата
+                    self._paused_until = max(self._paused_until, now + delay)
+            elif "message is not modified" not in str(e):
+                print(f"[PROGRESS] Не удалось обновить статус {chat_id}/{message_id}: {e}", flush=True)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
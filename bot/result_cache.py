@@ -0,0 +1,209 @@
+import json
+import re
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from bot import db
+
+
+YOUTUBE_ID_RE = re.compile(
+    r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)"
+    r"([A-Za-z0-9_-]{11})"
+)
+INSTAGRAM_ID_RE = re.compile(
+    r"instagram\.com/(?:[^/?#]+/)?(?:reels?|p|tv)/([A-Za-z0-9_-]+)"
+)
+
+# Параметры, которые не меняют видео (метки шаринга и аналитики)
+TRACKING_PARAMS = {
+    "igsh", "igshid", "si", "feature", "fbclid", "gclid", "ref", "ref_src",
+    "pp", "t", "start", "app", "share_id", "mibextid",
+}
+
+
+def normalize_url(url):
+    """
+    Ключ кэша для ссылки. Для YouTube и Instagram — ID видео,
+    для остальных — ссылка без схемы, www, якоря и трекинговых параметров.
+    """
+    url = url.strip()
+
+    match = YOUTUBE_ID_RE.search(url)
+    if match:
+        return f"youtube:{match.group(1)}"
+
+    match = INSTAGRAM_ID_RE.search(url)
+    if match:
+        return f"instagram:{match.group(1)}"
+
+    parts = urlsplit(url if "://" in url else f"https://{url}")
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith("utm_")
+    )
+    path = parts.path.rstrip("/")
+    key = f"url:{host}{path}"
+    if query:
+        key += "?" + urlencode(query)
+    return key
+
+
+@dataclass
+class CachedResult:
+    key: str
+    url: str
+    file_ids: list
+    width: int
+    height: int
+    duration: int
+    created_at: float
+    last_used: float
+    hits: int
+
+
+class ResultCache:
+    """
+    Постоянный кэш готовых результатов: ключ ссылки → file_id видео
+    (для разделённых видео — всех частей по порядку).
+
+    Повторный запрос отвечается send_video(file_id) без скачивания,
+    кодирования и загрузки файла. Записи живут ttl секунд, при превышении
+    max_entries вытесняются давно не использованные.
+    """
+
+    def __init__(self, ttl, max_entries, db_path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._schema_ready = False
+
+    def _connect(self):
+        conn = db.connect(self.db_path)
+        if not self._schema_ready:
+            with conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS result_cache (
+                        key TEXT PRIMARY KEY,
+                        url TEXT NOT NULL,
+                        file_ids TEXT NOT NULL,
+                        width INTEGER,
+                        height INTEGER,
+                        duration INTEGER,
+                        created_at REAL NOT NULL,
+                        last_used REAL NOT NULL,
+                        hits INTEGER NOT NULL DEFAULT 0
+                    )
+                    """
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS result_cache_last_used "
+                    "ON result_cache (last_used)"
+                )
+            self._schema_ready = True
+        return conn
+
+    @staticmethod
+    def _row_to_result(row):
+        return CachedResult(
+            key=row["key"],
+            url=row["url"],
+            file_ids=json.loads(row["file_ids"]),
+            width=row["width"] or 0,
+            height=row["height"] or 0,
+            duration=row["duration"] or 0,
+            created_at=row["created_at"],
+            last_used=row["last_used"],
+            hits=row["hits"],
+        )
+
+    def get(self, key):
+        """Возвращает CachedResult или None (просроченные записи удаляются)."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT * FROM result_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row["created_at"] > self.ttl:
+                conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+                return None
+            conn.execute(
+                "UPDATE result_cache SET hits = hits + 1, last_used = ? WHERE key = ?",
+                (now, key),
+            )
+            result = self._row_to_result(row)
+            result.hits += 1
+            return result
+
+    def put(self, key, url, file_ids, width=0, height=0, duration=0):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                INSERT INTO result_cache
+                    (key, url, file_ids, width, height, duration, created_at, last_used, hits)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+                ON CONFLICT(key) DO UPDATE SET
+                    url = excluded.url,
+                    file_ids = excluded.file_ids,
+                    width = excluded.width,
+                    height = excluded.height,
+                    duration = excluded.duration,
+                    created_at = excluded.created_at,
+                    last_used = excluded.last_used
+                """,
+                (key, url, json.dumps(file_ids), width, height, duration, now, now),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute(
+            "DELETE FROM result_cache WHERE created_at < ?", (now - self.ttl,)
+        )
+        conn.execute(
+            """
+            DELETE FROM result_cache WHERE key IN (
+                SELECT key FROM result_cache
+                ORDER BY last_used DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+
+    def delete(self, key):
+        """Удаляет запись. Возвращает True, если она была."""
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            return cursor.rowcount > 0
+
+    def purge(self):
+        """Очищает кэш целиком. Возвращает число удалённых записей."""
+        with closing(self._connect()) as conn, conn:
+            return conn.execute("DELETE FROM result_cache").rowcount
+
+    def stats(self):
+        """(записей, сумма попаданий)."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits "
+                "FROM result_cache"
+            ).fetchone()
+            return row["entries"], row["hits"]
+
+    def top(self, limit=10):
+        """Самые востребованные записи."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM result_cache ORDER BY hits DESC, last_used DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+            return [self._row_to_result(row) for row in rows]
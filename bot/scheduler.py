@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+from collections import deque
+
+
+class SchedulerBusy(Exception):
+    """
+    Очередь переполнена или у пользователя слишком много задач.
+    per_user — отказ из-за лимита пользователя, а не общей перегрузки.
+    """
+
+    def __init__(self, message, per_user=False):
+        super().__init__(message)
+        self.per_user = per_user
+
+
+class StagePool:
+    """
+    Ограниченный пул слотов для одной стадии (download / transcode / upload).
+
+    Ожидающие задачи стоят в FIFO-очереди; каждый ожидающий получает
+    уведомление о своей позиции, когда очередь сдвигается.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.active = 0
+        self._waiters = deque()  # элементы: [future, on_wait]
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _notify_positions(self):
+        for position, (fut, on_wait) in enumerate(self._waiters, start=1):
+            if on_wait is not None and not fut.done():
+                asyncio.ensure_future(_safe_call(on_wait, self.name, position))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, on_wait=None):
+        """
+        Занимает слот на время блока with.
+        on_wait(stage, position) — async-колбэк, вызывается пока задача в очереди.
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            entry = [fut, on_wait]
+            self._waiters.append(entry)
+            try:
+                # Уведомление тоже внутри try: отмена во время него
+                # не должна оставить запись в очереди
+                if on_wait is not None:
+                    await _safe_call(on_wait, self.name, len(self._waiters))
+                await fut
+            except asyncio.CancelledError:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    self._notify_positions()
+                elif fut.done() and not fut.cancelled():
+                    # Слот уже был передан нам — возвращаем его следующему
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        while self._waiters:
+            fut, _ = self._waiters.popleft()
+            if not fut.done():
+                # Слот переходит следующему в очереди, active не меняется
+                fut.set_result(None)
+                self._notify_positions()
+                return
+        self.active -= 1
+
+
+async def _safe_call(callback, *args):
+    try:
+        await callback(*args)
+    except Exception as e:
+        print(f"[SCHED] Ошибка колбэка очереди: {e}", flush=True)
+
+
+class JobScheduler:
+    """
+    Планировщик задач: отдельный ограниченный пул на каждую стадию,
+    лимит одновременных задач на пользователя и общий лимит задач в системе
+    (backpressure — лишние запросы отклоняются сразу, а не копятся).
+    """
+
+    def __init__(self, download_limit, transcode_limit, upload_limit,
+                 per_user_limit, max_jobs):
+        self.pools = {
+            "download": StagePool("download", download_limit),
+            "transcode": StagePool("transcode", transcode_limit),
+            "upload": StagePool("upload", upload_limit),
+        }
+        self.per_user_limit = max(1, int(per_user_limit))
+        self.max_jobs = max(1, int(max_jobs))
+        self._user_jobs = {}
+        self.jobs = 0
+
+    @contextlib.contextmanager
+    def admit(self, user_id):
+        """Регистрирует задачу пользователя или бросает SchedulerBusy."""
+        if self._user_jobs.get(user_id, 0) >= self.per_user_limit:
+            raise SchedulerBusy(
+                "У вас уже есть задачи в работе "
+                f"(лимит одновременных задач: {self.per_user_limit}). "
+                "Дождитесь их завершения и пришлите ссылку ещё раз.",
+                per_user=True,
+            )
+        if self.jobs >= self.max_jobs:
+            raise SchedulerBusy(
+                "Бот сейчас перегружен. Попробуйте отправить ссылку через пару минут."
+            )
+        self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+        self.jobs += 1
+        try:
+            yield
+        finally:
+            self.jobs -= 1
+            left = self._user_jobs.get(user_id, 1) - 1
+            if left > 0:
+                self._user_jobs[user_id] = left
+            else:
+                self._user_jobs.pop(user_id, None)
+
+    def stage(self, name, on_wait=None):
+        return self.pools[name].slot(on_wait)
+
+    def snapshot(self):
+        """Текущая загрузка пулов: {stage: (active, limit, waiting)}."""
+        return {
+            name: (pool.active, pool.limit, pool.waiting)
+            for name, pool in self.pools.items()
+        }
@@ -0,0 +1,122 @@
+import asyncio
+import functools
+import os
+import time
+from contextlib import closing
+
+from bot import db
+
+
+# Одновременные /start не должны загружать один и тот же файл несколько раз
+_upload_locks = {}
+
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _sent_file_id(message, kind):
+    """file_id из ответа send_<kind> (у фото — самый большой размер)."""
+    if kind == "photo":
+        return message.photo[-1].file_id if message.photo else None
+    media = getattr(message, kind, None) or getattr(message, "document", None)
+    return media.file_id if media else None
+
+
+class StaticMediaStore:
+    """
+    file_id статичных файлов бота (видеоинструкция и т.п.) в SQLite.
+
+    Файл загружается в Telegram один раз, дальше отправляется по file_id.
+    Запись привязана к размеру и времени изменения файла: заменили файл
+    на диске — он будет загружен заново.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._schema_ready = False
+
+    def _connect(self):
+        conn = db.connect(self.db_path)
+        if not self._schema_ready:
+            with conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS static_media (
+                        path TEXT NOT NULL,
+                        kind TEXT NOT NULL,
+                        file_id TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        updated_at REAL NOT NULL,
+                        PRIMARY KEY (path, kind)
+                    )
+                    """
+                )
+            self._schema_ready = True
+        return conn
+
+    def get(self, path, kind="video"):
+        """file_id для файла или None, если его нет или файл изменился."""
+        size, mtime_ns = _fingerprint(path)
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT * FROM static_media WHERE path = ? AND kind = ?",
+                (os.path.abspath(path), kind),
+            ).fetchone()
+        if row is None or row["size"] != size or row["mtime_ns"] != mtime_ns:
+            return None
+        return row["file_id"]
+
+    def put(self, path, file_id, kind="video"):
+        size, mtime_ns = _fingerprint(path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO static_media
+                    (path, kind, file_id, size, mtime_ns, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (os.path.abspath(path), kind, file_id, size, mtime_ns, time.time()),
+            )
+
+    def delete(self, path, kind="video"):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "DELETE FROM static_media WHERE path = ? AND kind = ?",
+                (os.path.abspath(path), kind),
+            )
+
+
+async def send_static(outbound, store, chat_id, path, kind="video", **kwargs):
+    """
+    Отправляет статичный файл по сохранённому file_id, а если его нет или
+    Telegram его больше не принимает — загружает файл и запоминает новый ID.
+    """
+    file_id = await asyncio.to_thread(store.get, path, kind)
+    if file_id is not None:
+        try:
+            return await outbound.send_media(kind, chat_id, file_id, **kwargs)
+        except Exception as e:
+            # 400 — file_id недействителен (другой бот, удалён и т.п.)
+            if getattr(e, "error_code", None) != 400:
+                raise
+            print(f"[BOT] file_id для {path} недействителен, загружаю заново: {e}", flush=True)
+            await asyncio.to_thread(store.delete, path, kind)
+
+    lock = _upload_locks.setdefault((os.path.abspath(path), kind), asyncio.Lock())
+    async with lock:
+        if file_id is None:
+            # Пока ждали, файл мог загрузить соседний запрос
+            file_id = await asyncio.to_thread(store.get, path, kind)
+            if file_id is not None:
+                return await outbound.send_media(kind, chat_id, file_id, **kwargs)
+
+        sent = await outbound.send_media(
+            kind, chat_id, functools.partial(open, path, "rb"), **kwargs
+        )
+        file_id = _sent_file_id(sent, kind)
+        if file_id:
+            await asyncio.to_thread(store.put, path, file_id, kind)
+        return sent
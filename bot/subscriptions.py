@@ -0,0 +1,51 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+class SubscriptionCache:
+    """
+    Кэш проверки подписки на канал: user_id → (подписан ли, когда истекает).
+
+    Подписку помним долго (positive_ttl), отсутствие подписки — недолго
+    (negative_ttl), чтобы только что подписавшийся пользователь не ждал.
+    Старые записи вытесняются по LRU сверх max_entries. Обновления
+    chat_member из канала сразу переписывают запись.
+    """
+
+    def __init__(self, positive_ttl=3600, negative_ttl=60, max_entries=10000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """True/False из кэша или None, если нужно спросить Telegram."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[0]
+
+    def put(self, user_id, subscribed):
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        with self._lock:
+            self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def is_channel(chat, channel):
+    """Относится ли чат из обновления к каналу из настроек (@username или ID)."""
+    if str(chat.id) == str(channel):
+        return True
+    return bool(chat.username) and chat.username.lower() == str(channel).lstrip("@").lower()
@@ -1,23 +1,26 @@
+import functools
+import io
 import os
 import subprocess
-import json
 import asyncio
+import contextlib
+import time
 
+from bot import metrics
+from bot.media import COPY_SEGMENT_RESERVE, probe_media, run_ffmpeg, shrink_to_limit
 
-def get_segment_time(path, max_size_mb=50, reserve=0.95):
+
+def get_segment_time(path, max_size_mb=50, reserve=COPY_SEGMENT_RESERVE, media_info=None):
     """
     Вычисляет длительность сегмента (в секундах), чтобы каждый файл
-    был не больше max_size_mb.
+    был не больше max_size_mb. Части режутся копированием по ключевым
+    кадрам, поэтому средний битрейт берётся с большим запасом reserve.
+    Если MediaInfo уже посчитан — ffprobe не запускается.
     """
-    cmd = [
-        "ffprobe", "-v", "error",
-        "-show_entries", "format=duration,size",
-        "-of", "json", path
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-    info = json.loads(result.stdout)["format"]
-    duration = float(info["duration"])       # в секундах
-    size_bytes = float(info["size"])         # в байтах
+    if media_info is None:
+        media_info = probe_media(path)
+    duration = media_info.duration               # в секундах
+    size_bytes = float(media_info.size)          # в байтах
 
     max_bytes = max_size_mb * 1024**2 * reserve
     raw_time = (max_bytes / size_bytes) * duration
@@ -26,9 +29,65 @@ def get_segment_time(path, max_size_mb=50, reserve=0.95):
     return max(10, min(seg, 600))
 
 
+class _ProgressFile(io.FileIO):
+    """Файл, сообщающий долю уже прочитанного aiohttp — прогресс отправки."""
+
+    def __init__(self, path, on_progress):
+        super().__init__(path, "rb")
+        self._total = os.fstat(self.fileno()).st_size or 1
+        self._done = 0
+        self._on_progress = on_progress
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        if chunk:
+            self._done += len(chunk)
+            self._on_progress(min(100.0, self._done * 100 / self._total))
+        return chunk
+
+
+async def upload_video_file(bot, chat_id, path, on_progress=None, **kwargs):
+    """
+    Отправляет видео с диска потоково: в send_video уходит открытый файл,
+    и aiohttp читает его кусками по 64 КБ в пуле потоков. В памяти держится
+    только буфер, а не весь файл. on_progress(percent) вызывается из пула
+    потоков по мере чтения файла.
+
+    bot — OutboundDispatcher: он открывает файл заново при повторе после 429.
+    """
+    if on_progress is not None:
+        opener = functools.partial(_ProgressFile, path, on_progress)
+    else:
+        opener = functools.partial(open, path, "rb")
+    return await bot.send_video(chat_id, opener, **kwargs)
+
+
+def _file_id(sent_message):
+    """file_id отправленного видео (Telegram может принять его как документ)."""
+    media = getattr(sent_message, "video", None) or getattr(sent_message, "document", None)
+    return media.file_id if media else None
+
+
 async def send_video_to_user(
-    bot, chat_id, user_id, username, url, video_path, width, height, admin_id
+    bot, chat_id, user_id, username, url, video_path, width, height, admin,
+    media_info=None, on_progress=None, uploaded_parts=None, on_part_uploaded=None
 ):
+    """
+    Отправляет видео (при необходимости — частями) и возвращает список
+    file_id отправленных частей или None, если Telegram не вернул file_id
+    хотя бы для одной из них.
+    Часть, которая всё же вышла больше 50 МБ, перекодируется под лимит
+    (media.shrink_to_limit), а не пропускается.
+    on_progress(percent) получает общий прогресс отправки. admin —
+    AdminDigest: успешные отправки попадают в сводку, ошибки — сразу.
+
+    uploaded_parts — части, отправленные до перезапуска бота ([file_id, ...]):
+    они не отправляются повторно. await on_part_uploaded(file_id, end)
+    вызывается после каждой отправленной части.
+    """
+    uploaded_parts = list(uploaded_parts or [])
+    file_ids = []
+    cancelled = False
     try:
         # Получение размера файла (в отдельном потоке)
         file_size = await asyncio.to_thread(os.path.getsize, video_path)
@@ -48,7 +107,9 @@ async def send_video_to_user(
             part_filenames = []
 
             # Вычисляем оптимальную длительность сегмента
-            seg_time = get_segment_time(video_path, max_size_mb=50)
+            seg_time = await asyncio.to_thread(
+                get_segment_time, video_path, 50, COPY_SEGMENT_RESERVE, media_info
+            )
             output_template = os.path.join(parts_dir, f"{base_filename}_part%02d{ext}")
             ffmpeg_command = [
                 "ffmpeg",
@@ -62,7 +123,11 @@ async def send_video_to_user(
             ]
 
             # ffmpeg остаётся синхронным → в поток
-            await asyncio.to_thread(subprocess.run, ffmpeg_command, check=True)
+            split_started = time.monotonic()
+            await asyncio.to_thread(run_ffmpeg, ffmpeg_command)
+            metrics.registry.observe(
+                "stage_seconds", time.monotonic() - split_started, stage="split"
+            )
 
             # Удаляем оригинальный файл после деления
             if os.path.exists(video_path):
@@ -72,86 +137,262 @@ async def send_video_to_user(
             # Формируем список частей (тоже в поток)
             def _collect_parts():
                 res = []
+                part_prefix = f"{base_filename}_part"
                 for filename in os.listdir(parts_dir):
-                    if filename.startswith(base_filename) and filename.endswith(ext):
+                    if filename.startswith(part_prefix) and filename.endswith(ext):
                         res.append(os.path.join(parts_dir, filename))
                 return res
 
             part_filenames = await asyncio.to_thread(_collect_parts)
 
-            # Уведомление администратора о делении
-            parts_info_lines = []
-            for part in sorted(part_filenames):
-                size_mb = (await asyncio.to_thread(os.path.getsize, part)) / (1024 * 1024)
-                parts_info_lines.append(
-                    f"{os.path.basename(part)} ({size_mb:.2f} MB)"
-                )
-
-            await bot.send_message(
-                admin_id,
-                "⚠️ Видео разделено на части:\n"
-                f"ID: {user_id}\n"
-                f"Имя: @{username}\n"
-                f"Ссылка: {url}\n"
-                f"Имя исходного файла: {original_filename} ({file_size_mb:.2f} MB)\n"
-                f"Части:\n" + "\n".join(parts_info_lines)
-            )
-
             # Отправка частей пользователю
-            for part_path in sorted(part_filenames):
+            part_filenames = sorted(part_filenames)
+            for index, part_path in enumerate(part_filenames):
+                if index < len(uploaded_parts):
+                    # Часть ушла пользователю ещё до перезапуска
+                    file_ids.append(uploaded_parts[index][0])
+                    await asyncio.to_thread(os.remove, part_path)
+                    continue
+
                 part_size_mb = (
                     await asyncio.to_thread(os.path.getsize, part_path)
                 ) / (1024 * 1024)
 
                 if part_size_mb > 50:
-                    await bot.send_message(
-                        chat_id,
-                        f"⚠️ Одна из частей ({os.path.basename(part_path)}) "
-                        f"превышает 50 МБ. Я не могу отправить её через Telegram."
-                    )
-                    continue
+                    # Пропустить часть нельзя (дыра в видео, сдвиг индексов при
+                    # продолжении) — пережимаем только её
+                    print(f"Часть {part_path} ({part_size_mb:.1f} МБ) больше 50 МБ, перекодирую.")
+                    part_path = await asyncio.to_thread(shrink_to_limit, part_path, 50)
 
-                # Чтение файла в потоках, чтобы не блокировать event loop
-                def _read_file(path):
-                    with open(path, "rb") as f:
-                        return f.read()
-
-                data = await asyncio.to_thread(_read_file, part_path)
-                await bot.send_video(chat_id, data, width=width, height=height)
+                part_progress = None
+                if on_progress is not None:
+                    def part_progress(percent, index=index):
+                        on_progress((index * 100 + percent) / len(part_filenames))
+                sent = await upload_video_file(
+                    bot, chat_id, part_path, on_progress=part_progress,
+                    width=width, height=height
+                )
+                file_ids.append(_file_id(sent))
+                if on_part_uploaded is not None:
+                    await on_part_uploaded(_file_id(sent), None)
 
                 await asyncio.to_thread(os.remove, part_path)
                 print(f"Часть {part_path} отправлена и удалена.")
 
-            return
+            admin.video_sent(user_id, username, file_size_mb, parts=len(part_filenames))
+            # Без file_id хотя бы одной части повторно отправить видео нельзя
+            return file_ids if None not in file_ids else None
 
         # Если файл меньше 50 МБ, отправляем как обычно
-        def _read_main(path):
-            with open(path, "rb") as f:
-                return f.read()
+        duration = int(media_info.duration) if media_info and media_info.duration else None
+        sent = await upload_video_file(
+            bot, chat_id, video_path, on_progress=on_progress,
+            width=width, height=height, duration=duration,
+            supports_streaming=True
+        )
+        file_ids.append(_file_id(sent))
 
-        data = await asyncio.to_thread(_read_main, video_path)
-        await bot.send_video(chat_id, data, width=width, height=height)
+        # Отправка попадёт в сводку для администратора
+        admin.video_sent(user_id, username, file_size_mb)
 
-        # Уведомление администратора о завершении
-        await bot.send_message(
-            admin_id,
-            "✅ Видео успешно скачано и отправлено пользователю:\n"
-            f"ID: {user_id}\n"
-            f"Имя: @{username}\n"
-            f"Ссылка: {url}\n"
-            f"Имя файла: {os.path.basename(video_path)}\n"
-            f"Размер файла: {file_size_mb:.2f} MB"
-        )
+        return file_ids if None not in file_ids else None
 
+    except asyncio.CancelledError:
+        # Остановка бота: файл нужен, чтобы продолжить отправку после запуска
+        cancelled = True
+        raise
     except subprocess.CalledProcessError as e:
-        await bot.send_message(admin_id, f"Ошибка при делении файла: {e}")
+        admin.error(
+            f"Ошибка при делении файла: {e}\n"
+            f"ID: {user_id}\nИмя: @{username}\nСсылка: {url}"
+        )
         raise
     except Exception as e:
-        await bot.send_message(admin_id, f"Ошибка при отправке видео: {e}")
+        admin.error(
+            f"Ошибка при отправке видео: {e}\n"
+            f"ID: {user_id}\nИмя: @{username}\nСсылка: {url}"
+        )
         raise
     finally:
-        if os.path.exists(video_path):
+        if cancelled:
+            print(f"Видео {video_path} оставлено для продолжения после перезапуска.")
+        elif os.path.exists(video_path):
             await asyncio.to_thread(os.remove, video_path)
             print(f"Видео {video_path} удалено.")
         else:
             print(f"Видео {video_path} не найдено для удаления.")
+
+
+class CachedSendError(Exception):
+    """
+    Повторная отправка частей по file_id оборвалась, когда часть из них
+    уже дошла до пользователя (sent из total).
+    """
+
+    def __init__(self, sent, total, error):
+        super().__init__(f"отправлено {sent} из {total} частей: {error}")
+        self.sent = sent
+        self.total = total
+
+
+async def send_cached_video(bot, chat_id, file_ids, width=0, height=0, duration=0):
+    """
+    Повторно отправляет уже загруженное в Telegram видео по file_id —
+    без чтения файла и без трафика на загрузку. duration — длительность
+    всего видео, поэтому для частей её не передаём.
+
+    Ошибка на первой части пробрасывается как есть (пользователь ничего
+    не получил), на следующих — CachedSendError.
+    """
+    if len(file_ids) > 1:
+        duration = 0
+    for sent, file_id in enumerate(file_ids):
+        try:
+            await bot.send_video(
+                chat_id, file_id,
+                width=width or None,
+                height=height or None,
+                duration=duration or None,
+                supports_streaming=True
+            )
+        except Exception as e:
+            if not sent:
+                raise
+            raise CachedSendError(sent, len(file_ids), e) from e
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _read_segment_list(list_path):
+    """Готовые части из csv-списка ffmpeg: [(имя файла, начало, конец)]."""
+    try:
+        with open(list_path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    segments = []
+    for line in lines:
+        name, start, end = line.rsplit(",", 2)
+        segments.append((name, float(start), float(end)))
+    return segments
+
+
+async def encode_and_send_segments(
+    bot, chat_id, user_id, username, url, video_path, media_info, plan, admin,
+    poll_interval=0.5, on_progress=None, uploaded_parts=None, on_part_uploaded=None,
+    upload_slot=None
+):
+    """
+    Кодирует длинное видео сразу в части (один проход вместо
+    «перекодировать целиком → перечитать и разрезать») и отправляет каждую
+    часть, как только ffmpeg её закрыл, пока следующие ещё кодируются.
+
+    Возвращает (file_ids, width, height); file_ids — None, если хотя бы
+    для одной части нет file_id. Часть больше 50 МБ не
+    пропускается (дыра в видео, сдвиг точки продолжения после
+    перезапуска), а перекодируется под лимит отдельно.
+    on_progress(percent) — какая доля видео уже закодирована (по концу
+    последней готовой части).
+
+    uploaded_parts — [file_id, конец части] отправленных до перезапуска:
+    кодирование продолжается с конца последней из них (-ss), а не с начала.
+    await on_part_uploaded(file_id, end) вызывается после каждой части.
+    upload_slot() — асинхронный контекстный менеджер, под которым идёт
+    отправка каждой части (слот upload планировщика): ffmpeg тем временем
+    продолжает кодировать следующие.
+    """
+    uploaded_parts = list(uploaded_parts or [])
+    if upload_slot is None:
+        upload_slot = contextlib.nullcontext
+    parts_dir = os.path.dirname(video_path)
+    base_filename = os.path.splitext(os.path.basename(video_path))[0]
+    output_template = os.path.join(parts_dir, f"{base_filename}_part%02d.mp4")
+    list_path = os.path.join(parts_dir, f"{base_filename}_parts.csv")
+
+    # Время в csv-списке отсчитывается от точки, с которой начали кодировать
+    offset = (uploaded_parts[-1][1] or 0.0) if uploaded_parts else 0.0
+    seek_args = ["-ss", f"{offset:.3f}"] if offset else []
+
+    ffmpeg_command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        *seek_args,
+        "-i", video_path,
+        *plan.codec_args,
+        "-f", "segment",
+        "-segment_time", str(plan.segment_time),
+        "-segment_start_number", str(len(uploaded_parts)),
+        "-reset_timestamps", "1",
+        "-segment_format_options", "movflags=+faststart",
+        "-segment_list", list_path,
+        "-segment_list_type", "csv",
+        output_template
+    ]
+
+    if not uploaded_parts:
+        await bot.send_message(
+            chat_id,
+            "Видео длинное, отправлю его частями — первая придёт, "
+            "пока остальные ещё обрабатываются."
+        )
+    # Список от прерванного запуска описывает уже отправленные части
+    await asyncio.to_thread(_remove_if_exists, list_path)
+
+    process = await asyncio.create_subprocess_exec(*ffmpeg_command)
+    file_ids = [file_id for file_id, _ in uploaded_parts]
+    sent_mb = 0.0
+    sent_count = 0
+
+    async def _send_ready_parts():
+        nonlocal sent_count, sent_mb
+        segments = await asyncio.to_thread(_read_segment_list, list_path)
+        if on_progress is not None and segments and media_info.duration:
+            on_progress(min(100.0, (offset + segments[-1][2]) * 100 / media_info.duration))
+        for name, start, end in segments[sent_count:]:
+            part_path = os.path.join(parts_dir, name)
+            size_mb = (await asyncio.to_thread(os.path.getsize, part_path)) / (1024 * 1024)
+            if size_mb > 50:
+                # Пропустить часть нельзя — пережимаем только её
+                print(f"Часть {part_path} ({size_mb:.1f} МБ) больше 50 МБ, перекодирую.")
+                part_path = await asyncio.to_thread(shrink_to_limit, part_path, 50)
+                size_mb = (await asyncio.to_thread(os.path.getsize, part_path)) / (1024 * 1024)
+            sent_mb += size_mb
+            async with upload_slot():
+                sent = await upload_video_file(
+                    bot, chat_id, part_path,
+                    width=plan.width, height=plan.height,
+                    duration=int(end - start) or None,
+                    supports_streaming=True
+                )
+            file_ids.append(_file_id(sent))
+            if on_part_uploaded is not None:
+                await on_part_uploaded(_file_id(sent), offset + end)
+            await asyncio.to_thread(os.remove, part_path)
+            print(f"Часть {part_path} отправлена и удалена.")
+            sent_count += 1
+
+    try:
+        while process.returncode is None:
+            try:
+                await asyncio.wait_for(process.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            await _send_ready_parts()
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, ffmpeg_command)
+        await _send_ready_parts()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    admin.video_sent(user_id, username, sent_mb, parts=len(uploaded_parts) + sent_count)
+
+    # Без file_id хотя бы одной части повторно отправить видео нельзя
+    return (file_ids if None not in file_ids else None), plan.width, plan.height
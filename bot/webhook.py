@@ -0,0 +1,79 @@
+import asyncio
+import hmac
+import json
+
+from aiohttp import web
+from telebot import types
+
+from bot import metrics
+
+
+# Заголовок, в котором Telegram присылает secret_token из setWebhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Приём обновлений по webhook вместо long polling.
+
+    Telegram сам присылает POST с обновлением; проверяем secret_token,
+    сразу отвечаем 200 и передаём обновление обработчикам бота отдельной
+    задачей — долгие задачи (скачивание, отправка) не задерживают приём
+    следующих обновлений.
+    """
+
+    def __init__(self, bot, secret, path="/telegram", host="127.0.0.1", port=8443):
+        self.bot = bot
+        self.secret = secret
+        self.path = path
+        self.host = host
+        self.port = port
+        self._runner = None
+        self._tasks = set()
+
+    def _make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self._make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+
+    async def stop(self):
+        """Перестаёт принимать обновления (уже переданные обработчикам продолжают работу)."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _authorized(self, request):
+        token = request.headers.get(SECRET_HEADER, "")
+        return hmac.compare_digest(token.encode(), self.secret.encode())
+
+    async def _handle(self, request):
+        if not self._authorized(request):
+            metrics.registry.inc("webhook_updates", result="rejected")
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.json())
+        except (ValueError, KeyError, TypeError, json.JSONDecodeError):
+            metrics.registry.inc("webhook_updates", result="invalid")
+            return web.Response(status=400)
+
+        metrics.registry.inc("webhook_updates", result="accepted")
+        task = asyncio.get_running_loop().create_task(
+            self.bot.process_new_updates([update])
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def register(self, url, allowed_updates=None):
+        """setWebhook с нашим secret_token: Telegram начнёт присылать обновления на url."""
+        await self.bot.set_webhook(
+            url=url.rstrip("/") + self.path,
+            secret_token=self.secret,
+            allowed_updates=allowed_updates,
+        )
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import signal
+import socket
+import threading
+from types import SimpleNamespace
+
+from bot import config
+from bot import main as frontend
+from bot.job_store import STAGE_QUEUED
+
+
+class JobReporter:
+    """
+    Замена Flight в процессе-воркере: статус задачи не правится в Telegram,
+    а пишется в JobStore, откуда его забирает фронтенд.
+
+    update() вызывается и из рабочих потоков (прогресс yt-dlp/ffmpeg),
+    поэтому только запоминает последний текст; в базу он уходит фоновой
+    задачей не чаще раза в interval секунд, заодно с heartbeat.
+    """
+
+    def __init__(self, store, record, interval=1.0, heartbeat_interval=10.0):
+        self.store = store
+        self.record = record
+        self.interval = interval
+        self.heartbeat_interval = heartbeat_interval
+        self.status_text = None
+        self._lock = threading.Lock()
+        self._pending = None
+        self._task = None
+
+    def subscribe(self, chat_id, message_id):
+        # Статусные сообщения подписчиков правит фронтенд
+        pass
+
+    def update(self, text, **kwargs):
+        with self._lock:
+            if text == self.status_text:
+                return
+            self.status_text = text
+            self._pending = (text, kwargs.get("parse_mode"))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        since_write = 0.0
+        while True:
+            await asyncio.sleep(self.interval)
+            since_write += self.interval
+            try:
+                if await self.flush():
+                    since_write = 0.0
+                elif since_write >= self.heartbeat_interval:
+                    await asyncio.to_thread(self.store.touch, self.record)
+                    since_write = 0.0
+            except Exception as e:
+                print(f"[WORKER] Ошибка записи статуса: {e}", flush=True)
+
+    async def flush(self):
+        """Записывает последний статус, если он изменился. True — если записали."""
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None:
+            return False
+        await asyncio.to_thread(self.store.set_status, self.record, *pending)
+        return True
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+
+async def _run_job(record):
+    with frontend._track_job():
+        if record.stage != STAGE_QUEUED:
+            # Задачу бросил другой воркер (остановка или сбой) — продолжаем с её стадии
+            attempts = await asyncio.to_thread(frontend.job_store.mark_resumed, record)
+            if attempts > config.JOB_MAX_RESUMES:
+                await asyncio.to_thread(
+                    frontend.job_store.finish, record, "слишком много перезапусков"
+                )
+                await asyncio.to_thread(
+                    frontend.JobWorkspace(config.DOWNLOAD_DIR, record.job_id).cleanup
+                )
+                return
+            frontend.log(f"[WORKER] resuming job {record.job_id} stage={record.stage}")
+
+        reporter = JobReporter(frontend.job_store, record, config.WORKER_STATUS_INTERVAL)
+        reporter.start()
+        message = frontend._message_from_record(record)
+        status_message = SimpleNamespace(message_id=record.status_message_id)
+        try:
+            await frontend._run_download_job(
+                message, record.url, reporter, status_message, record
+            )
+        except Exception:
+            # Ошибка уже записана в задачу, её покажет фронтенд
+            pass
+        finally:
+            await reporter.close()
+
+
+async def _serve(worker_id):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    frontend.log(
+        f"[WORKER] {worker_id} started, concurrency={config.WORKER_CONCURRENCY}"
+    )
+    # Свой OutboundDispatcher в каждом процессе — берём только свою долю лимитов Bot API
+    frontend.outbound.share_limits(config.WORKER_PROCESSES + 1)
+    # Несколько воркеров на одной машине — у каждого свой WORKER_METRICS_PORT
+    metrics_server = await frontend.start_metrics_server(config.WORKER_METRICS_PORT)
+    while not stop.is_set():
+        if len(frontend.active_jobs) >= config.WORKER_CONCURRENCY:
+            await asyncio.wait(
+                set(frontend.active_jobs), timeout=config.WORKER_POLL_INTERVAL,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            continue
+        record = None
+        try:
+            record = await asyncio.to_thread(
+                frontend.job_store.claim, worker_id, config.WORKER_STALE_TIMEOUT
+            )
+        except Exception as e:
+            frontend.log(f"[WORKER] claim failed: {e}")
+        if record is None:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=config.WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        frontend.log(f"[WORKER] {worker_id} took job {record.job_id} url={record.url}")
+        asyncio.create_task(_run_job(record))
+        # Задача попадает в active_jobs при первом шаге — ждём его,
+        # чтобы лимит параллельных задач считался верно
+        await asyncio.sleep(0)
+
+    frontend.log(f"[WORKER] {worker_id} shutting down")
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await frontend._shutdown()
+    released = await asyncio.to_thread(frontend.job_store.release, worker_id)
+    if released:
+        frontend.log(f"[WORKER] released {released} unfinished jobs")
+
+
+def main():
+    # Имя воркера видно в логах фронтенда и в таблице jobs
+    worker_id = config.WORKER_ID or f"{socket.gethostname()}:{os.getpid()}"
+    asyncio.run(_serve(worker_id))
@@ -0,0 +1,28 @@
+import os
+import shutil
+import uuid
+
+
+JOB_DIR_PREFIX = "job_"
+
+
+class JobWorkspace:
+    """
+    Отдельная папка для одной задачи внутри DOWNLOAD_DIR.
+
+    Все файлы задачи (скачанный оригинал, *_fixed.mp4, части) живут только
+    здесь, поэтому параллельные задачи больше не видят чужие файлы.
+    """
+
+    def __init__(self, root_dir, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.path = os.path.join(root_dir, f"{JOB_DIR_PREFIX}{self.job_id}")
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+        return self
+
+    def cleanup(self):
+        """Удаляет папку задачи целиком. Безопасно вызывать повторно."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
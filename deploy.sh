@@ -16,4 +16,10 @@ git pull origin main
 echo "Перезапуск сервиса Telegram-бота..."
 sudo systemctl restart margarine7
 
+# Воркеры (EXTERNAL_WORKERS=1), если они настроены как margarine7-worker@N
+if systemctl list-units --all --plain --no-legend 'margarine7-worker@*' | grep -q .; then
+    echo "Перезапуск воркеров..."
+    sudo systemctl restart 'margarine7-worker@*'
+fi
+
 echo "Деплой Telegram-бота завершён!"